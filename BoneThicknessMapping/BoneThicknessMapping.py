@@ -1,4 +1,12 @@
+import argparse
+import collections
+import copy
+import functools
+import hashlib
 import inspect
+import json
+import os
+import shutil
 
 import ctk
 import slicer
@@ -6,8 +14,12 @@ import numpy
 import time
 import qt
 import vtk
-import colorsys
+import vtkITK
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
+from BoneThicknessMappingLib import BackgroundTask, CohortStatistics, FootprintSearch, LabelmapThickness, Phantoms, RasterExport, ThicknessCalculation
+from BoneThicknessMappingLib.ResultCache import ResultCache
+from BoneThicknessMappingLib.RunMetrics import RunMetrics
 
 
 # Interface tools
@@ -88,6 +100,15 @@ class InterfaceTools:
         if width is not None: b.setFixedWidth(width)
         return b
 
+    @staticmethod
+    def build_check_box(title, on_click, checked=False, tooltip=None, width=None):
+        b = qt.QCheckBox(title)
+        b.setChecked(checked)
+        b.connect('clicked(bool)', on_click)
+        if tooltip is not None: b.setToolTip(tooltip)
+        if width is not None: b.setFixedWidth(width)
+        return b
+
     @staticmethod
     def build_label(text, width=None):
         b = qt.QLabel(text)
@@ -106,9 +127,13 @@ class InterfaceTools:
         return b
 
     @staticmethod
-    def build_min_max(initial, decimals=2, step=0.1, lb=0.0, hb=1000.0, units='mm', min_text='MIN: ', max_text='MAX: '):
-        def set_min(value): initial[0] = value
-        def set_max(value): initial[1] = value
+    def build_min_max(initial, decimals=2, step=0.1, lb=0.0, hb=1000.0, units='mm', min_text='MIN: ', max_text='MAX: ', on_change=None):
+        def set_min(value):
+            initial[0] = value
+            if on_change is not None: on_change()
+        def set_max(value):
+            initial[1] = value
+            if on_change is not None: on_change()
         box = qt.QHBoxLayout()
         box.addStretch()
         box.addWidget(InterfaceTools.build_label(min_text, 40))
@@ -136,6 +161,10 @@ class BoneThicknessMappingType:
     THICKNESS = 'Thickness to dura'
     AIR_CELL = 'Distance to first air cell'
 
+class BoneSegmentationMethod:
+    DIRECT = 'Image filters (threshold, opening, largest island)'
+    SEGMENT_EDITOR = 'Segment Editor effects'
+
 class BoneSegmentationLowerBound:
     MANUAL = 'Manual'
     CLINICAL = 'Clinical CT'
@@ -145,6 +174,16 @@ class BoneDepthMappingPresets:
     MANUAL = 'Manual'
     BCI601 = 'BCI 601'
     BCI602 = 'BCI 602'
+    # (skull thickness, air cell) depth ranges in mm
+    RANGES = {
+        BCI601: ([0.0, 8.7], [0.0, 4.0]),
+        BCI602: ([0.0, 4.5], [0.0, 4.0]),
+    }
+
+class BoneImplantFootprint:
+    DISC = 'Disc (diameter)'
+    RECTANGLE = 'Rectangle (length x width)'
+    SHAPES = {DISC: FootprintSearch.DISC, RECTANGLE: FootprintSearch.RECTANGLE}
 
 class BoneThicknessMappingState:
     WAITING = 1
@@ -159,16 +198,85 @@ class BoneThicknessMappingQuality:
     HIGH = 'HIGH (ray every 0.5 dimensional units)'
     VERY_HIGH = 'VERY HIGH (ray every 0.25 dimensional units)'
     EXTREME = 'EXTREME (ray every 0.125 dimensional units)'
+    PRECISION = {VERY_LOW: 4.0, LOW: 2.0, MEDIUM: 1.0, HIGH: 0.50, VERY_HIGH: 0.25, EXTREME: 0.125}
+
+class BoneThicknessMappingCastEngine:
+    BSP_TREE = 'BSP tree (intersect each ray)'
+    Z_BUFFER = 'Z-buffer (rasterize surface onto cast plane)'
+    LABELMAP = 'Labelmap (march through segment voxels, no surface mesh)'
+
+class BoneThicknessMappingSampling:
+    UNIFORM = 'Uniform grid (ray at every grid point)'
+    ADAPTIVE = 'Adaptive quadtree (refine where depth or thickness changes)'
+
+
+class HitPointGrid:
+    pid_grid = None  # int32 (rows, columns) of point ids, -1 where the ray missed
+    points = None  # float64 (N, 3), normals and thickness rays are built from these
+    normals = None  # float64 (N, 3), zero where no quad was formed
+    vtk_points = None  # float32 copy of points, only for display
+    plane = None  # (cast index, plane origin, precision) placing pid_grid on the cast plane
+    sample_step = 1  # grid cells between the coarsest samples, adaptive grids leave the inside of their leaves unsampled
+
+    def __init__(self, pid_grid, points):
+        self.pid_grid = pid_grid
+        self.points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1, 3)
+        self.normals = numpy.zeros_like(self.points)
+        self.vtk_points = vtk.vtkPoints()
+        self.vtk_points.SetData(numpy_support.numpy_to_vtk(self.points.astype(numpy.float32), deep=False))
+
+    def __len__(self):
+        return len(self.points)
+
+    def set_plane(self, cast_plane):
+        self.plane = (cast_plane.cast_index, tuple(cast_plane.origin), cast_plane.precision)
+
+
+class CastPlane:
+    cast_index = None
+    plane_indices = None
+    negated = None
+    cast_vector = None
+    depth_range = None
+    origin = None
+    precision = None
+    shape = None
+
+    def __init__(self, seg_bounds, cast_axis, precision):
+        self.negated = 1 if cast_axis in [ctk.ctkAxesWidget.Right, ctk.ctkAxesWidget.Anterior, ctk.ctkAxesWidget.Superior] else -1
+        self.cast_index = BoneThicknessMappingLogic.determine_cast_axis_index(cast_axis)
+        self.cast_vector = [0.0, 0.0, 0.0]
+        self.cast_vector[self.cast_index] = 1.0 * self.negated
+        self.plane_indices = [0, 1, 2]
+        self.plane_indices.remove(self.cast_index)
+        depthIncrements = [seg_bounds[self.cast_index], seg_bounds[self.cast_index+1]]
+        if cast_axis in [ctk.ctkAxesWidget.Right, ctk.ctkAxesWidget.Posterior, ctk.ctkAxesWidget.Superior]: depthIncrements.reverse()
+        horizontalIncrements = [seg_bounds[self.plane_indices[0]*2], seg_bounds[self.plane_indices[0]*2+1]]
+        verticalIncrements = [seg_bounds[self.plane_indices[1]*2], seg_bounds[self.plane_indices[1]*2+1]]
+        # rays travel from depth_range[0] to depth_range[1] along the cast index
+        self.depth_range = [depthIncrements[0] + self.negated*100, depthIncrements[1] - self.negated*100]
+        self.origin = [horizontalIncrements[0], verticalIncrements[0]]
+        self.precision = precision
+        self.shape = (
+            int(abs(horizontalIncrements[0] - horizontalIncrements[1])/precision),
+            int(abs(verticalIncrements[0] - verticalIncrements[1])/precision),
+        )
 
+    def tile(self, first_row, last_row):
+        # plane of rows first_row up to last_row, rays of a tile are the same rays as on the whole plane
+        tile = copy.copy(self)
+        tile.origin = [self.origin[0] + first_row*self.precision, self.origin[1]]
+        tile.shape = (last_row - first_row, self.shape[1])
+        return tile
 
-class HitPoint:
-    pid = None
-    point = None
-    normal = [0.0, 0.0, 0.0]
-
-    def __init__(self, pid, point):
-        self.pid = pid
-        self.point = point
+    def ray(self, i, j):
+        p1 = [None, None, None]
+        p1[self.cast_index] = self.depth_range[0]
+        p1[self.plane_indices[0]] = self.origin[0] + i*self.precision
+        p1[self.plane_indices[1]] = self.origin[1] + j*self.precision
+        p2 = p1[:]
+        p2[self.cast_index] = self.depth_range[1]
+        return p1, p2
 
 
 class BoneThicknessMapping(ScriptedLoadableModule):
@@ -187,27 +295,55 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
     # Data members --------------
     state = BoneThicknessMappingState.WAITING
     status, progress = 'N/A', 0
+    notice = None  # why the last execution stopped or could not start, shown while ready
     thicknessScalarArray, airCellScalarArray = None, None
     thicknessColourNode, airCellColourNode = None, None
-    modelPolyData = None
+    modelPolyData = None  # BinaryLabelmap of the segment instead of its surface with the labelmap engine
     segmentationBounds = None
     topLayerPolyData = None
-    hitPointList = None
+    hitPointGrid = None
     modelNode = None
+    results = None  # cast axis -> (top layer poly data, hit point grid, thickness array, air cell array, model node)
+    resultAxis = None
+    resultCache = None
+    implantSitesNode = None
+    progressChannel = None
+    runMetrics = None
+    statusRefreshTime = 0.0
+    STATUS_REFRESH_INTERVAL = 0.1  # seconds between interface refreshes while executing
 
     # Configuration preferences
     CONFIG_precision = 1.0
-    CONFIG_rayCastAxis = ctk.ctkAxesWidget.Left
+    CONFIG_rayCastAxes = [ctk.ctkAxesWidget.Left]
     CONFIG_segmentThresholdRange = [600, 3071]
+    CONFIG_segmentationMethod = BoneSegmentationMethod.DIRECT
     CONFIG_regionOfInterest = [-100, 100]
+    CONFIG_cropToCastingBounds = True
+    CONFIG_cropMarginMm = 20.0
     CONFIG_minMaxAirCell = [0.0, 4.0]
     CONFIG_minMaxSkullThickness = [0.0, 8.7]
+    CONFIG_colourResolutionMm = 0.1
     CONFIG_mmOfAirPastBone = 4.0
+    CONFIG_progressive = False
+    CONFIG_sampling = BoneThicknessMappingSampling.UNIFORM
+    CONFIG_adaptiveTolerance = [0.5, 0.5]
+    CONFIG_castEngine = BoneThicknessMappingCastEngine.BSP_TREE
+    CONFIG_decimationErrorMm = 0.0  # off
+    CONFIG_thicknessWorkers = 1
+    CONFIG_tiled = False
+    CONFIG_tileMemoryMb = 1024.0
+    CONFIG_cacheEnabled = True
+    CONFIG_cacheSizeMb = 2048.0
+    CONFIG_footprintShape = BoneImplantFootprint.DISC
+    CONFIG_footprintSizeMm = [16.0, 16.0]
+    CONFIG_footprintCoverage = 100.0  # % of the footprint that must clear the thickness depth MAX
 
     # UI members (in order of appearance) --------------
     infoLabel = None
     volumeSelector = None
     configuration_tools = None
+    configurationGroups = []
+    depthMappingGroup = None
     statusLabel = None
     executeButton = None
     progressBar = None
@@ -216,6 +352,9 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
     displayThicknessSelector = None
     displayFirstAirCellSelector = None
     displayScalarBarCheckbox = None
+    resultAxisSelector = None
+    exportButton = None
+    sitesLabel = None
 
     def __init__(self, parent=None):
         ScriptedLoadableModuleWidget.__init__(self, parent)
@@ -237,7 +376,7 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         self.volumeSelector = InterfaceTools.build_volume_selector(on_click=self.click_input_selector)
         box = qt.QHBoxLayout()
         box.addWidget(self.volumeSelector)
-        box.addWidget(InterfaceTools.build_icon_button('/Resources/Icons/fit.png', on_click=lambda: BoneThicknessMappingLogic.reset_view(self.CONFIG_rayCastAxis), tooltip="Reset 3D view."))
+        box.addWidget(InterfaceTools.build_icon_button('/Resources/Icons/fit.png', on_click=self.click_fit, tooltip="Reset 3D view."))
         form = qt.QFormLayout()
         form.addRow(qt.QLabel('Select an input volume to auto-segment, render, and calculate thickness.'))
         form.addRow("Input Volume: ", box)
@@ -276,28 +415,41 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         )
 
 
+        # segmentation method
+        def set_method(string): self.CONFIG_segmentationMethod = string
+        methodBox = InterfaceTools.build_combo_box(
+            items=[BoneSegmentationMethod.DIRECT, BoneSegmentationMethod.SEGMENT_EDITOR],
+            current_index_changed=set_method
+        )
+
         group_box = qt.QGroupBox('Auto segmenting')
         group_layout = qt.QFormLayout(group_box)
         group_layout.addRow("Presets", presets)
         group_layout.addRow("Otsu bone-threshold range", threshBox)
+        group_layout.addRow("Method", methodBox)
         layout.addRow(group_box)
 
-        # ray direction
-        def set_axis(a):
-            self.CONFIG_rayCastAxis = a
-            slicer.app.layoutManager().threeDWidget(0).threeDView().lookFromViewAxis(a)
+        # ray directions, every checked one is cast in the same execution
+        def set_axis(a, checked):
+            if checked and a not in self.CONFIG_rayCastAxes: self.CONFIG_rayCastAxes.append(a)
+            elif not checked and a in self.CONFIG_rayCastAxes: self.CONFIG_rayCastAxes.remove(a)
+            if checked: slicer.app.layoutManager().threeDWidget(0).threeDView().lookFromViewAxis(a)
+            self.update_all()
+
+        def build_axis_box(title, a):
+            return InterfaceTools.build_check_box(title, lambda checked: set_axis(a, checked), checked=a in self.CONFIG_rayCastAxes, width=100)
 
         dirBox = qt.QVBoxLayout()
         row1 = qt.QHBoxLayout()
         row1.addStretch()
-        row1.addWidget(InterfaceTools.build_radio_button('R', lambda: set_axis(ctk.ctkAxesWidget.Right), width=100))
-        row1.addWidget(InterfaceTools.build_radio_button('A', lambda: set_axis(ctk.ctkAxesWidget.Anterior), width=100))
-        row1.addWidget(InterfaceTools.build_radio_button('S', lambda: set_axis(ctk.ctkAxesWidget.Superior), width=100))
+        row1.addWidget(build_axis_box('R', ctk.ctkAxesWidget.Right))
+        row1.addWidget(build_axis_box('A', ctk.ctkAxesWidget.Anterior))
+        row1.addWidget(build_axis_box('S', ctk.ctkAxesWidget.Superior))
         row2 = qt.QHBoxLayout()
         row2.addStretch()
-        row2.addWidget(InterfaceTools.build_radio_button('L', lambda: set_axis(ctk.ctkAxesWidget.Left), width=100, checked=True))
-        row2.addWidget(InterfaceTools.build_radio_button('P', lambda: set_axis(ctk.ctkAxesWidget.Posterior), width=100))
-        row2.addWidget(InterfaceTools.build_radio_button('I', lambda: set_axis(ctk.ctkAxesWidget.Inferior), width=100))
+        row2.addWidget(build_axis_box('L', ctk.ctkAxesWidget.Left))
+        row2.addWidget(build_axis_box('P', ctk.ctkAxesWidget.Posterior))
+        row2.addWidget(build_axis_box('I', ctk.ctkAxesWidget.Inferior))
         dirBox.addLayout(row1)
         dirBox.addLayout(row2)
 
@@ -311,12 +463,30 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         # region of interest
         roiBox, setRoi = InterfaceTools.build_min_max(self.CONFIG_regionOfInterest, step=1.0, decimals=0, lb=-1000, hb=1000, units='units')
 
+        # crop the volume to the casting bounds before segmenting
+        cropBox = qt.QHBoxLayout()
+        def set_crop(state):
+            self.CONFIG_cropToCastingBounds = state == 2
+            cropMarginBox.setEnabled(self.CONFIG_cropToCastingBounds)
+        def set_crop_margin(mm): self.CONFIG_cropMarginMm = mm
+        cropCheckbox = qt.QCheckBox()
+        cropCheckbox.checked = self.CONFIG_cropToCastingBounds
+        cropCheckbox.setToolTip("Only segment and mesh the casting bounds plus a margin, for thickness rays leaving them at an angle.")
+        cropCheckbox.connect("stateChanged(int)", set_crop)
+        cropMarginBox = InterfaceTools.build_spin_box(0.0, 1000.0, decimals=1, click=set_crop_margin, step=1.0, initial=self.CONFIG_cropMarginMm, width=120)
+        cropBox.addStretch()
+        cropBox.addWidget(cropCheckbox)
+        cropBox.addWidget(InterfaceTools.build_label("margin", width=50))
+        cropBox.addWidget(cropMarginBox)
+        cropBox.addWidget(InterfaceTools.build_label("mm", width=30))
+
         # add ray-casting box
         group_box = qt.QGroupBox('Ray-casting')
         group_layout = qt.QFormLayout(group_box)
-        group_layout.addRow("Cast direction: ", dirBox)
+        group_layout.addRow("Cast directions: ", dirBox)
         group_layout.addRow("Air allowance after bone: ", airBox)
         group_layout.addRow("Casting bounds (along cast direction):", roiBox)
+        group_layout.addRow("Crop volume to casting bounds:", cropBox)
         layout.addRow(InterfaceTools.build_vertical_space())
         layout.addRow(group_box)
 
@@ -324,41 +494,47 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         # TODO
 
         # min/max
-        skullBox, setSkullBoxes = InterfaceTools.build_min_max(self.CONFIG_minMaxSkullThickness)
-        airCellBox, setAirBoxes = InterfaceTools.build_min_max(self.CONFIG_minMaxAirCell)
+        skullBox, setSkullBoxes = InterfaceTools.build_min_max(self.CONFIG_minMaxSkullThickness, on_change=lambda: self.update_depth_mapping(BoneThicknessMappingType.THICKNESS))
+        airCellBox, setAirBoxes = InterfaceTools.build_min_max(self.CONFIG_minMaxAirCell, on_change=lambda: self.update_depth_mapping(BoneThicknessMappingType.AIR_CELL))
 
         def pick_depth_preset(string):
             if string == BoneDepthMappingPresets.MANUAL:
                 setSkullBoxes(enabled=True)
                 setAirBoxes(enabled=True)
-            elif string == BoneDepthMappingPresets.BCI601:
-                setSkullBoxes([0.0, 8.7], enabled=False)
-                setAirBoxes([0.0, 4.0], enabled=False)
-            elif string == BoneDepthMappingPresets.BCI602:
-                setSkullBoxes([0.0, 4.5], enabled=False)
-                setAirBoxes([0.0, 4.0], enabled=False)
+            elif string in BoneDepthMappingPresets.RANGES:
+                skullRange, airCellRange = BoneDepthMappingPresets.RANGES[string]
+                setSkullBoxes(skullRange, enabled=False)
+                setAirBoxes(airCellRange, enabled=False)
         comboBox = InterfaceTools.build_combo_box(
             items=[BoneDepthMappingPresets.MANUAL, BoneDepthMappingPresets.BCI601, BoneDepthMappingPresets.BCI602],
             current_index_changed=pick_depth_preset
         )
 
+        # colour steps of both maps
+        def set_resolution(value):
+            self.CONFIG_colourResolutionMm = value
+            self.update_depth_mapping(BoneThicknessMappingType.THICKNESS)
+            self.update_depth_mapping(BoneThicknessMappingType.AIR_CELL)
+        resolutionSpinBox = InterfaceTools.build_spin_box(0.01, 1.0, click=set_resolution, decimals=2, step=0.01, initial=self.CONFIG_colourResolutionMm, width=80)
+        resolutionSpinBox.setSuffix(' mm')
+        resolutionSpinBox.setToolTip("Depth covered by each colour of the thickness and air cell maps.")
+        resolutionBox = qt.QHBoxLayout()
+        resolutionBox.addStretch()
+        resolutionBox.addWidget(resolutionSpinBox)
+
         # add ray-casting box
-        group_box = qt.QGroupBox('Depth mapping')
+        group_box = self.depthMappingGroup = qt.QGroupBox('Depth mapping')
         g_layout = qt.QFormLayout(group_box)
         g_layout.addRow('Depth preset: ', comboBox)
         g_layout.addRow("Thickness depth: ", skullBox)
         g_layout.addRow("Air cell depth: ", airCellBox)
+        g_layout.addRow("Colour resolution: ", resolutionBox)
         layout.addRow(InterfaceTools.build_vertical_space())
         layout.addRow(group_box)
 
         # quality
         def current_index_changed(string):
-            if string == BoneThicknessMappingQuality.VERY_LOW: self.CONFIG_precision = 4.0
-            elif string == BoneThicknessMappingQuality.LOW: self.CONFIG_precision = 2.0
-            elif string == BoneThicknessMappingQuality.MEDIUM: self.CONFIG_precision = 1.0
-            elif string == BoneThicknessMappingQuality.HIGH: self.CONFIG_precision = 0.50
-            elif string == BoneThicknessMappingQuality.VERY_HIGH: self.CONFIG_precision = 0.25
-            elif string == BoneThicknessMappingQuality.EXTREME: self.CONFIG_precision = 0.125
+            if string in BoneThicknessMappingQuality.PRECISION: self.CONFIG_precision = BoneThicknessMappingQuality.PRECISION[string]
         comboBox = qt.QComboBox()
         comboBox.addItems([BoneThicknessMappingQuality.VERY_LOW, BoneThicknessMappingQuality.LOW, BoneThicknessMappingQuality.MEDIUM, BoneThicknessMappingQuality.HIGH, BoneThicknessMappingQuality.VERY_HIGH, BoneThicknessMappingQuality.EXTREME])
         comboBox.setCurrentIndex(2)
@@ -368,15 +544,102 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         box.addStretch()
         box.addWidget(comboBox)
 
+        # progressive preview
+        def set_progressive(state): self.CONFIG_progressive = state == 2
+        progressiveCheckbox = qt.QCheckBox()
+        progressiveCheckbox.checked = self.CONFIG_progressive
+        progressiveCheckbox.setToolTip("Render a VERY LOW quality map first and refine it level by level up to the selected quality.")
+        progressiveCheckbox.connect("stateChanged(int)", set_progressive)
+
+        # sampling
+        def set_sampling(string):
+            self.CONFIG_sampling = string
+            setToleranceBoxes(enabled=string == BoneThicknessMappingSampling.ADAPTIVE)
+        samplingBox = InterfaceTools.build_combo_box(
+            items=[BoneThicknessMappingSampling.UNIFORM, BoneThicknessMappingSampling.ADAPTIVE],
+            current_index_changed=set_sampling
+        )
+        toleranceBoxes, setToleranceBoxes = InterfaceTools.build_min_max(self.CONFIG_adaptiveTolerance, step=0.1, hb=20.0, min_text='DEPTH: ', max_text='THICK: ')
+        setToleranceBoxes(enabled=False)
+
         # add ray-casting box
         group_box = qt.QGroupBox('Rendering')
         g_layout = qt.QFormLayout(group_box)
         g_layout.addRow("Render quality: ", box)
+        g_layout.addRow("Progressive preview: ", progressiveCheckbox)
+        g_layout.addRow("Sampling: ", samplingBox)
+        g_layout.addRow("Refine above: ", toleranceBoxes)
+        layout.addRow(InterfaceTools.build_vertical_space())
+        layout.addRow(group_box)
+
+        # first-hit engine
+        def set_engine(string): self.CONFIG_castEngine = string
+        engineBox = InterfaceTools.build_combo_box(
+            items=[BoneThicknessMappingCastEngine.BSP_TREE, BoneThicknessMappingCastEngine.Z_BUFFER, BoneThicknessMappingCastEngine.LABELMAP],
+            current_index_changed=set_engine
+        )
+
+        # surface decimation
+        decimationBox = qt.QHBoxLayout()
+        def set_decimation(mm): self.CONFIG_decimationErrorMm = mm
+        decimationSpinBox = InterfaceTools.build_spin_box(0.0, 5.0, click=set_decimation, decimals=2, step=0.05, initial=self.CONFIG_decimationErrorMm, width=260)
+        decimationSpinBox.setToolTip("Largest distance the simplified bone surface may move from the segmented one, 0 keeps every triangle.")
+        decimationBox.addStretch()
+        decimationBox.addWidget(decimationSpinBox)
+        decimationBox.addWidget(InterfaceTools.build_label("mm", width=60))
+
+        # thickness worker processes
+        workerBox = qt.QHBoxLayout()
+        def set_workers(count): self.CONFIG_thicknessWorkers = int(count)
+        workerBox.addStretch()
+        workerBox.addWidget(InterfaceTools.build_spin_box(1, max(1, os.cpu_count() or 1), click=set_workers, initial=self.CONFIG_thicknessWorkers, width=260))
+        workerBox.addWidget(InterfaceTools.build_label("processes", width=60))
+
+        # tiled execution
+        tileBox = qt.QHBoxLayout()
+        def set_tiled(state): self.CONFIG_tiled = state == 2
+        def set_tile_memory(mb): self.CONFIG_tileMemoryMb = mb
+        tileCheckbox = qt.QCheckBox()
+        tileCheckbox.checked = self.CONFIG_tiled
+        tileCheckbox.setToolTip("Cast the uniform grid in tiles of rows, finishing the thickness of each before the next, so that working memory stays within the budget at any quality.")
+        tileCheckbox.connect("stateChanged(int)", set_tiled)
+        tileBox.addStretch()
+        tileBox.addWidget(tileCheckbox)
+        tileBox.addWidget(InterfaceTools.build_spin_box(16, 1000000, click=set_tile_memory, step=256, initial=self.CONFIG_tileMemoryMb, width=120))
+        tileBox.addWidget(InterfaceTools.build_label("MB", width=30))
+
+        # result cache
+        cacheBox = qt.QHBoxLayout()
+        def set_cache_enabled(state): self.CONFIG_cacheEnabled = state == 2
+        def set_cache_size(mb): self.CONFIG_cacheSizeMb = mb
+        def clear_cache():
+            cache = self.get_result_cache()
+            if cache is not None: cache.clear()
+        cacheCheckbox = qt.QCheckBox()
+        cacheCheckbox.checked = self.CONFIG_cacheEnabled
+        cacheCheckbox.connect("stateChanged(int)", set_cache_enabled)
+        cacheBox.addStretch()
+        cacheBox.addWidget(cacheCheckbox)
+        cacheBox.addWidget(InterfaceTools.build_spin_box(64, 1000000, click=set_cache_size, step=256, initial=self.CONFIG_cacheSizeMb, width=120))
+        cacheBox.addWidget(InterfaceTools.build_label("MB", width=30))
+        clearButton = qt.QPushButton('Clear')
+        clearButton.connect('clicked(bool)', clear_cache)
+        cacheBox.addWidget(clearButton)
+
+        # add performance box
+        group_box = qt.QGroupBox('Performance')
+        g_layout = qt.QFormLayout(group_box)
+        g_layout.addRow("First-hit engine: ", engineBox)
+        g_layout.addRow("Decimation error: ", decimationBox)
+        g_layout.addRow("Thickness workers: ", workerBox)
+        g_layout.addRow("Tiled casting: ", tileBox)
+        g_layout.addRow("Result cache: ", cacheBox)
         layout.addRow(InterfaceTools.build_vertical_space())
         layout.addRow(group_box)
 
         layout.addRow(InterfaceTools.build_vertical_space())
         layout.setMargin(10)
+        self.configurationGroups = slicer.util.findChildren(self.configuration_tools, className='QGroupBox')
         return self.configuration_tools
 
     def build_execution_tools(self):
@@ -395,9 +658,14 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         self.finishButton.visible = False
         self.finishButton.connect('clicked(bool)', self.click_finish)
         self.finishButton.setFixedHeight(36)
+        self.cancelButton = qt.QPushButton('Cancel')
+        self.cancelButton.visible = False
+        self.cancelButton.connect('clicked(bool)', self.click_cancel)
+        self.cancelButton.setFixedHeight(36)
         box = qt.QHBoxLayout()
         box.addWidget(self.progressBar)
         box.addWidget(self.finishButton)
+        box.addWidget(self.cancelButton)
 
         layout = qt.QVBoxLayout()
         layout.addWidget(self.build_configuration_tools())
@@ -417,6 +685,10 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         box.addWidget(self.displayThicknessSelector)
         box.addWidget(self.displayFirstAirCellSelector)
 
+        # switches between the maps of a multi-direction run, all models stay loaded
+        self.resultAxisSelector = qt.QComboBox()
+        self.resultAxisSelector.connect("currentIndexChanged(QString)", lambda name: self.show_result(BoneThicknessMappingBatch.AXES[name]) if name else None)
+
         self.displayScalarBarCheckbox = qt.QCheckBox()
         self.displayScalarBarCheckbox.checked = True
         self.displayScalarBarCheckbox.connect("stateChanged(int)", self.click_toggle_scalar_bar)
@@ -424,8 +696,40 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         form = qt.QFormLayout(self.resultSection)
         # form.addRow('Results', qt.QWidget())
         form.addRow("Map Display: ", box)
+        form.addRow("Cast direction: ", self.resultAxisSelector)
         # form.addRow(qt.QLayout())
         form.addRow("Display Scalar Bar: ", self.displayScalarBarCheckbox)
+        self.exportButton = qt.QPushButton('Export...')
+        self.exportButton.toolTip = "Save the shown map as a binary .vtp model plus memory-mappable .npy thickness, air cell and hit mask rasters of the cast plane."
+        self.exportButton.connect('clicked(bool)', self.click_export)
+        form.addRow("Export rasters: ", self.exportButton)
+
+        # implant site search, sites need the thickness depth MAX under (a share of) the footprint
+        def set_footprint_shape(string): self.CONFIG_footprintShape = string
+        footprintShapeBox = InterfaceTools.build_combo_box([BoneImplantFootprint.DISC, BoneImplantFootprint.RECTANGLE], set_footprint_shape)
+        footprintSizeBox, _ = InterfaceTools.build_min_max(self.CONFIG_footprintSizeMm, step=0.5, hb=100.0, min_text='SIZE: ', max_text='WIDTH: ')
+        def set_coverage(value): self.CONFIG_footprintCoverage = value
+        coverageSpinBox = InterfaceTools.build_spin_box(50.0, 100.0, click=set_coverage, decimals=0, step=5.0, initial=self.CONFIG_footprintCoverage, width=80)
+        coverageSpinBox.setSuffix(' %')
+        coverageSpinBox.setToolTip("Share of the footprint that must reach the thickness depth MAX. At 100% sites rank by the thinnest bone under them, below it by that share.")
+        findSitesButton = qt.QPushButton('Find sites')
+        findSitesButton.setToolTip("Mark the best implant sites on the shown map, at least one footprint apart.")
+        findSitesButton.connect('clicked(bool)', self.click_find_sites)
+        searchBox = qt.QHBoxLayout()
+        searchBox.addStretch()
+        searchBox.addWidget(coverageSpinBox)
+        searchBox.addWidget(findSitesButton)
+        form.addRow("Implant footprint: ", footprintShapeBox)
+        form.addRow("Footprint size: ", footprintSizeBox)
+        form.addRow("Clearing depth: ", searchBox)
+        self.sitesLabel = qt.QLabel()
+        self.sitesLabel.setStyleSheet('font-family: monospace; font-size: 10px')
+        self.sitesLabel.setTextInteractionFlags(qt.Qt.TextSelectableByMouse)
+        form.addRow("Implant sites: ", self.sitesLabel)
+        self.metricsLabel = qt.QLabel()
+        self.metricsLabel.setStyleSheet('font-family: monospace; font-size: 10px')
+        self.metricsLabel.setTextInteractionFlags(qt.Qt.TextSelectableByMouse)
+        form.addRow("Run metrics: ", self.metricsLabel)
         form.setContentsMargins(10, 8, 10, 14)
 
         layout = qt.QVBoxLayout()
@@ -455,6 +759,9 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
             self.volumeSelector.enabled = False
 
     def update_execution_tools(self):
+        # only the depth mapping stays editable once a map exists, it re-colours the result in place
+        for group in self.configurationGroups:
+            group.enabled = self.state is not BoneThicknessMappingState.FINISHED or group is self.depthMappingGroup
         if self.state is BoneThicknessMappingState.WAITING:
             self.configuration_tools.enabled = True
             self.configuration_tools.collapsed = True
@@ -465,15 +772,17 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
             self.statusLabel.enabled = False
             self.statusLabel.text = 'Status: WAITING'
             self.finishButton.visible = False
+            self.cancelButton.visible = False
         elif self.state is BoneThicknessMappingState.READY:
             self.configuration_tools.enabled = True
             self.executeButton.visible = True
-            self.executeButton.enabled = True
+            self.executeButton.enabled = len(self.CONFIG_rayCastAxes) > 0
             self.progressBar.visible = False
             self.progressBar.value = 0
             self.statusLabel.enabled = True
-            self.statusLabel.text = 'Status: READY'
+            self.statusLabel.text = 'Status: READY' if self.notice is None else 'Status: READY (' + self.notice + ')'
             self.finishButton.visible = False
+            self.cancelButton.visible = False
         elif self.state is BoneThicknessMappingState.EXECUTING:
             self.configuration_tools.enabled = False
             self.configuration_tools.collapsed = True
@@ -484,75 +793,358 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
             self.statusLabel.enabled = True
             self.statusLabel.text = 'Status: ' + str(self.status)
             self.finishButton.visible = False
+            self.cancelButton.visible = True
+            self.cancelButton.enabled = self.progressChannel is not None and not self.progressChannel.cancelled()
         elif self.state is BoneThicknessMappingState.FINISHED:
-            self.configuration_tools.enabled = False
-            self.configuration_tools.collapsed = True
+            self.configuration_tools.enabled = True
             self.progressBar.value = 100
             self.executeButton.visible = False
             self.finishButton.visible = True
+            self.cancelButton.visible = False
 
     def update_results(self):
         if self.thicknessScalarArray is not None and self.airCellScalarArray is not None:
             self.resultSection.enabled = True
         else: self.resultSection.enabled = False
+        finished = self.state is BoneThicknessMappingState.FINISHED and self.runMetrics is not None
+        self.resultAxisSelector.enabled = self.results is not None and len(self.results) > 1
+        self.metricsLabel.text = self.runMetrics.summary() if finished else ''
 
-    def update_status(self, text=None, progress=None):
+    def update_status(self, text=None, progress=None, force=False):
         if text is not None:
             print(text)
             self.status = str(text)
         if progress is not None:
             self.progress = progress
+        # refreshing the whole interface is expensive, so skip refreshes that come too soon after the last one
+        if not force and time.time() - self.statusRefreshTime < self.STATUS_REFRESH_INTERVAL: return
+        self.statusRefreshTime = time.time()
         self.update_all()
         slicer.app.processEvents()
 
+    def run_in_background(self, function, channel=None, **kwargs):
+        # the stage runs on a worker thread while this loop keeps the interface alive and relays its progress
+        self.progressChannel = channel if channel is not None else BackgroundTask.ProgressChannel()
+        task = BackgroundTask.BackgroundTask(function, self.progressChannel, **kwargs)
+        task.start()
+        try:
+            while task.is_alive():
+                task.join(self.STATUS_REFRESH_INTERVAL)
+                self.relay_progress()
+            self.relay_progress()
+        finally:
+            self.progressChannel = None
+        return task.result()
+
+    def relay_progress(self):
+        for function, args in self.progressChannel.take_posted(): function(*args)
+        status = self.progressChannel.take_status()
+        if status is not None: self.update_status(text=status[0], progress=status[1], force=True)
+        else: slicer.app.processEvents()
+
     # interface click events ----------------------------------------------------------------------
     def click_input_selector(self):
         if self.volumeSelector.currentNode() is not None:
             BoneThicknessMappingLogic.update_input_volume(self.volumeSelector.currentNode().GetID())
+        self.notice = None
         self.update_all()
 
     def click_execute(self):
-        # TODO add try and catch
         if self.state is not BoneThicknessMappingState.READY: return
+        outside = self.axes_outside_volume()
+        if outside:
+            self.notice = 'the region of interest misses the volume when casting from ' + ', '.join(outside)
+            self.update_status(text='Not executing, ' + self.notice, force=True)
+            return
+        self.notice = None
         self.state = BoneThicknessMappingState.EXECUTING
-        self.update_status(text='Initializing execution..', progress=0)
-        BoneThicknessMappingLogic.reset_view(self.CONFIG_rayCastAxis)
+        self.modelNode = None
+        self.runMetrics = RunMetrics()
+        self.update_status(text='Initializing execution..', progress=0, force=True)
+        try: self.execute()
+        except BackgroundTask.Cancelled: self.abort_execution()
+        except Exception as e:
+            # leave the interface ready for another run, the traceback still reaches the Python console
+            self.abort_execution('Execution failed: ' + str(e))
+            raise
+
+    def axes_outside_volume(self):
+        # names of the cast axes whose region of interest, grown by the crop margin, misses the volume; cropping to it
+        # would leave no voxels to segment
+        if not self.CONFIG_cropToCastingBounds: return []
+        axisNames = dict((axis, name) for name, axis in BoneThicknessMappingBatch.AXES.items())
+        return [axisNames[axis] for axis in self.CONFIG_rayCastAxes if BoneThicknessMappingLogic.bounds_empty(BoneThicknessMappingLogic.crop_bounds(
+            self.volumeSelector.currentNode(), [axis], self.CONFIG_regionOfInterest, self.CONFIG_cropMarginMm))]
+
+    def execute(self):
+        BoneThicknessMappingLogic.reset_view(self.CONFIG_rayCastAxes[0])
         BoneThicknessMappingLogic.clear_3d_view()
         BoneThicknessMappingLogic.set_scalar_colour_bar_state(0)
-        self.modelPolyData, self.segmentationBounds = BoneThicknessMappingLogic.process_segmentation(
-            threshold_range=self.CONFIG_segmentThresholdRange,
-            image=self.volumeSelector.currentNode(),
-            axis=self.CONFIG_rayCastAxis,
-            update_status=self.update_status
-        )
-        self.topLayerPolyData, self.hitPointList = BoneThicknessMappingLogic.rainfall_quad_cast(
-            poly_data=self.modelPolyData,
-            seg_bounds=self.segmentationBounds,
-            cast_axis=self.CONFIG_rayCastAxis,
-            precision=self.CONFIG_precision,
-            region_of_interest=self.CONFIG_regionOfInterest,
-            update_status=self.update_status
-        )
-        self.modelNode = BoneThicknessMappingLogic.build_model(
-            poly_data=self.topLayerPolyData,
-            update_status=self.update_status
-        )
-        self.thicknessScalarArray, self.airCellScalarArray = BoneThicknessMappingLogic.ray_cast_color_thickness(
-            poly_data=self.modelPolyData,
-            hit_point_list=self.hitPointList,
-            cast_axis=self.CONFIG_rayCastAxis,
-            dimensions=self.volumeSelector.currentNode().GetImageData().GetDimensions(),
-            mm_of_air_past_bone=self.CONFIG_mmOfAirPastBone,
-            update_status=self.update_status
-        )
         self.thicknessColourNode, self.airCellColourNode = BoneThicknessMappingLogic.build_color_table_nodes(
             minmax_thickness=self.CONFIG_minMaxSkullThickness,
-            minmax_air_cell=self.CONFIG_minMaxAirCell
+            minmax_air_cell=self.CONFIG_minMaxAirCell,
+            resolution=self.CONFIG_colourResolutionMm,
+            table_nodes=(self.thicknessColourNode, self.airCellColourNode),
+            metrics=self.runMetrics
         )
-        # finalize
-        self.click_result_radio()
+        cropBounds = None
+        if self.CONFIG_cropToCastingBounds:
+            cropBounds = BoneThicknessMappingLogic.crop_bounds(self.volumeSelector.currentNode(), self.CONFIG_rayCastAxes, self.CONFIG_regionOfInterest, self.CONFIG_cropMarginMm)
+        cache, segmentationKey = self.get_result_cache(), None
+        if cache is not None:
+            # keyed on the voxels that are segmented, different requested bounds can crop to the same ones
+            volume = self.volumeSelector.currentNode()
+            cropExtent = BoneThicknessMappingLogic.crop_extent(volume, cropBounds) if cropBounds is not None else None
+            if cropExtent == list(volume.GetImageData().GetExtent()): cropExtent = None
+            segmentationKey = ResultCache.key(BoneThicknessMappingLogic.volume_fingerprint(volume), self.CONFIG_segmentThresholdRange, self.CONFIG_segmentationMethod, cropExtent)
+
+        # every axis gets its own top layer model, the bone surface and its locators are only prepared once
+        surface, axisNames = None, dict((axis, name) for name, axis in BoneThicknessMappingBatch.AXES.items())
+        self.results = collections.OrderedDict()
+        for axis in self.CONFIG_rayCastAxes:
+            resultKey, cachedResult = None, None
+            if cache is not None:
+                self.update_status(text='Checking result cache...', progress=1)
+                resultKey = ResultCache.key(segmentationKey, axis, self.CONFIG_precision, self.CONFIG_regionOfInterest, self.CONFIG_mmOfAirPastBone, self.CONFIG_castEngine,
+                                           self.CONFIG_sampling, self.CONFIG_adaptiveTolerance if self.CONFIG_sampling == BoneThicknessMappingSampling.ADAPTIVE else None, self.CONFIG_decimationErrorMm)
+                with self.runMetrics.stage('cache_lookup'): cachedResult = BoneThicknessMappingLogic.load_cached_result(cache, resultKey)
+            if cachedResult is not None:
+                self.update_status(text='Loaded thickness map from cache...', progress=80)
+                self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray = cachedResult
+                self.modelNode = BoneThicknessMappingLogic.build_model(
+                    poly_data=self.topLayerPolyData,
+                    update_status=self.update_status
+                )
+            else:
+                if surface is None: surface = self.prepare_surface(cache, segmentationKey, cropBounds)
+                self.update_status(text='Casting from ' + axisNames[axis] + '...', progress=20)
+                self.execute_pipeline(axis, surface, cache, resultKey)
+            BoneThicknessMappingLogic.attach_scalar_arrays(self.topLayerPolyData, self.thicknessScalarArray, self.airCellScalarArray)
+            self.modelNode.SetName('BoneThicknessMap_' + axisNames[axis])
+            self.results[axis] = (self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray, self.modelNode)
+            self.click_result_radio()
+
+        # finalize, metrics are kept with the results so they are saved along with the scene
+        for result in self.results.values(): result[4].SetAttribute('BoneThicknessMapping.Metrics', json.dumps(self.runMetrics.as_dict()))
+        self.resultAxisSelector.clear()
+        self.resultAxisSelector.addItems([axisNames[axis] for axis in self.results])
+        self.show_result(self.CONFIG_rayCastAxes[0])
         self.state = BoneThicknessMappingState.FINISHED
-        self.update_status(progress=100)
+        self.update_status(progress=100, force=True)
+
+    def abort_execution(self, status='Execution cancelled'):
+        # the axis being cast when cancelled or failing may not be in the results yet
+        modelNodes = [result[4] for result in self.results.values()] if self.results is not None else []
+        for modelNode in set(modelNodes + [self.modelNode]):
+            if modelNode is not None: slicer.mrmlScene.RemoveNode(modelNode)
+        self.results = None
+        self.modelNode, self.topLayerPolyData, self.hitPointGrid = None, None, None
+        self.thicknessScalarArray, self.airCellScalarArray = None, None
+        self.state = BoneThicknessMappingState.WAITING
+        self.notice = status
+        self.update_status(text=status, progress=0, force=True)
+
+    def prepare_surface(self, cache=None, segmentation_key=None, crop_bounds=None):
+        # bone surface (or labelmap), the undecimated surface if it was decimated, and the locators shared by every axis
+        # the labelmap engine keeps the segment's voxels in place of a surface mesh, those are not cached
+        labelmapEngine = self.CONFIG_castEngine == BoneThicknessMappingCastEngine.LABELMAP
+        cachedSegmentation = BoneThicknessMappingLogic.load_cached_segmentation(cache, segmentation_key) if cache is not None and not labelmapEngine else None
+        if cachedSegmentation is not None:
+            self.update_status(text='Loaded segmentation surface from cache...', progress=18)
+            self.modelPolyData, self.segmentationBounds = cachedSegmentation
+            BoneThicknessMappingLogic.build_surface_model(self.modelPolyData)
+        else:
+            self.modelPolyData, self.segmentationBounds = BoneThicknessMappingLogic.process_segmentation(
+                threshold_range=self.CONFIG_segmentThresholdRange,
+                image=self.volumeSelector.currentNode(),
+                axis=self.CONFIG_rayCastAxes[0],
+                update_status=self.update_status,
+                closed_surface=not labelmapEngine,
+                method=self.CONFIG_segmentationMethod,
+                crop_bounds=crop_bounds,
+                metrics=self.runMetrics
+            )
+            if cache is not None and not labelmapEngine: BoneThicknessMappingLogic.store_cached_segmentation(cache, segmentation_key, self.modelPolyData, self.segmentationBounds)
+        # locators are cached per mesh, the decimated surface is a different mesh than the segmented one
+        segmentedPolyData, meshKey = None, segmentation_key
+        if not labelmapEngine and self.CONFIG_decimationErrorMm > 0:
+            self.update_status(text='Decimating bone surface...', progress=19)
+            segmentedPolyData = self.modelPolyData
+            self.modelPolyData = BoneThicknessMappingLogic.decimate_surface(segmentedPolyData, self.CONFIG_decimationErrorMm, self.runMetrics)
+            if segmentation_key is not None: meshKey = ResultCache.key(segmentation_key, self.CONFIG_decimationErrorMm)
+        bspTree, cellLocator = None, None
+        def build_cell_locator():
+            with self.runMetrics.stage('locator_build'): return ThicknessCalculation.build_cell_locator(self.modelPolyData)
+        if self.CONFIG_castEngine == BoneThicknessMappingCastEngine.BSP_TREE:
+            def build_bsp_tree(): return BoneThicknessMappingLogic.build_bsp_tree(self.modelPolyData, self.runMetrics)
+            bspTree = cache.locator(meshKey, 'bsp', build_bsp_tree) if cache is not None else build_bsp_tree()
+        if not labelmapEngine and self.CONFIG_thicknessWorkers <= 1:
+            cellLocator = cache.locator(meshKey, 'cell', build_cell_locator) if cache is not None else build_cell_locator()
+        return segmentedPolyData, bspTree, cellLocator
+
+    def execute_pipeline(self, cast_axis, surface, cache=None, result_key=None):
+        segmentedPolyData, bspTree, cellLocator = surface
+        if self.CONFIG_sampling == BoneThicknessMappingSampling.ADAPTIVE:
+            self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray = self.run_in_background(
+                BoneThicknessMappingLogic.adaptive_quad_cast,
+                poly_data=self.modelPolyData,
+                seg_bounds=self.segmentationBounds,
+                cast_axis=cast_axis,
+                precision=self.CONFIG_precision,
+                region_of_interest=self.CONFIG_regionOfInterest,
+                dimensions=self.volumeSelector.currentNode().GetImageData().GetDimensions(),
+                mm_of_air_past_bone=self.CONFIG_mmOfAirPastBone,
+                depth_tolerance=self.CONFIG_adaptiveTolerance[0],
+                thickness_tolerance=self.CONFIG_adaptiveTolerance[1],
+                engine=self.CONFIG_castEngine,
+                workers=self.CONFIG_thicknessWorkers,
+                bsp_tree=bspTree,
+                cell_locator=cellLocator,
+                metrics=self.runMetrics
+            )
+            self.modelNode = BoneThicknessMappingLogic.build_model(
+                poly_data=self.topLayerPolyData,
+                update_status=lambda text=None, progress=None: None
+            )
+        elif self.CONFIG_tiled:
+            self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray = self.run_in_background(
+                BoneThicknessMappingLogic.tiled_quad_cast,
+                poly_data=self.modelPolyData,
+                seg_bounds=self.segmentationBounds,
+                cast_axis=cast_axis,
+                precision=self.CONFIG_precision,
+                region_of_interest=self.CONFIG_regionOfInterest,
+                dimensions=self.volumeSelector.currentNode().GetImageData().GetDimensions(),
+                mm_of_air_past_bone=self.CONFIG_mmOfAirPastBone,
+                memory_budget_mb=self.CONFIG_tileMemoryMb,
+                engine=self.CONFIG_castEngine,
+                workers=self.CONFIG_thicknessWorkers,
+                bsp_tree=bspTree,
+                cell_locator=cellLocator,
+                metrics=self.runMetrics
+            )
+            self.modelNode = BoneThicknessMappingLogic.build_model(
+                poly_data=self.topLayerPolyData,
+                update_status=lambda text=None, progress=None: None
+            )
+        elif self.CONFIG_progressive:
+            self.modelNode = None
+
+            def show_level(top_layer_poly_data, hit_point_grid, thickness_scalar_array, air_cell_scalar_array):
+                self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray = hit_point_grid, thickness_scalar_array, air_cell_scalar_array
+                BoneThicknessMappingLogic.attach_scalar_arrays(top_layer_poly_data, thickness_scalar_array, air_cell_scalar_array)
+                if self.modelNode is None:
+                    self.topLayerPolyData = top_layer_poly_data
+                    self.modelNode = BoneThicknessMappingLogic.build_model(poly_data=self.topLayerPolyData, update_status=lambda text=None, progress=None: None)
+                else: self.topLayerPolyData.ShallowCopy(top_layer_poly_data)
+                self.click_result_radio()
+                self.update_status(force=True)
+
+            # levels are computed on the worker thread and shown by the main thread
+            channel = BackgroundTask.ProgressChannel()
+            self.run_in_background(
+                BoneThicknessMappingLogic.progressive_quad_cast,
+                channel=channel,
+                poly_data=self.modelPolyData,
+                seg_bounds=self.segmentationBounds,
+                cast_axis=cast_axis,
+                precision=self.CONFIG_precision,
+                region_of_interest=self.CONFIG_regionOfInterest,
+                dimensions=self.volumeSelector.currentNode().GetImageData().GetDimensions(),
+                mm_of_air_past_bone=self.CONFIG_mmOfAirPastBone,
+                on_level=lambda *level: channel.post(show_level, *level),
+                engine=self.CONFIG_castEngine,
+                workers=self.CONFIG_thicknessWorkers,
+                bsp_tree=bspTree,
+                cell_locator=cellLocator,
+                metrics=self.runMetrics
+            )
+        else:
+            self.topLayerPolyData, self.hitPointGrid = self.run_in_background(
+                BoneThicknessMappingLogic.rainfall_quad_cast,
+                poly_data=self.modelPolyData,
+                seg_bounds=self.segmentationBounds,
+                cast_axis=cast_axis,
+                precision=self.CONFIG_precision,
+                region_of_interest=self.CONFIG_regionOfInterest,
+                engine=self.CONFIG_castEngine,
+                bsp_tree=bspTree,
+                metrics=self.runMetrics
+            )
+            self.modelNode = BoneThicknessMappingLogic.build_model(
+                poly_data=self.topLayerPolyData,
+                update_status=self.update_status
+            )
+            self.thicknessScalarArray, self.airCellScalarArray = self.run_in_background(
+                BoneThicknessMappingLogic.ray_cast_color_thickness,
+                poly_data=self.modelPolyData,
+                hit_point_grid=self.hitPointGrid,
+                cast_axis=cast_axis,
+                dimensions=self.volumeSelector.currentNode().GetImageData().GetDimensions(),
+                mm_of_air_past_bone=self.CONFIG_mmOfAirPastBone,
+                workers=self.CONFIG_thicknessWorkers,
+                cell_locator=cellLocator,
+                metrics=self.runMetrics
+            )
+        if segmentedPolyData is not None:
+            self.update_status(text='Measuring thickness change from decimation...', progress=100, force=True)
+            BoneThicknessMappingLogic.decimation_thickness_change(
+                segmentedPolyData, self.hitPointGrid, self.thicknessScalarArray, cast_axis,
+                self.volumeSelector.currentNode().GetImageData().GetDimensions(), self.CONFIG_mmOfAirPastBone, metrics=self.runMetrics
+            )
+        if cache is not None:
+            BoneThicknessMappingLogic.store_cached_result(cache, result_key, self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray)
+
+    def get_result_cache(self):
+        if not self.CONFIG_cacheEnabled: return None
+        directory = os.path.join(slicer.app.temporaryPath, 'BoneThicknessMappingCache')
+        if self.resultCache is None or self.resultCache.directory != directory: self.resultCache = ResultCache(directory, 0)
+        self.resultCache.max_bytes = int(self.CONFIG_cacheSizeMb * 1024 * 1024)
+        return self.resultCache
+
+    def click_cancel(self):
+        if self.progressChannel is None: return
+        self.progressChannel.cancel()
+        self.update_status(text='Cancelling...', force=True)
+
+    def click_fit(self):
+        axis = self.resultAxis if self.resultAxis is not None else next(iter(self.CONFIG_rayCastAxes), ctk.ctkAxesWidget.Left)
+        BoneThicknessMappingLogic.reset_view(axis)
+
+    def show_result(self, axis):
+        if self.results is None or axis not in self.results: return
+        self.resultAxis = axis
+        self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray, self.modelNode = self.results[axis]
+        for a, result in self.results.items(): result[4].GetDisplayNode().SetVisibility(a == axis)
+        # marked sites belong to the previously shown map
+        if self.implantSitesNode is not None: self.implantSitesNode.RemoveAllControlPoints()
+        self.sitesLabel.text = ''
+        self.click_result_radio()
+        BoneThicknessMappingLogic.reset_view(axis)
+
+    def click_export(self):
+        if self.topLayerPolyData is None or self.hitPointGrid is None: return
+        axisName = next(name for name, axis in BoneThicknessMappingBatch.AXES.items() if axis == self.resultAxis)
+        path = qt.QFileDialog.getSaveFileName(None, 'Export thickness map', self.modelNode.GetName() + '.vtp', 'Top layer model (*.vtp)')
+        if not path: return
+        prefix = path[:-len('.vtp')] if path.lower().endswith('.vtp') else path
+        try:
+            BoneThicknessMappingLogic.export_result(prefix, self.topLayerPolyData, self.hitPointGrid, self.thicknessScalarArray, self.airCellScalarArray, axisName)
+        except (IOError, OSError, ValueError) as e:
+            self.update_status(text='Export failed: ' + str(e), force=True)
+            return
+        self.update_status(text='Exported ' + prefix + '.vtp and its rasters', force=True)
+
+    def click_find_sites(self):
+        if self.hitPointGrid is None or self.hitPointGrid.plane is None: return
+        size = self.CONFIG_footprintSizeMm[:1] if self.CONFIG_footprintShape == BoneImplantFootprint.DISC else self.CONFIG_footprintSizeMm
+        sites = BoneThicknessMappingLogic.find_implant_sites(
+            self.hitPointGrid, self.thicknessScalarArray, BoneImplantFootprint.SHAPES[self.CONFIG_footprintShape], size,
+            self.CONFIG_minMaxSkullThickness[1], coverage=self.CONFIG_footprintCoverage / 100.0
+        )
+        self.implantSitesNode = BoneThicknessMappingLogic.mark_implant_sites(sites, self.implantSitesNode)
+        lines = ['%d: min %.1f mm, mean %.1f mm, %.0f%% clear' % (n + 1, site['minimum'], site['mean'], 100 * site['share']) for n, site in enumerate(sites)]
+        self.sitesLabel.text = '\n'.join(lines) if lines else 'No site clears %.1f mm' % self.CONFIG_minMaxSkullThickness[1]
 
     def click_finish(self):
         self.state = BoneThicknessMappingState.WAITING
@@ -560,18 +1152,14 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
 
     def click_result_radio(self):
         if self.thicknessScalarArray is None or self.airCellScalarArray is None: return  # TODO add error message
-        scalar, scalarName, colourNodeId = None, None, None
+        # both arrays are on the top layer already, only the shown one changes
+        scalarName, colourNodeId = None, None
         if self.displayThicknessSelector.isChecked():
-            scalar = self.thicknessScalarArray
             scalarName = BoneThicknessMappingType.THICKNESS
             colourNodeId = self.thicknessColourNode.GetID()
         elif self.displayFirstAirCellSelector.isChecked():
-            scalar = self.airCellScalarArray
             scalarName = BoneThicknessMappingType.AIR_CELL
             colourNodeId = self.airCellColourNode.GetID()
-        # update poly data
-        self.topLayerPolyData.GetPointData().SetScalars(scalar)
-        self.topLayerPolyData.Modified()
         # update display node
         displayNode = self.modelNode.GetDisplayNode()
         displayNode.SetActiveScalarName(scalarName)
@@ -581,13 +1169,22 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         # update scalar bar
         BoneThicknessMappingLogic.set_scalar_colour_bar_state(1, colourNodeId)
         # reset view
-        # BoneThicknessMappingLogic.reset_view(self.CONFIG_rayCastAxis)
+        # BoneThicknessMappingLogic.reset_view(self.resultAxis)
+
+    def update_depth_mapping(self, mapping_type):
+        # re-colour the finished map, the scalar arrays themselves are left as they are
+        if self.state is not BoneThicknessMappingState.FINISHED or self.thicknessColourNode is None or self.airCellColourNode is None: return
+        if mapping_type == BoneThicknessMappingType.THICKNESS:
+            BoneThicknessMappingLogic.fill_thickness_color_table(self.thicknessColourNode, self.CONFIG_minMaxSkullThickness, resolution=self.CONFIG_colourResolutionMm)
+        elif mapping_type == BoneThicknessMappingType.AIR_CELL:
+            BoneThicknessMappingLogic.fill_air_cell_color_table(self.airCellColourNode, self.CONFIG_minMaxAirCell, resolution=self.CONFIG_colourResolutionMm)
+        if self.displayScalarBarCheckbox.checked: self.click_toggle_scalar_bar(2)
 
     def click_toggle_scalar_bar(self, state):
         if state == 0: BoneThicknessMappingLogic.set_scalar_colour_bar_state(0)
         elif state == 2:
-            if self.displayThicknessSelector.isChecked(): BoneThicknessMappingLogic.set_scalar_colour_bar_state(1, self.thicknessColourNode)
-            elif self.displayFirstAirCellSelector.isChecked(): BoneThicknessMappingLogic.set_scalar_colour_bar_state(1, self.airCellColourNode)
+            if self.displayThicknessSelector.isChecked(): BoneThicknessMappingLogic.set_scalar_colour_bar_state(1, self.thicknessColourNode.GetID())
+            elif self.displayFirstAirCellSelector.isChecked(): BoneThicknessMappingLogic.set_scalar_colour_bar_state(1, self.airCellColourNode.GetID())
 
     def release_memory(self):
 
@@ -595,6 +1192,8 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         self.infoLabel = None
         self.volumeSelector = None
         self.configuration_tools = None
+        self.configurationGroups = []
+        self.depthMappingGroup = None
         self.statusLabel = None
         self.executeButton = None
         self.progressBar = None
@@ -603,15 +1202,35 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         self.displayThicknessSelector = None
         self.displayFirstAirCellSelector = None
         self.displayScalarBarCheckbox = None
+        self.resultAxisSelector = None
+        self.exportButton = None
+        self.sitesLabel = None
 
         # Config
         self.CONFIG_precision = None
-        self.CONFIG_rayCastAxis = None
+        self.CONFIG_rayCastAxes = None
         self.CONFIG_segmentThresholdRange = None
+        self.CONFIG_segmentationMethod = None
         self.CONFIG_regionOfInterest = None
+        self.CONFIG_cropToCastingBounds = None
+        self.CONFIG_cropMarginMm = None
         self.CONFIG_minMaxAirCell = None
         self.CONFIG_minMaxSkullThickness = None
+        self.CONFIG_colourResolutionMm = None
         self.CONFIG_mmOfAirPastBone = None
+        self.CONFIG_progressive = None
+        self.CONFIG_sampling = None
+        self.CONFIG_adaptiveTolerance = None
+        self.CONFIG_castEngine = None
+        self.CONFIG_decimationErrorMm = None
+        self.CONFIG_thicknessWorkers = None
+        self.CONFIG_tiled = None
+        self.CONFIG_tileMemoryMb = None
+        self.CONFIG_cacheEnabled = None
+        self.CONFIG_cacheSizeMb = None
+        self.CONFIG_footprintShape = None
+        self.CONFIG_footprintSizeMm = None
+        self.CONFIG_footprintCoverage = None
 
         # Data
         self.thicknessScalarArray, self.airCellScalarArray = None, None
@@ -619,8 +1238,12 @@ class BoneThicknessMappingWidget(ScriptedLoadableModuleWidget):
         self.modelPolyData = None
         self.segmentationBounds = None
         self.topLayerPolyData = None
-        self.hitPointList = None
+        self.hitPointGrid = None
         self.modelNode = None
+        self.results = None
+        self.resultAxis = None
+        self.resultCache = None
+        self.implantSitesNode = None
 
 
 
@@ -653,14 +1276,22 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         v.SetAxisLabelsVisible(False)
 
     @staticmethod
-    def process_segmentation(threshold_range, image, axis, update_status):
+    def process_segmentation(threshold_range, image, axis, update_status, update_views=True, closed_surface=True, method=BoneSegmentationMethod.DIRECT, crop_bounds=None, metrics=RunMetrics.DISABLED):
         # Fix Volume Orientation
-        update_status(text="Rotating views to volume plane...", progress=2)
-        manager = slicer.app.layoutManager()
-        for name in manager.sliceViewNames():
-            widget = manager.sliceWidget(name)
-            node = widget.mrmlSliceNode()
-            node.RotateToVolumePlane(image)
+        if update_views:
+            update_status(text="Rotating views to volume plane...", progress=2)
+            manager = slicer.app.layoutManager()
+            for name in manager.sliceViewNames():
+                widget = manager.sliceWidget(name)
+                node = widget.mrmlSliceNode()
+                node.RotateToVolumePlane(image)
+
+        # Crop, so that segmentation and meshing scale with the casting bounds instead of the whole scan
+        croppedImage = None
+        if crop_bounds is not None:
+            update_status(text="Cropping volume to casting bounds...", progress=4)
+            with metrics.stage('crop'): croppedImage = BoneThicknessMappingLogic.crop_volume(image, crop_bounds, metrics)
+            if croppedImage is not None: image = croppedImage
 
         # Create segmentation
         update_status(text="Creating segmentation...", progress=5)
@@ -670,13 +1301,110 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         segmentId = segmentationNode.GetSegmentation().AddEmptySegment("Bone")
         segmentationNode.GetSegmentation().GetSegment(segmentId).SetColor([0.9, 0.8, 0.7])
 
+        if method == BoneSegmentationMethod.SEGMENT_EDITOR: BoneThicknessMappingLogic.apply_segment_editor_effects(segmentationNode, image, threshold_range, update_status, metrics)
+        else: BoneThicknessMappingLogic.apply_image_filters(segmentationNode, segmentId, image, threshold_range, update_status, metrics)
+
+        # The labelmap engine works on the voxels directly and never needs a surface mesh
+        if not closed_surface:
+            update_status(text="Retrieving binary labelmap...", progress=15)
+            with metrics.stage('labelmap_extraction'):
+                matrix = vtk.vtkMatrix4x4()
+                image.GetIJKToRASMatrix(matrix)
+                labelmap = LabelmapThickness.BinaryLabelmap(slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentId, image), slicer.util.arrayFromVTKMatrix(matrix))
+            if croppedImage is not None: slicer.mrmlScene.RemoveNode(croppedImage)
+            if update_views: BoneThicknessMappingLogic.reset_view(axis)
+            return labelmap, labelmap.bounds()
+
+        # Make segmentation results visible in 3D and set focal
+        if croppedImage is not None: slicer.mrmlScene.RemoveNode(croppedImage)
+        update_status(text="Rendering...", progress=15)
+        with metrics.stage('surface_extraction'): segmentationNode.CreateClosedSurfaceRepresentation()
+        if update_views: BoneThicknessMappingLogic.reset_view(axis)
+
+        # Retrieve segmentation bounds
+        bounds = [0, 0, 0, 0, 0, 0]
+        segmentationNode.GetBounds(bounds)
+
+        # Make sure surface mesh cells are consistently oriented
+        update_status(text="Retrieving surface mesh...", progress=18)
+        if slicer.app.majorVersion == 4 and slicer.app.minorVersion <= 10:
+            polyData = segmentationNode.GetClosedSurfaceRepresentation(segmentId)
+        else:
+            polyData = vtk.vtkPolyData()
+            segmentationNode.GetClosedSurfaceRepresentation(segmentId, polyData)
+
+        return polyData, bounds
+
+    @staticmethod
+    def crop_bounds(image, cast_axes, region_of_interest, margin=20.0, cast_plane_box=None):
+        # RAS bounds of the volume that can reach the maps of all cast axes: for each, the region of interest along the
+        # axis and optionally a [horizontal min, max, vertical min, max] box on its cast plane, grown by margin for
+        # thickness rays at an angle
+        volumeBounds = [0.0] * 6
+        image.GetRASBounds(volumeBounds)
+        union = None
+        for castAxis in cast_axes:
+            bounds = list(volumeBounds)
+            castIndex = BoneThicknessMappingLogic.determine_cast_axis_index(castAxis)
+            ranges = {castIndex: region_of_interest}
+            if cast_plane_box is not None:
+                planeIndices = [i for i in range(3) if i != castIndex]
+                ranges[planeIndices[0]], ranges[planeIndices[1]] = cast_plane_box[0:2], cast_plane_box[2:4]
+            for axis, (low, high) in ranges.items():
+                bounds[axis*2] = max(bounds[axis*2], low - margin)
+                bounds[axis*2+1] = min(bounds[axis*2+1], high + margin)
+            union = bounds if union is None else [min(u, b) if i % 2 == 0 else max(u, b) for i, (u, b) in enumerate(zip(union, bounds))]
+        return union
+
+    @staticmethod
+    def bounds_empty(bounds):
+        return any(bounds[axis*2] > bounds[axis*2+1] for axis in range(3))
+
+    @staticmethod
+    def crop_extent(image, bounds):
+        # voxel extent of image within RAS bounds, the voxels that cropping to them keeps
+        rasToIjk = vtk.vtkMatrix4x4()
+        image.GetRASToIJKMatrix(rasToIjk)
+        corners = numpy.array([[x, y, z, 1.0] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]]) @ slicer.util.arrayFromVTKMatrix(rasToIjk).T
+        extent, voi = image.GetImageData().GetExtent(), []
+        for axis in range(3):
+            voi += [max(extent[axis*2], int(numpy.floor(corners[:, axis].min()))), min(extent[axis*2+1], int(numpy.ceil(corners[:, axis].max())))]
+        if voi[0] > voi[1] or voi[2] > voi[3] or voi[4] > voi[5]: raise ValueError('Casting bounds do not overlap the volume')
+        return voi
+
+    @staticmethod
+    def crop_volume(image, bounds, metrics=RunMetrics.DISABLED):
+        # temporary volume node with the voxels of image within RAS bounds, None if that is the whole volume
+        extent, voi = image.GetImageData().GetExtent(), BoneThicknessMappingLogic.crop_extent(image, bounds)
+        metrics.count('volume_voxels', int(numpy.prod([extent[a*2+1] - extent[a*2] + 1 for a in range(3)])))
+        metrics.count('segmented_voxels', int(numpy.prod([voi[a*2+1] - voi[a*2] + 1 for a in range(3)])))
+        if voi == list(extent): return None
+        extract = vtk.vtkExtractVOI()
+        extract.SetInputData(image.GetImageData())
+        extract.SetVOI(*voi)
+        # volume nodes expect extents starting at zero, the offset moves into the IJK to RAS matrix
+        shift = vtk.vtkImageChangeInformation()
+        shift.SetInputConnection(extract.GetOutputPort())
+        shift.SetOutputExtentStart(0, 0, 0)
+        shift.Update()
+        ijkToRas = vtk.vtkMatrix4x4()
+        image.GetIJKToRASMatrix(ijkToRas)
+        start = ijkToRas.MultiplyPoint([voi[0], voi[2], voi[4], 1.0])
+        for row in range(3): ijkToRas.SetElement(row, 3, start[row])
+        croppedImage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', image.GetName() + ' (cropped)')
+        croppedImage.SetAndObserveImageData(shift.GetOutput())
+        croppedImage.SetIJKToRASMatrix(ijkToRas)
+        return croppedImage
+
+    @staticmethod
+    def apply_segment_editor_effects(segmentation_node, image, threshold_range, update_status, metrics=RunMetrics.DISABLED):
         # Create segment editor to get access to effects
         update_status(text="Starting segmentation editor...", progress=6)
         segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
         segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
         segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
         segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segmentationNode)
+        segmentEditorWidget.setSegmentationNode(segmentation_node)
         segmentEditorWidget.setMasterVolumeNode(image)
 
         # Threshold
@@ -685,7 +1413,7 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         effect = segmentEditorWidget.activeEffect()
         effect.setParameter("MinimumThreshold", str(threshold_range[0]))  # 1460 #1160 # 223
         effect.setParameter("MaximumThreshold", str(threshold_range[1]))
-        effect.self().onApply()
+        with metrics.stage('segmentation_threshold'): effect.self().onApply()
 
         # Smoothing
         update_status(text="Processing smoothing segmentation...", progress=10)
@@ -693,7 +1421,7 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         effect = segmentEditorWidget.activeEffect()
         effect.setParameter("SmoothingMethod", "MORPHOLOGICAL_OPENING")
         effect.setParameter("KernelSizeMm", 0.5)
-        effect.self().onApply()
+        with metrics.stage('segmentation_smoothing'): effect.self().onApply()
 
         # Islands
         update_status(text="Processing island segmentation...", progress=11)
@@ -701,7 +1429,7 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         effect = segmentEditorWidget.activeEffect()
         effect.setParameter("Operation", "KEEP_LARGEST_ISLAND")
         effect.setParameter("MinimumSize", 1000)
-        effect.self().onApply()
+        with metrics.stage('segmentation_islands'): effect.self().onApply()
 
         # Crop
         # update_status("Cropping segmentation...")
@@ -716,24 +1444,58 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         segmentEditorWidget.setActiveEffectByName(None)
         slicer.mrmlScene.RemoveNode(segmentEditorNode)
 
-        # Make segmentation results visible in 3D and set focal
-        update_status(text="Rendering...", progress=15)
-        segmentationNode.CreateClosedSurfaceRepresentation()
-        BoneThicknessMappingLogic.reset_view(axis)
-
-        # Retrieve segmentation bounds
-        bounds = [0, 0, 0, 0, 0, 0]
-        segmentationNode.GetBounds(bounds)
-
-        # Make sure surface mesh cells are consistently oriented
-        update_status(text="Retrieving surface mesh...", progress=18)
-        if slicer.app.majorVersion == 4 and slicer.app.minorVersion <= 10:
-            polyData = segmentationNode.GetClosedSurfaceRepresentation(segmentId)
-        else:
-            polyData = vtk.vtkPolyData()
-            segmentationNode.GetClosedSurfaceRepresentation(segmentId, polyData)
-
-        return polyData, bounds
+    @staticmethod
+    def apply_image_filters(segmentation_node, segment_id, image, threshold_range, update_status, metrics=RunMetrics.DISABLED, kernel_size_mm=0.5, minimum_island_size=1000):
+        # same steps as the Threshold, Smoothing (morphological opening) and Islands (keep largest) effects, straight on
+        # the image data with multithreaded VTK filters and without starting a segment editor
+        update_status(text="Processing threshold segmentation...", progress=8)
+        with metrics.stage('segmentation_threshold'):
+            threshold = vtk.vtkImageThreshold()
+            threshold.SetInputData(image.GetImageData())
+            threshold.ThresholdBetween(threshold_range[0], threshold_range[1])
+            threshold.SetInValue(1)
+            threshold.SetOutValue(0)
+            threshold.SetOutputScalarTypeToUnsignedChar()
+            threshold.Update()
+            labelmap = threshold.GetOutput()
+
+        # kernel size rounded to the nearest odd number of voxels, as the smoothing effect does
+        update_status(text="Processing smoothing segmentation...", progress=10)
+        with metrics.stage('segmentation_smoothing'):
+            opening = vtk.vtkImageOpenClose3D()
+            opening.SetInputData(labelmap)
+            opening.SetOpenValue(1)
+            opening.SetCloseValue(0)
+            opening.SetKernelSize(*[int(round((kernel_size_mm / spacing + 1) / 2) * 2 - 1) for spacing in image.GetSpacing()])
+            opening.Update()
+            labelmap = opening.GetOutput()
+
+        # island labels are sorted by size, the largest is 1
+        update_status(text="Processing island segmentation...", progress=11)
+        with metrics.stage('segmentation_islands'):
+            cast = vtk.vtkImageCast()
+            cast.SetInputData(labelmap)
+            cast.SetOutputScalarTypeToUnsignedInt()
+            islands = vtkITK.vtkITKIslandMath()
+            islands.SetInputConnection(cast.GetOutputPort())
+            islands.SetFullyConnected(False)
+            islands.SetMinimumSize(minimum_island_size)
+            largest = vtk.vtkImageThreshold()
+            largest.SetInputConnection(islands.GetOutputPort())
+            largest.ThresholdBetween(1, 1)
+            largest.SetInValue(1)
+            largest.SetOutValue(0)
+            largest.SetOutputScalarTypeToUnsignedChar()
+            largest.Update()
+            labelmap = largest.GetOutput()
+
+        update_status(text="Storing bone segment...", progress=13)
+        segment = slicer.vtkOrientedImageData()
+        segment.ShallowCopy(labelmap)
+        ijkToRas = vtk.vtkMatrix4x4()
+        image.GetIJKToRASMatrix(ijkToRas)
+        segment.SetImageToWorldMatrix(ijkToRas)
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(segment, segmentation_node, segment_id)
 
     @staticmethod
     def determine_cast_axis_index(cast_axis):
@@ -744,82 +1506,557 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         return castIndex
 
     @staticmethod
-    def rainfall_quad_cast(poly_data, seg_bounds, cast_axis, precision, region_of_interest, update_status):
+    def poly_data_triangles(poly_data):
+        triangleFilter = vtk.vtkTriangleFilter()
+        triangleFilter.SetInputData(poly_data)
+        triangleFilter.PassVertsOff()
+        triangleFilter.PassLinesOff()
+        triangleFilter.Update()
+        triangles = triangleFilter.GetOutput()
+        legacy = vtk.vtkIdTypeArray()
+        if hasattr(triangles.GetPolys(), 'ExportLegacyFormat'): triangles.GetPolys().ExportLegacyFormat(legacy)
+        else: legacy.DeepCopy(triangles.GetPolys().GetData())
+        points = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData()).astype(numpy.float64)
+        return points, numpy_support.vtk_to_numpy(legacy).reshape(-1, 4)[:, 1:]
+
+    @staticmethod
+    def build_bsp_tree(poly_data, metrics=RunMetrics.DISABLED):
+        with metrics.stage('bsp_build'):
+            bspTree = vtk.vtkModifiedBSPTree()
+            bspTree.SetDataSet(poly_data)
+            bspTree.BuildLocator()
+        return bspTree
+
+    @staticmethod
+    def decimate_surface(poly_data, max_error_mm, metrics=RunMetrics.DISABLED):
+        # removes vertices for as long as the surface stays within max_error_mm of the original, keeping its topology
+        # and boundary so the mesh stays closed for the thickness rays
+        with metrics.stage('decimation'):
+            decimate = vtk.vtkDecimatePro()
+            decimate.SetInputData(poly_data)
+            decimate.SetTargetReduction(0.99)
+            decimate.PreserveTopologyOn()
+            decimate.SplittingOff()
+            decimate.BoundaryVertexDeletionOff()
+            decimate.AccumulateErrorOn()
+            decimate.SetErrorIsAbsolute(1)
+            decimate.SetAbsoluteError(max_error_mm)
+            decimate.Update()
+            decimatedPolyData = vtk.vtkPolyData()
+            decimatedPolyData.ShallowCopy(decimate.GetOutput())
+        metrics.set('triangles_segmented', poly_data.GetNumberOfCells())
+        metrics.set('triangles_decimated', decimatedPolyData.GetNumberOfCells())
+        return decimatedPolyData
+
+    @staticmethod
+    def decimation_thickness_change(segmented_poly_data, hit_point_grid, thickness_scalar_array, cast_axis, dimensions, mm_of_air_past_bone, sample=1000, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        # thickness of a random sample of the map's rays against the undecimated surface, compared to the map, in mm
+        measured = numpy.flatnonzero(numpy.linalg.norm(hit_point_grid.normals, axis=1) > 0)
+        if len(measured) == 0: return None
+        pids = numpy.random.default_rng(0).choice(measured, min(sample, len(measured)), replace=False)
+        with metrics.stage('decimation_check'):
+            stretchFactor = dimensions[BoneThicknessMappingLogic.determine_cast_axis_index(cast_axis)]
+            thickness, airCellDistance = ThicknessCalculation.calculate_thickness(
+                segmented_poly_data, ThicknessCalculation.build_cell_locator(segmented_poly_data), hit_point_grid.points[pids], hit_point_grid.normals[pids],
+                stretchFactor, mm_of_air_past_bone, gradient_scale_factor
+            )
+            change = numpy.abs(numpy_support.vtk_to_numpy(thickness_scalar_array)[pids] - thickness) / gradient_scale_factor
+        metrics.set('decimation_check_rays', len(pids))
+        # rays grazing an edge of the bone can jump to another surface, the percentile shows the change elsewhere
+        change = {'mean': float(change.mean()), 'p95': float(numpy.percentile(change, 95)), 'max': float(change.max())}
+        for name, value in change.items(): metrics.set('decimation_thickness_change_' + name + '_mm', value)
+        return change
+
+    @staticmethod
+    def bsp_first_hits(bsp_tree, cast_plane, rows, columns, update_status=None):
+        hits, temporaryHitPoint = numpy.full((len(rows), 3), numpy.nan), [0.0, 0.0, 0.0]
+        for n, (i, j) in enumerate(zip(rows.tolist(), columns.tolist())):
+            if update_status is not None and n % 10000 == 0: update_status(text=f"Casting rays (~{n} of {len(rows)} rays)", progress=44 + int(round(n*20.0/len(rows))))
+            start, end = cast_plane.ray(i, j)
+            if bsp_tree.IntersectWithLine(start, end, 0, vtk.reference(0), temporaryHitPoint, [0.0, 0.0, 0.0], vtk.reference(0), vtk.reference(0)) != 0:
+                hits[n] = temporaryHitPoint
+        return hits
+
+    @staticmethod
+    def bsp_first_hit_grid(poly_data, cast_plane, update_status, bsp_tree=None, known_hits=None, known_mask=None):
         update_status(text="Building intersection object tree...", progress=41)
-        bspTree = vtk.vtkModifiedBSPTree()
-        bspTree.SetDataSet(poly_data)
-        bspTree.BuildLocator()
+        bspTree = bsp_tree if bsp_tree is not None else BoneThicknessMappingLogic.build_bsp_tree(poly_data)
 
-        update_status(text="Calculating segmentation dimensions...", progress=42)
-        negated = 1 if cast_axis in [ctk.ctkAxesWidget.Right, ctk.ctkAxesWidget.Anterior, ctk.ctkAxesWidget.Superior] else -1
-        castIndex = BoneThicknessMappingLogic.determine_cast_axis_index(cast_axis)
-        castVector = [0.0, 0.0, 0.0]
-        castVector[castIndex] = 1.0 * negated
-        castPlaneIndices = [0, 1, 2]
-        castPlaneIndices.remove(castIndex)
+        # rays already cast at a coarser level keep their hits (or misses)
+        hitGrid = numpy.full(cast_plane.shape + (3,), numpy.nan)
+        if known_mask is not None: hitGrid[known_mask] = known_hits[known_mask]
+        rows, columns = numpy.nonzero(numpy.ones(cast_plane.shape, dtype=bool) if known_mask is None else ~known_mask)
+        update_status(text="Casting " + str(len(rows)) + " rays...", progress=44)
+        hitGrid[rows, columns] = BoneThicknessMappingLogic.bsp_first_hits(bspTree, cast_plane, rows, columns, update_status=update_status)
+        return hitGrid
 
-        update_status(text="Calculating segmentation cast-plane...", progress=43)
-        depthIncrements = [seg_bounds[castIndex], seg_bounds[castIndex+1]]
-        if cast_axis in [ctk.ctkAxesWidget.Right, ctk.ctkAxesWidget.Posterior, ctk.ctkAxesWidget.Superior]: depthIncrements.reverse()
-        horizontalIncrements = [seg_bounds[castPlaneIndices[0]*2], seg_bounds[castPlaneIndices[0]*2+1]]
-        verticalIncrements = [seg_bounds[castPlaneIndices[1]*2],  seg_bounds[castPlaneIndices[1]*2+1]]
-        castPlaneIncrements = [
-            int(abs(horizontalIncrements[0] - horizontalIncrements[1])/precision),
-            int(abs(verticalIncrements[0] - verticalIncrements[1])/precision),
-        ]
+    @staticmethod
+    def z_buffer_first_hit_grid(poly_data, cast_plane, update_status, max_candidates=2**22, tolerance=1e-7, mesh=None):
+        # mesh is (points, triangles) of poly_data when it has already been triangulated, possibly only the triangles
+        # that can reach the plane
+        update_status(text="Projecting surface onto cast-plane...", progress=41)
+        points, triangles = mesh if mesh is not None else BoneThicknessMappingLogic.poly_data_triangles(poly_data)
+        hIndex, vIndex = cast_plane.plane_indices
+        # vertex positions in grid units, rays sit on integer coordinates
+        u = (points[triangles, hIndex] - cast_plane.origin[0]) / cast_plane.precision
+        v = (points[triangles, vIndex] - cast_plane.origin[1]) / cast_plane.precision
+        depth = points[triangles, cast_plane.cast_index]
+        denominator = (v[:, 1] - v[:, 2])*(u[:, 0] - u[:, 2]) + (u[:, 2] - u[:, 1])*(v[:, 0] - v[:, 2])
+        # rays on the plane's edges that graze the surface hit it here, where the BSP tree can pass over to a deeper crossing
+        iMin = numpy.maximum(numpy.ceil(u.min(axis=1) - tolerance), 0).astype(numpy.int64)
+        iMax = numpy.minimum(numpy.floor(u.max(axis=1) + tolerance), cast_plane.shape[0] - 1).astype(numpy.int64)
+        jMin = numpy.maximum(numpy.ceil(v.min(axis=1) - tolerance), 0).astype(numpy.int64)
+        jMax = numpy.minimum(numpy.floor(v.max(axis=1) + tolerance), cast_plane.shape[1] - 1).astype(numpy.int64)
+        widths = numpy.maximum(jMax - jMin + 1, 0)
+        counts = numpy.maximum(iMax - iMin + 1, 0) * widths
+        # triangles seen edge-on from the cast direction can't be hit by a ray
+        counts[numpy.abs(denominator) < 1e-12] = 0
+        visible = numpy.nonzero(counts)[0]
+
+        # depth buffer holds depth signed by travel direction, so the first hit is the minimum
+        direction = 1.0 if cast_plane.depth_range[1] >= cast_plane.depth_range[0] else -1.0
+        depthBuffer = numpy.full(cast_plane.shape, numpy.inf)
+        nearest, farthest = sorted([direction*cast_plane.depth_range[0], direction*cast_plane.depth_range[1]])
+        update_status(text="Rasterizing " + str(len(visible)) + " triangles onto " + str(int(cast_plane.shape[0]*cast_plane.shape[1])) + " rays...", progress=44)
+        chunks = numpy.cumsum(counts[visible]) // max_candidates
+        rasterized = 0
+        for chunk in numpy.split(visible, numpy.nonzero(numpy.diff(chunks))[0] + 1):
+            if len(chunk) == 0: continue
+            # once per chunk, which is where a cancel takes effect
+            update_status(text=f"Rasterizing triangles (~{rasterized} of {len(visible)} triangles)", progress=44 + int(round(rasterized*20.0/len(visible))))
+            rasterized += len(chunk)
+            ids = numpy.repeat(chunk, counts[chunk])
+            local = numpy.arange(len(ids)) - numpy.repeat(numpy.cumsum(counts[chunk]) - counts[chunk], counts[chunk])
+            ci, cj = iMin[ids] + local // widths[ids], jMin[ids] + local % widths[ids]
+            tu, tv, d = u[ids], v[ids], denominator[ids]
+            l0 = ((tv[:, 1] - tv[:, 2])*(ci - tu[:, 2]) + (tu[:, 2] - tu[:, 1])*(cj - tv[:, 2])) / d
+            l1 = ((tv[:, 2] - tv[:, 0])*(ci - tu[:, 2]) + (tu[:, 0] - tu[:, 2])*(cj - tv[:, 2])) / d
+            l2 = 1.0 - l0 - l1
+            hitDepth = direction * (l0*depth[ids, 0] + l1*depth[ids, 1] + l2*depth[ids, 2])
+            inside = (l0 >= -tolerance) & (l1 >= -tolerance) & (l2 >= -tolerance) & (nearest <= hitDepth) & (hitDepth <= farthest)
+            numpy.minimum.at(depthBuffer, (ci[inside], cj[inside]), hitDepth[inside])
+
+        hitGrid = numpy.full(cast_plane.shape + (3,), numpy.nan)
+        hit = numpy.isfinite(depthBuffer)
+        hitI, hitJ = numpy.nonzero(hit)
+        hitGrid[hit, hIndex] = cast_plane.origin[0] + hitI*cast_plane.precision
+        hitGrid[hit, vIndex] = cast_plane.origin[1] + hitJ*cast_plane.precision
+        hitGrid[hit, cast_plane.cast_index] = direction * depthBuffer[hit]
+        return hitGrid
 
-        def build_ray(i, j):
-            p1 = [None, None, None]
-            p1[castIndex] = depthIncrements[0] + negated*100
-            p1[castPlaneIndices[0]] = horizontalIncrements[0] + i*precision
-            p1[castPlaneIndices[1]] = verticalIncrements[0] + j*precision
-            p2 = p1[:]
-            p2[castIndex] = depthIncrements[1] - negated*100
-            return p1, p2
+    @staticmethod
+    def build_cell_array(connectivity):
+        # connectivity is (cells, points per cell), padded with -1 for cells with fewer points,
+        # converted to the legacy [n, id0, id1, ...] layout in one go
+        present = numpy.concatenate([numpy.ones((connectivity.shape[0], 1), dtype=bool), connectivity >= 0], axis=1)
+        legacy = numpy.concatenate([present[:, 1:].sum(axis=1)[:, None], connectivity], axis=1)
+        legacy = legacy[present].astype(numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE])
+        cells = vtk.vtkCellArray()
+        cells.SetCells(connectivity.shape[0], numpy_support.numpy_to_vtkIdTypeArray(legacy, deep=True))
+        return cells
 
-        # cast rays
-        update_status(text="Casting " + str(int(castPlaneIncrements[0]*castPlaneIncrements[1])) + " rays...", progress=44)
-        startTime = time.time()
-        points, temporaryHitPoint = vtk.vtkPoints(), [0.0, 0.0, 0.0]
-        hitPointMatrix = [[None for j in range(castPlaneIncrements[1])] for i in range(castPlaneIncrements[0])]
-        for i in range(len(hitPointMatrix)):
-            for j in range(len(hitPointMatrix[i])):
-                start, end = build_ray(i, j)
-                res = bspTree.IntersectWithLine(start, end, 0, vtk.reference(0), temporaryHitPoint, [0.0, 0.0, 0.0], vtk.reference(0), vtk.reference(0))
-                # if hit is found, and the top hitpoint is within ROI bounds
-                if res != 0 and region_of_interest[0] <= temporaryHitPoint[castIndex] < region_of_interest[1]:
-                    temporaryHitPoint[castIndex] += 0.3 * negated  # raised to improve visibility
-                    hitPointMatrix[i][j] = HitPoint(points.InsertNextPoint(temporaryHitPoint), temporaryHitPoint[:])
+    @staticmethod
+    def quad_normals(p0, p1, p2):
+        # the solution of [p0; p1; p2] * n = [1, 1, 1], normalized; solved like the per-quad solve it replaces, as the
+        # closed form cross(p1 - p0, p2 - p0) / det rounds differently and moves thickness rays grazing an edge.
+        # Quads whose plane passes through the origin have no solution and get a zero normal.
+        matrices = numpy.stack([p0, p1, p2], axis=1).astype(numpy.float64)
+        try: rawNormals = numpy.linalg.solve(matrices, numpy.ones((len(matrices), 3, 1)))[:, :, 0]
+        except numpy.linalg.LinAlgError:
+            rawNormals, solvable = numpy.zeros((len(matrices), 3)), numpy.linalg.det(matrices) != 0
+            rawNormals[solvable] = numpy.linalg.solve(matrices[solvable], numpy.ones((numpy.count_nonzero(solvable), 3, 1)))[:, :, 0]
+        lengths = numpy.sqrt(numpy.sum(rawNormals**2, axis=1))
+        return numpy.divide(rawNormals, lengths[:, None], out=numpy.zeros_like(rawNormals), where=lengths[:, None] > 0)
+
+    @staticmethod
+    def form_quads(hit_point_grid, precision, metrics=RunMetrics.DISABLED):
+        return BoneThicknessMappingLogic.build_cell_array(BoneThicknessMappingLogic.quad_connectivity(hit_point_grid, precision, metrics))
+
+    @staticmethod
+    def quad_connectivity(hit_point_grid, precision, metrics=RunMetrics.DISABLED):
+        # every grid cell is a candidate quad, in the same row-major order as the cast
+        pidGrid = hit_point_grid.pid_grid
+        quads = numpy.stack([pidGrid[:-1, :-1], pidGrid[1:, :-1], pidGrid[1:, 1:], pidGrid[:-1, 1:]], axis=-1).reshape(-1, 4)
+        # check if full quad
+        quads = quads[(quads >= 0).all(axis=1)]
+        # check if area is not extremely large
+        quadPoints = hit_point_grid.points[quads]
+        accepted = (numpy.linalg.norm(quadPoints[:, 1:] - quadPoints[:, :1], axis=2) <= precision*6).all(axis=1)
+        metrics.count('quads_rejected_edge_test', int(len(accepted) - numpy.count_nonzero(accepted)))
+        quads, quadPoints = quads[accepted], quadPoints[accepted]
+        metrics.count('quads', len(quads))
+        # calculate normals
+        hit_point_grid.normals[quads[:, 0]] = BoneThicknessMappingLogic.quad_normals(quadPoints[:, 0], quadPoints[:, 1], quadPoints[:, 2])
+        return quads
+
+    @staticmethod
+    def labelmap_first_hit_grid(labelmap, cast_plane, update_status, known_hits=None, known_mask=None):
+        hitGrid = numpy.full(cast_plane.shape + (3,), numpy.nan)
+        if known_mask is not None: hitGrid[known_mask] = known_hits[known_mask]
+        rows, columns = numpy.nonzero(numpy.ones(cast_plane.shape, dtype=bool) if known_mask is None else ~known_mask)
+        update_status(text="Marching " + str(len(rows)) + " rays through the labelmap...", progress=44)
+        starts = numpy.zeros((len(rows), 3))
+        starts[:, cast_plane.cast_index] = cast_plane.depth_range[0]
+        starts[:, cast_plane.plane_indices[0]] = cast_plane.origin[0] + rows * cast_plane.precision
+        starts[:, cast_plane.plane_indices[1]] = cast_plane.origin[1] + columns * cast_plane.precision
+        direction = numpy.zeros(3)
+        direction[cast_plane.cast_index] = numpy.sign(cast_plane.depth_range[1] - cast_plane.depth_range[0])
+        directions = numpy.broadcast_to(direction, starts.shape)
+        depths = LabelmapThickness.first_crossings(
+            labelmap, starts, directions, abs(cast_plane.depth_range[1] - cast_plane.depth_range[0]),
+            on_progress=lambda done, count: update_status(text=f"Casting rays (~{done} of {count} rays)", progress=44 + int(round(done*20.0/count)))
+        )
+        hitGrid[rows, columns] = starts + depths[:, None] * directions
+        return hitGrid
+
+    @staticmethod
+    def first_hit_grid(poly_data, cast_plane, update_status, engine=BoneThicknessMappingCastEngine.BSP_TREE, bsp_tree=None, known_hits=None, known_mask=None, max_candidates=2**22, mesh=None,
+                       metrics=RunMetrics.DISABLED):
+        # with the labelmap engine poly_data is the BinaryLabelmap of the segment, mesh is only used by the z-buffer
+        if engine == BoneThicknessMappingCastEngine.BSP_TREE and bsp_tree is None:
+            update_status(text="Building intersection object tree...", progress=41)
+            bsp_tree = BoneThicknessMappingLogic.build_bsp_tree(poly_data, metrics)
+        with metrics.stage('first_hit_cast'):
+            if engine == BoneThicknessMappingCastEngine.LABELMAP: hitGrid = BoneThicknessMappingLogic.labelmap_first_hit_grid(poly_data, cast_plane, update_status, known_hits=known_hits, known_mask=known_mask)
+            elif engine == BoneThicknessMappingCastEngine.Z_BUFFER: hitGrid = BoneThicknessMappingLogic.z_buffer_first_hit_grid(poly_data, cast_plane, update_status, max_candidates=max_candidates, mesh=mesh)
+            else: hitGrid = BoneThicknessMappingLogic.bsp_first_hit_grid(poly_data, cast_plane, update_status, bsp_tree=bsp_tree, known_hits=known_hits, known_mask=known_mask)
+        metrics.count('first_hit_rays', int(hitGrid.shape[0] * hitGrid.shape[1] - (numpy.count_nonzero(known_mask) if known_mask is not None else 0)))
+        metrics.count('first_hits', int(numpy.count_nonzero(~numpy.isnan(hitGrid[:, :, 0]))))
+        return hitGrid
+
+    @staticmethod
+    def build_top_layer(hit_grid, cast_plane, region_of_interest, update_status, metrics=RunMetrics.DISABLED):
+        castIndex = cast_plane.cast_index
+        # keep hits where the top hitpoint is within ROI bounds
+        with numpy.errstate(invalid='ignore'):
+            inRegion = (region_of_interest[0] <= hit_grid[:, :, castIndex]) & (hit_grid[:, :, castIndex] < region_of_interest[1])
+        pidGrid = numpy.full(cast_plane.shape, -1, dtype=numpy.int32)
+        pidGrid[inRegion] = numpy.arange(numpy.count_nonzero(inRegion), dtype=numpy.int32)
+        points = hit_grid[inRegion]
+        points[:, castIndex] += 0.3 * cast_plane.negated  # raised to improve visibility
+        hitPoints = HitPointGrid(pidGrid, points)
+        hitPoints.set_plane(cast_plane)
+        del points
 
         # form quads/cells
         update_status(text="Forming top layer polygons", progress=64)
-        cells = vtk.vtkCellArray()
-        for i in range(len(hitPointMatrix)-1):  # -1 as the end row/col will be taken into account
-            for j in range(len(hitPointMatrix[i])-1):
-                hitPoints = [hitPointMatrix[i][j], hitPointMatrix[i+1][j], hitPointMatrix[i+1][j+1], hitPointMatrix[i][j+1]]
-                # check if full quad
-                if None in hitPoints: continue
-                # check if area is not extremely large
-                d1 = numpy.linalg.norm(numpy.array(hitPoints[0].point)-numpy.array(hitPoints[1].point))
-                d2 = numpy.linalg.norm(numpy.array(hitPoints[0].point)-numpy.array(hitPoints[2].point))
-                d3 = numpy.linalg.norm(numpy.array(hitPoints[0].point)-numpy.array(hitPoints[3].point))
-                m = precision*6
-                if d1 > m or d2 > m or d3 > m: continue
-                # calculate normals
-                rawNormal = numpy.linalg.solve(numpy.array([hitPoints[0].point, hitPoints[1].point, hitPoints[2].point]), [1, 1, 1])
-                hitPointMatrix[i][j].normal = rawNormal / numpy.sqrt(numpy.sum(rawNormal**2))
-                # # check if quad is acceptable by normal vs. cast vector
-                # v1, v2 = numpy.array(hitPointMatrix[i][j].normal), numpy.array(castVector)
-                # degrees = numpy.degrees(numpy.math.atan2(numpy.cross(v1, v2).shape[0], numpy.dot(v1, v2)))
-                cells.InsertNextCell(4, [p.pid for p in hitPoints])
-        update_status(text="Finished ray-casting in " + str("%.1f" % (time.time() - startTime)) + "s, found " + str(cells.GetNumberOfCells()) + " cells...", progress=80)
+        with metrics.stage('quad_formation'): cells = BoneThicknessMappingLogic.form_quads(hitPoints, cast_plane.precision, metrics)
 
         # build poly data
         topLayerPolyData = vtk.vtkPolyData()
-        topLayerPolyData.SetPoints(points)
+        topLayerPolyData.SetPoints(hitPoints.vtk_points)
+        topLayerPolyData.SetPolys(cells)
+        topLayerPolyData.Modified()
+        return topLayerPolyData, hitPoints
+
+    @staticmethod
+    def rainfall_quad_cast(poly_data, seg_bounds, cast_axis, precision, region_of_interest, update_status, engine=BoneThicknessMappingCastEngine.BSP_TREE, bsp_tree=None, metrics=RunMetrics.DISABLED):
+        update_status(text="Calculating segmentation cast-plane...", progress=43)
+        castPlane = CastPlane(seg_bounds, cast_axis, precision)
+
+        # cast rays
+        startTime = time.time()
+        hitGrid = BoneThicknessMappingLogic.first_hit_grid(poly_data, castPlane, update_status, engine=engine, bsp_tree=bsp_tree, metrics=metrics)
+        topLayerPolyData, hitPoints = BoneThicknessMappingLogic.build_top_layer(hitGrid, castPlane, region_of_interest, update_status, metrics)
+        update_status(text="Finished ray-casting in " + str("%.1f" % (time.time() - startTime)) + "s, found " + str(topLayerPolyData.GetNumberOfCells()) + " cells...", progress=80)
+        return topLayerPolyData, hitPoints
+
+    @staticmethod
+    def progressive_quad_cast(poly_data, seg_bounds, cast_axis, precision, region_of_interest, dimensions, mm_of_air_past_bone, update_status, on_level,
+                              engine=BoneThicknessMappingCastEngine.BSP_TREE, workers=1, bsp_tree=None, cell_locator=None, metrics=RunMetrics.DISABLED):
+        # every quality level from VERY LOW down to the requested precision, coarsest first
+        levels = sorted(set([p for p in BoneThicknessMappingQuality.PRECISION.values() if p > precision] + [precision]), reverse=True)
+        weights = numpy.cumsum([0.0] + [1.0/p**2 for p in levels])
+        weights = weights / weights[-1]
+        if engine == BoneThicknessMappingCastEngine.BSP_TREE and bsp_tree is None: bsp_tree = BoneThicknessMappingLogic.build_bsp_tree(poly_data, metrics)
+        if engine != BoneThicknessMappingCastEngine.LABELMAP and workers <= 1 and cell_locator is None:
+            with metrics.stage('locator_build'): cell_locator = ThicknessCalculation.build_cell_locator(poly_data)
+
+        previousHits, previousPlane, result = None, None, None
+        for level, levelPrecision in enumerate(levels):
+            def level_status(text=None, progress=None):
+                # squeeze each level's 41-100 progress into its share of the whole run
+                if progress is not None: progress = 41 + int(59 * (weights[level] + (weights[level+1] - weights[level]) * max(0, progress - 41) / 59.0))
+                update_status(text="[" + str(level + 1) + "/" + str(len(levels)) + "] " + text if text is not None else None, progress=progress)
+
+            castPlane = CastPlane(seg_bounds, cast_axis, levelPrecision)
+            knownHits, knownMask = None, None
+            ratio = previousPlane.precision / levelPrecision if previousPlane is not None else 0
+            if previousPlane is not None and abs(ratio - round(ratio)) < 1e-9:
+                # grid points of the coarser level coincide with every ratio-th fine ray
+                ratio = int(round(ratio))
+                knownHits, knownMask = numpy.full(castPlane.shape + (3,), numpy.nan), numpy.zeros(castPlane.shape, dtype=bool)
+                knownHits[::ratio, ::ratio][:previousPlane.shape[0], :previousPlane.shape[1]] = previousHits
+                knownMask[::ratio, ::ratio][:previousPlane.shape[0], :previousPlane.shape[1]] = True
+            hitGrid = BoneThicknessMappingLogic.first_hit_grid(poly_data, castPlane, level_status, engine=engine, bsp_tree=bsp_tree, known_hits=knownHits, known_mask=knownMask, metrics=metrics)
+            del knownHits, knownMask
+            topLayerPolyData, hitPoints = BoneThicknessMappingLogic.build_top_layer(hitGrid, castPlane, region_of_interest, level_status, metrics)
+            thicknessScalarArray, airCellScalarArray = BoneThicknessMappingLogic.ray_cast_color_thickness(
+                poly_data, hitPoints, cast_axis, dimensions, mm_of_air_past_bone, level_status, workers=workers, cell_locator=cell_locator, metrics=metrics
+            )
+            result = (topLayerPolyData, hitPoints, thicknessScalarArray, airCellScalarArray)
+            on_level(*result)
+            previousHits, previousPlane = hitGrid, castPlane
+        return result
+
+    @staticmethod
+    def tiled_quad_cast(poly_data, seg_bounds, cast_axis, precision, region_of_interest, dimensions, mm_of_air_past_bone, update_status, memory_budget_mb=1024.0, bytes_per_ray=512,
+                        engine=BoneThicknessMappingCastEngine.BSP_TREE, workers=1, bsp_tree=None, cell_locator=None, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        # the uniform cast one tile of cast-plane rows at a time: first hits, quads and thickness of a tile are finished
+        # before the next tile is cast, so working memory is set by the budget (about bytes_per_ray per ray of a tile)
+        # and not by the grid. Quads of a tile also use the last row of hits of the previous one, which is carried over
+        # rather than cast again. Point ids, cells and values come out exactly as from rainfall_quad_cast followed by
+        # ray_cast_color_thickness.
+        update_status(text="Calculating segmentation cast-plane...", progress=43)
+        castPlane = CastPlane(seg_bounds, cast_axis, precision)
+        castIndex, budget = castPlane.cast_index, memory_budget_mb * 2**20
+        mesh, meshRows = None, None
+        if engine == BoneThicknessMappingCastEngine.Z_BUFFER:
+            # the z-buffer triangulates the surface once, every tile then only rasterizes the triangles reaching its rows;
+            # the triangulated mesh stays for the whole cast and comes out of the budget
+            with metrics.stage('first_hit_cast'):
+                mesh = BoneThicknessMappingLogic.poly_data_triangles(poly_data)
+                rowCoordinates = (mesh[0][mesh[1], castPlane.plane_indices[0]] - castPlane.origin[0]) / precision
+                meshRows = (numpy.floor(rowCoordinates.min(axis=1)).astype(numpy.int32) - 1, numpy.ceil(rowCoordinates.max(axis=1)).astype(numpy.int32) + 1)
+                del rowCoordinates
+            budget = max(budget - sum(a.nbytes for a in mesh + meshRows), 0)
+        tileRows = max(2, int(budget // (bytes_per_ray * max(castPlane.shape[1], 1))))
+        tiles = [(r, min(r + tileRows, castPlane.shape[0])) for r in range(0, castPlane.shape[0], tileRows)]
+        metrics.set('tiles', len(tiles))
+        if engine == BoneThicknessMappingCastEngine.BSP_TREE and bsp_tree is None: bsp_tree = BoneThicknessMappingLogic.build_bsp_tree(poly_data, metrics)
+        if engine != BoneThicknessMappingCastEngine.LABELMAP and workers <= 1 and cell_locator is None:
+            with metrics.stage('locator_build'): cell_locator = ThicknessCalculation.build_cell_locator(poly_data)
+
+        # finished points, normals, values and quads of every tile, assembled once all tiles are done
+        pidGrid = numpy.full(castPlane.shape, -1, dtype=numpy.int32)
+        done = collections.OrderedDict((name, []) for name in ['points', 'normals', 'thickness', 'air_cell', 'quads'])
+        carried, hitCount, startTime = numpy.empty((0, 3)), 0, time.time()
+        for n, (firstRow, lastRow) in enumerate(tiles):
+            def tile_status(text=None, progress=None):
+                if progress is not None: progress = 41 + int(59 * (n + max(0, progress - 41) / 59.0) / len(tiles))
+                update_status(text="[tile " + str(n + 1) + "/" + str(len(tiles)) + "] " + text if text is not None else None, progress=progress)
+
+            tileMesh = None
+            if mesh is not None: tileMesh = (mesh[0], mesh[1][(meshRows[1] >= firstRow) & (meshRows[0] < lastRow)])
+            hitGrid = BoneThicknessMappingLogic.first_hit_grid(
+                poly_data, castPlane.tile(firstRow, lastRow), tile_status, engine=engine, bsp_tree=bsp_tree, max_candidates=max(2**16, int(budget // 1024)), mesh=tileMesh, metrics=metrics
+            )
+            del tileMesh
+            with numpy.errstate(invalid='ignore'):
+                inRegion = (region_of_interest[0] <= hitGrid[:, :, castIndex]) & (hitGrid[:, :, castIndex] < region_of_interest[1])
+            points = hitGrid[inRegion]
+            del hitGrid
+            points[:, castIndex] += 0.3 * castPlane.negated  # raised to improve visibility
+            pidGrid[firstRow:lastRow][inRegion] = numpy.arange(hitCount, hitCount + len(points), dtype=numpy.int32)
+            hitCount += len(points)
+
+            # quads down from the carried row, whose points then have their normals; the last row waits for the next tile
+            base = hitCount - len(points) - len(carried)
+            localPids = pidGrid[max(firstRow - 1, 0):lastRow]
+            tile = HitPointGrid(numpy.where(localPids >= 0, localPids - base, -1), numpy.concatenate([carried, points]))
+            del points
+            tile_status(text="Forming top layer polygons", progress=64)
+            with metrics.stage('quad_formation'): quads = BoneThicknessMappingLogic.quad_connectivity(tile, precision, metrics)
+            finished = len(tile) if lastRow == castPlane.shape[0] else len(tile) - int(numpy.count_nonzero(localPids[-1] >= 0))
+            thickness, airCell = BoneThicknessMappingLogic.point_thickness(
+                poly_data, tile.points[:finished], tile.normals[:finished], cast_axis, dimensions, mm_of_air_past_bone, tile_status, gradient_scale_factor, workers, cell_locator, metrics
+            )
+            for name, values in zip(done, [tile.points[:finished], tile.normals[:finished], thickness, airCell, quads + numpy.int32(base)]): done[name].append(values)
+            carried = tile.points[finished:].copy()
+            del tile, quads, thickness, airCell
+
+        # one buffer per result, filled while the tile pieces are let go of
+        def assemble(name, out):
+            start = 0
+            while done[name]:
+                values = done[name].pop(0)
+                out[start:start + len(values)] = values
+                start += len(values)
+            return out
+        hitPoints = HitPointGrid(pidGrid, assemble('points', numpy.empty((hitCount, 3))))
+        hitPoints.set_plane(castPlane)
+        assemble('normals', hitPoints.normals)
+        thicknessValues = assemble('thickness', numpy.empty(hitCount, dtype=numpy.float32))
+        airCellValues = assemble('air_cell', numpy.empty(hitCount, dtype=numpy.float32))
+        quadCount = sum(len(q) for q in done['quads'])
+        connectivity = assemble('quads', numpy.empty((quadCount, 4), dtype=numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]))
+        # the cell array uses the connectivity buffer as it is
+        cells = vtk.vtkCellArray()
+        cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(numpy.arange(0, 4*quadCount + 1, 4), deep=True), numpy_support.numpy_to_vtkIdTypeArray(connectivity.ravel(), deep=False))
+        topLayerPolyData = vtk.vtkPolyData()
+        topLayerPolyData.SetPoints(hitPoints.vtk_points)
         topLayerPolyData.SetPolys(cells)
         topLayerPolyData.Modified()
-        return topLayerPolyData, [p for d0 in hitPointMatrix for p in d0 if p is not None]
+        update_status(text="Finished tiled casting in " + str("%.1f" % (time.time() - startTime)) + "s, " + str(len(tiles)) + " tiles of " + str(tileRows) + " rows, found " + str(topLayerPolyData.GetNumberOfCells()) + " cells...", progress=100)
+        return topLayerPolyData, hitPoints, BoneThicknessMappingLogic.scalar_array(thicknessValues, BoneThicknessMappingType.THICKNESS), BoneThicknessMappingLogic.scalar_array(airCellValues, BoneThicknessMappingType.AIR_CELL)
+
+    @staticmethod
+    def adaptive_quad_cast(poly_data, seg_bounds, cast_axis, precision, region_of_interest, dimensions, mm_of_air_past_bone, update_status,
+                           depth_tolerance=0.5, thickness_tolerance=0.5, coarse_precision=4.0, engine=BoneThicknessMappingCastEngine.BSP_TREE,
+                           workers=1, bsp_tree=None, cell_locator=None, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        update_status(text="Calculating segmentation cast-plane...", progress=43)
+        castPlane = CastPlane(seg_bounds, cast_axis, precision)
+        castIndex, lift = castPlane.cast_index, 0.3 * castPlane.negated
+        # leaves are (i, j, size) squares in fine grid units, sizes are powers of two up to the coarse step
+        step = 2 ** max(0, int(round(numpy.log2(max(coarse_precision / precision, 1.0)))))
+        # pad the plane so the coarse cells tile it, rays past the segmentation bounds simply miss
+        castPlane.shape = tuple(int(numpy.ceil(max(n - 1, 1) / float(step))) * step + 1 for n in castPlane.shape)
+        shape, cells = castPlane.shape, (castPlane.shape[0] - 1, castPlane.shape[1] - 1)
+        startTime = time.time()
+
+        if engine in [BoneThicknessMappingCastEngine.Z_BUFFER, BoneThicknessMappingCastEngine.LABELMAP]:
+            # whole-plane engines are cheap enough to run once, refinement then only looks up the rays it needs
+            planeHits = BoneThicknessMappingLogic.first_hit_grid(poly_data, castPlane, update_status, engine=engine, metrics=metrics)
+            cast = lambda rows, columns: planeHits[rows, columns]
+        else:
+            update_status(text="Building intersection object tree...", progress=41)
+            bspTree = bsp_tree if bsp_tree is not None else BoneThicknessMappingLogic.build_bsp_tree(poly_data, metrics)
+
+            def cast(rows, columns):
+                with metrics.stage('first_hit_cast'): rayHits = BoneThicknessMappingLogic.bsp_first_hits(bspTree, castPlane, rows, columns)
+                metrics.count('first_hit_rays', len(rows))
+                metrics.count('first_hits', int(numpy.count_nonzero(~numpy.isnan(rayHits[:, 0]))))
+                return rayHits
+        if engine != BoneThicknessMappingCastEngine.LABELMAP and workers <= 1 and cell_locator is None:
+            with metrics.stage('locator_build'): cell_locator = ThicknessCalculation.build_cell_locator(poly_data)
+        stretchFactor = dimensions[castIndex]
+
+        def thickness_of(points, normals):
+            statistics = {}
+            with metrics.stage('thickness_cast'):
+                if engine == BoneThicknessMappingCastEngine.LABELMAP:
+                    result = LabelmapThickness.calculate_thickness(poly_data, points, normals, stretchFactor, mm_of_air_past_bone, gradient_scale_factor)
+                elif workers > 1:
+                    result = ThicknessCalculation.calculate_thickness_parallel(
+                        poly_data, numpy.arange(len(points)), points, normals, stretchFactor, mm_of_air_past_bone, workers,
+                        gradient_scale_factor=gradient_scale_factor, executable=BoneThicknessMappingLogic.thickness_worker_executable(), statistics=statistics
+                    )
+                else: result = ThicknessCalculation.calculate_thickness(poly_data, cell_locator, points, normals, stretchFactor, mm_of_air_past_bone, gradient_scale_factor, statistics)
+            metrics.count('thickness_rays', len(points))
+            for name, value in statistics.items(): metrics.count(name, value)
+            return result
+
+        def corner_indices(leaves):
+            # corners in the same order as a uniform quad: [i][j], [i+1][j], [i+1][j+1], [i][j+1]
+            i, j, s = leaves[:, 0], leaves[:, 1], leaves[:, 2]
+            return numpy.stack([i, i + s, i + s, i], axis=1), numpy.stack([j, j, j + s, j + s], axis=1)
+
+        def split_leaves(leaves):
+            i, j, h = leaves[:, 0], leaves[:, 1], leaves[:, 2] // 2
+            return numpy.concatenate([numpy.stack([i, j, h], axis=1), numpy.stack([i + h, j, h], axis=1), numpy.stack([i, j + h, h], axis=1), numpy.stack([i + h, j + h, h], axis=1)])
+
+        def balance(leaves):
+            # split leaves until no edge neighbour is less than half their size, so every edge has at most one hanging vertex
+            while True:
+                sizes, sizeMap = numpy.unique(leaves[:, 2]), numpy.zeros(cells, dtype=numpy.int64)
+                for s in sizes:
+                    blocks = numpy.zeros((cells[0] // s, cells[1] // s), dtype=numpy.int64)
+                    blocks[leaves[leaves[:, 2] == s, 0] // s, leaves[leaves[:, 2] == s, 1] // s] = s
+                    sizeMap = numpy.maximum(sizeMap, numpy.repeat(numpy.repeat(blocks, s, axis=0), s, axis=1))
+                padded = numpy.pad(sizeMap, 1, mode='constant', constant_values=step)
+                neighbours = numpy.minimum.reduce([padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]])
+                split = numpy.zeros(len(leaves), dtype=bool)
+                for s in sizes[sizes > 2]:
+                    selected = leaves[:, 2] == s
+                    blockMinimum = neighbours.reshape(cells[0] // s, s, cells[1] // s, s).min(axis=(1, 3))
+                    split[selected] = blockMinimum[leaves[selected, 0] // s, leaves[selected, 1] // s] * 2 < s
+                if not split.any(): return leaves
+                leaves = numpy.concatenate([leaves[~split], split_leaves(leaves[split])])
+
+        def lifted_corners(ci, cj):
+            # lifted like the final hit points, so refinement sees the same normals as the result
+            corners = hits[ci, cj].copy()
+            corners[..., castIndex] += lift
+            return corners
+
+        hits, sampled = numpy.full(shape + (3,), numpy.nan), numpy.zeros(shape, dtype=bool)
+        thickness, airCell, thicknessSize = numpy.zeros(shape), numpy.zeros(shape), numpy.zeros(shape, dtype=numpy.int64)
+        rows, columns = numpy.meshgrid(numpy.arange(0, cells[0], step), numpy.arange(0, cells[1], step), indexing='ij')
+        leaves = numpy.stack([rows.ravel(), columns.ravel(), numpy.full(rows.size, step)], axis=1)
+        firstHitRays, thicknessRays = 0, 0
+        while True:
+            # first hits for corners not cast yet
+            ci, cj = corner_indices(leaves)
+            pending = numpy.zeros(shape, dtype=bool)
+            pending[ci, cj] = True
+            pendingRows, pendingColumns = numpy.nonzero(pending & ~sampled)
+            update_status(text="Adaptive sampling " + str(len(leaves)) + " cells, casting " + str(len(pendingRows)) + " rays...", progress=44 + int(36 * (1.0 - numpy.log2(leaves[:, 2].min()) / max(1.0, numpy.log2(step)))))
+            hits[pendingRows, pendingColumns] = cast(pendingRows, pendingColumns)
+            sampled[pendingRows, pendingColumns] = True
+            firstHitRays += len(pendingRows)
+            with numpy.errstate(invalid='ignore'):
+                valid = (region_of_interest[0] <= hits[:, :, castIndex]) & (hits[:, :, castIndex] < region_of_interest[1])
+
+            # thickness at the first corner of every fully covered leaf, with the normal of that leaf
+            cornerValid = valid[ci, cj]
+            complete = cornerValid.all(axis=1)
+            fresh = numpy.flatnonzero(complete & (thicknessSize[ci[:, 0], cj[:, 0]] != leaves[:, 2]))
+            if len(fresh) > 0:
+                corners = lifted_corners(ci[fresh], cj[fresh])
+                normals = BoneThicknessMappingLogic.quad_normals(corners[:, 0], corners[:, 1], corners[:, 2])
+                t, a = thickness_of(corners[:, 0], normals)
+                thickness[ci[fresh, 0], cj[fresh, 0]], airCell[ci[fresh, 0], cj[fresh, 0]] = t, a
+                thicknessSize[ci[fresh, 0], cj[fresh, 0]] = leaves[fresh, 2]
+                thicknessRays += len(fresh)
+
+            # refine where coverage changes, or where depth or thickness varies more than tolerated across the leaf
+            split = cornerValid.any(axis=1) & ~complete
+            depths = hits[ci[complete], cj[complete], castIndex]
+            split[complete] |= depths.max(axis=1) - depths.min(axis=1) > depth_tolerance
+            known = thicknessSize[ci, cj] > 0
+            spread = numpy.where(known, thickness[ci, cj], -numpy.inf).max(axis=1) - numpy.where(known, thickness[ci, cj], numpy.inf).min(axis=1)
+            split |= (known.sum(axis=1) >= 2) & (spread > thickness_tolerance * gradient_scale_factor)
+            split &= leaves[:, 2] > 1
+            if not split.any(): break
+            leaves = balance(numpy.concatenate([leaves[~split], split_leaves(leaves[split])]))
+
+        # hit points are the covered corners of the final leaves
+        update_status(text="Forming top layer polygons", progress=80)
+        with metrics.stage('quad_formation'):
+            ci, cj = corner_indices(leaves)
+            usable = numpy.zeros(shape, dtype=bool)
+            usable[ci, cj] = True
+            usable &= valid
+            pidGrid = numpy.full(shape, -1, dtype=numpy.int32)
+            pidGrid[usable] = numpy.arange(numpy.count_nonzero(usable), dtype=numpy.int32)
+            points = hits[usable]
+            points[:, castIndex] += lift  # raised to improve visibility
+            hitPoints = HitPointGrid(pidGrid, points)
+            hitPoints.set_plane(castPlane)
+            hitPoints.sample_step = step
+            del points
+
+            # one polygon per covered leaf, including the hanging vertices of smaller neighbours so the mesh stays conforming
+            complete = valid[ci, cj].all(axis=1)
+            leaves, ci, cj = leaves[complete], ci[complete], cj[complete]
+            corners = pidGrid[ci, cj]
+            quadPoints = hitPoints.points[corners]
+            accepted = (numpy.linalg.norm(quadPoints[:, 1:] - quadPoints[:, :1], axis=2) <= leaves[:, 2:3] * precision * 6).all(axis=1)
+            metrics.count('quads_rejected_edge_test', int(len(accepted) - numpy.count_nonzero(accepted)))
+            leaves, corners, quadPoints = leaves[accepted], corners[accepted], quadPoints[accepted]
+            metrics.count('quads', len(leaves))
+            hitPoints.normals[corners[:, 0]] = BoneThicknessMappingLogic.quad_normals(quadPoints[:, 0], quadPoints[:, 1], quadPoints[:, 2])
+            i, j, s = leaves[:, 0], leaves[:, 1], leaves[:, 2]
+            h = s // 2
+            midpoints = [(i + h, j), (i + s, j + h), (i + h, j + s), (i, j + h)]
+            polygons = numpy.full((len(leaves), 8), -1, dtype=numpy.int64)
+            polygons[:, 0::2] = corners
+            for n, (mi, mj) in enumerate(midpoints):
+                polygons[:, 2*n + 1] = numpy.where((s > 1) & usable[mi, mj], pidGrid[mi, mj], -1)
+
+            topLayerPolyData = vtk.vtkPolyData()
+            topLayerPolyData.SetPoints(hitPoints.vtk_points)
+            topLayerPolyData.SetPolys(BoneThicknessMappingLogic.build_cell_array(polygons))
+            topLayerPolyData.Modified()
+
+        # thickness of the accepted leaves was computed with their own normals during refinement
+        thicknessValues, airCellValues = numpy.zeros(len(hitPoints), dtype=numpy.float32), numpy.zeros(len(hitPoints), dtype=numpy.float32)
+        thicknessValues[corners[:, 0]], airCellValues[corners[:, 0]] = thickness[i, j], airCell[i, j]
+        thicknessScalarArray = BoneThicknessMappingLogic.scalar_array(thicknessValues, BoneThicknessMappingType.THICKNESS)
+        airCellScalarArray = BoneThicknessMappingLogic.scalar_array(airCellValues, BoneThicknessMappingType.AIR_CELL)
+        uniformRays = (shape[0] - 1) * (shape[1] - 1)
+        update_status(text="Finished adaptive sampling in " + str("%.1f" % (time.time() - startTime)) + "s, " + str(firstHitRays) + " first-hit and " + str(thicknessRays) + " thickness rays (uniform grid: ~" + str(uniformRays) + " each), found " + str(topLayerPolyData.GetNumberOfCells()) + " cells...", progress=100)
+        return topLayerPolyData, hitPoints, thicknessScalarArray, airCellScalarArray
 
     @staticmethod
     def build_model(poly_data, update_status):
@@ -834,65 +2071,260 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         return modelNode
 
     @staticmethod
-    def ray_cast_color_thickness(poly_data, hit_point_list, cast_axis, dimensions, mm_of_air_past_bone, update_status, gradient_scale_factor=10.0):
-        # ray direction cast axis index
-        castIndex = BoneThicknessMappingLogic.determine_cast_axis_index(cast_axis)
+    def thickness_worker_executable():
+        # worker processes must run a plain interpreter, not another Slicer application instance
+        return shutil.which('PythonSlicer')
 
-        update_status(text="Building static cell locator...", progress=81)
-        cellLocator = vtk.vtkStaticCellLocator()
-        cellLocator.SetDataSet(poly_data)
-        cellLocator.BuildLocator()
+    @staticmethod
+    def ray_cast_color_thickness(poly_data, hit_point_grid, cast_axis, dimensions, mm_of_air_past_bone, update_status, gradient_scale_factor=10.0, workers=1, cell_locator=None, metrics=RunMetrics.DISABLED):
+        skullThickness, airCellDistance = BoneThicknessMappingLogic.point_thickness(
+            poly_data, hit_point_grid.points, hit_point_grid.normals, cast_axis, dimensions, mm_of_air_past_bone, update_status, gradient_scale_factor, workers, cell_locator, metrics
+        )
+        return BoneThicknessMappingLogic.scalar_array(skullThickness, BoneThicknessMappingType.THICKNESS), BoneThicknessMappingLogic.scalar_array(airCellDistance, BoneThicknessMappingType.AIR_CELL)
 
-        total = len(hit_point_list)
-        update_status(text="Calculating thickness (may take long, " + str(total) + " rays)...", progress=82)
+    @staticmethod
+    def point_thickness(poly_data, points, normals, cast_axis, dimensions, mm_of_air_past_bone, update_status, gradient_scale_factor=10.0, workers=1, cell_locator=None, metrics=RunMetrics.DISABLED):
+        # ray direction cast axis index
+        castIndex = BoneThicknessMappingLogic.determine_cast_axis_index(cast_axis)
+        stretchFactor = dimensions[castIndex]
+        pids = numpy.arange(len(points))
+
+        # results go straight into float32 per-pid buffers, which scalar arrays share without a copy
+        total, statistics = len(points), {}
+        skullThickness, airCellDistance = numpy.zeros(total, dtype=numpy.float32), numpy.zeros(total, dtype=numpy.float32)
+        cellLocator = cell_locator
+        if not isinstance(poly_data, LabelmapThickness.BinaryLabelmap) and workers <= 1 and cellLocator is None:
+            update_status(text="Building static cell locator...", progress=81)
+            with metrics.stage('locator_build'): cellLocator = ThicknessCalculation.build_cell_locator(poly_data)
         startTime = time.time()
-
-        def init_array(name):
-            a = vtk.vtkFloatArray()
-            a.SetName(name)
-            return a
-
-        def interpret_distance(points):
-            firstIn, lastOut = points[0], points[1]
-            if len(points) > 2:
-                for inOutPair in zip(*[iter(points[2:])] * 2):
-                    # TODO incorporate cast bounds
-                    # if newIn[1][cast_axis] < minBound and newOut[1][cast_axis] < minBound
-                    if calculate_distance(lastOut[1], inOutPair[0][1]) < mm_of_air_past_bone*gradient_scale_factor: lastOut = inOutPair[1]
-                return calculate_distance(firstIn[1], lastOut[1])
+        with metrics.stage('thickness_cast'):
+            if isinstance(poly_data, LabelmapThickness.BinaryLabelmap):
+                update_status(text="Marching thickness rays through the labelmap (" + str(total) + " rays)...", progress=82)
+                skullThickness[:], airCellDistance[:] = LabelmapThickness.calculate_thickness(
+                    poly_data, points, normals, stretchFactor, mm_of_air_past_bone, gradient_scale_factor,
+                    on_progress=lambda done, count: update_status(text=f"Calculating thickness (~{done} of {count} rays)", progress=82 + int(round((done*1.0/count*1.0)*18.0)))
+                )
+            elif workers > 1:
+                update_status(text="Calculating thickness on " + str(workers) + " worker processes (" + str(total) + " rays)...", progress=81)
+                skullThickness[:], airCellDistance[:] = ThicknessCalculation.calculate_thickness_parallel(
+                    poly_data, pids, points, normals, stretchFactor, mm_of_air_past_bone, workers,
+                    gradient_scale_factor=gradient_scale_factor,
+                    on_progress=lambda done, count: update_status(text=f"Calculating thickness (~{done} of {count} rays)", progress=82 + int(round((done*1.0/count*1.0)*18.0))),
+                    executable=BoneThicknessMappingLogic.thickness_worker_executable(),
+                    statistics=statistics
+                )
             else:
-                return calculate_distance(firstIn[1], points[-1][1])
-
-        def calculate_distance(point1, point2):
-            d = numpy.linalg.norm(numpy.array((point1[0], point1[1], point1[2])) - numpy.array((point2[0], point2[1], point2[2])))
-            d = d*gradient_scale_factor
-            return d
-
-        skullThicknessArray, airCellDistanceArray = init_array(BoneThicknessMappingType.THICKNESS), init_array(BoneThicknessMappingType.AIR_CELL)
-        tol, pCoords, subId = 0.000, [0, 0, 0], vtk.reference(0)
-        pointsOfIntersection, cellsOfIntersection = vtk.vtkPoints(), vtk.vtkIdList()
-        for i, hitPoint in enumerate(hit_point_list):
-            stretchFactor = dimensions[castIndex]
-            start = [hitPoint.point[0] + hitPoint.normal[0]*stretchFactor, hitPoint.point[1] + hitPoint.normal[1]*stretchFactor, hitPoint.point[2] + hitPoint.normal[2]*stretchFactor]
-            end = [hitPoint.point[0] - hitPoint.normal[0]*stretchFactor, hitPoint.point[1] - hitPoint.normal[1]*stretchFactor, hitPoint.point[2] - hitPoint.normal[2]*stretchFactor]
-            cellLocator.FindCellsAlongLine(start, end, tol, cellsOfIntersection)
-            distances = []
-            for cellIndex in range(cellsOfIntersection.GetNumberOfIds()):
-                t = vtk.reference(0.0)
-                p = [0.0, 0.0, 0.0]
-                if poly_data.GetCell(cellsOfIntersection.GetId(cellIndex)).IntersectWithLine(start, end, tol, t, p, pCoords, subId) and 0.0 <= t <= 1.0:
-                    distances.append([t, p])
-            if len(distances) >= 2:
-                distances = sorted(distances, key=lambda kv: kv[0])
-                skullThicknessArray.InsertTuple1(hitPoint.pid, interpret_distance(distances))
-                airCellDistanceArray.InsertTuple1(hitPoint.pid, calculate_distance(distances[0][1], distances[1][1]))
-            else:
-                skullThicknessArray.InsertTuple1(hitPoint.pid, 0)
-                airCellDistanceArray.InsertTuple1(hitPoint.pid, 0)
-            # update rays casted status
-            if i % 200 == 0: update_status(text=f"Calculating thickness (~{i} of {total} rays)", progress=82 + int(round((i*1.0/total*1.0)*18.0)))
+                update_status(text="Calculating thickness (may take long, " + str(total) + " rays)...", progress=82)
+                for i in range(0, total, 200):
+                    skullThickness[i:i+200], airCellDistance[i:i+200] = ThicknessCalculation.calculate_thickness(poly_data, cellLocator, points[i:i+200], normals[i:i+200], stretchFactor, mm_of_air_past_bone, gradient_scale_factor, statistics)
+                    # update rays casted status
+                    update_status(text=f"Calculating thickness (~{i} of {total} rays)", progress=82 + int(round((i*1.0/total*1.0)*18.0)))
+        metrics.count('thickness_rays', total)
+        for name, value in statistics.items(): metrics.count(name, value)
         update_status(text="Finished thickness calculation in " + str("%.1f" % (time.time() - startTime)) + "s...", progress=100)
-        return skullThicknessArray, airCellDistanceArray
+        return skullThickness, airCellDistance
+
+    @staticmethod
+    def scalar_array(values, name):
+        # vtkFloatArray on a float32 numpy buffer, which the array keeps alive
+        array = numpy_support.numpy_to_vtk(values, deep=False)
+        array.SetName(name)
+        return array
+
+    @staticmethod
+    def attach_scalar_arrays(top_layer_poly_data, thickness_scalar_array, air_cell_scalar_array):
+        # both maps stay on the top layer, switching between them only changes the display's active scalar name
+        pointData = top_layer_poly_data.GetPointData()
+        pointData.AddArray(thickness_scalar_array)
+        pointData.AddArray(air_cell_scalar_array)
+        pointData.SetActiveScalars(BoneThicknessMappingType.THICKNESS)
+
+    @staticmethod
+    def volume_fingerprint(image):
+        # hash of the voxel data and its placement, without copying the volume
+        h = hashlib.blake2b(digest_size=16)
+        h.update(numpy.ascontiguousarray(numpy_support.vtk_to_numpy(image.GetImageData().GetPointData().GetScalars())).data)
+        matrix = vtk.vtkMatrix4x4()
+        image.GetIJKToRASMatrix(matrix)
+        h.update(str([matrix.GetElement(i, j) for i in range(4) for j in range(4)] + list(image.GetImageData().GetDimensions())).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def load_cached_segmentation(cache, key):
+        polyData = cache.get_poly_data(ResultCache.SEGMENTATION, key)
+        if polyData is None: return None
+        bounds = list(numpy_support.vtk_to_numpy(polyData.GetFieldData().GetArray('SegmentationBounds')))
+        polyData.GetFieldData().RemoveArray('SegmentationBounds')
+        return polyData, bounds
+
+    @staticmethod
+    def store_cached_segmentation(cache, key, poly_data, bounds):
+        stored = vtk.vtkPolyData()
+        stored.ShallowCopy(poly_data)
+        stored.SetFieldData(vtk.vtkFieldData())
+        boundsArray = numpy_support.numpy_to_vtk(numpy.array(bounds, dtype=numpy.float64), deep=True)
+        boundsArray.SetName('SegmentationBounds')
+        stored.GetFieldData().AddArray(boundsArray)
+        cache.put_poly_data(ResultCache.SEGMENTATION, key, stored)
+
+    @staticmethod
+    def load_cached_result(cache, key):
+        stored = cache.get_poly_data(ResultCache.RESULT, key)
+        if stored is None: return None
+        shape = numpy_support.vtk_to_numpy(stored.GetFieldData().GetArray('PidGridShape'))
+        pidGrid = numpy_support.vtk_to_numpy(stored.GetFieldData().GetArray('PidGrid')).astype(numpy.int32).reshape(shape)
+        hitPointGrid = HitPointGrid(pidGrid, numpy_support.vtk_to_numpy(stored.GetPoints().GetData()))
+        hitPointGrid.normals[:] = numpy_support.vtk_to_numpy(stored.GetPointData().GetArray('HitPointNormals'))
+        plane = stored.GetFieldData().GetArray('PidGridPlane')
+        if plane is not None:
+            castIndex, o0, o1, precision, sampleStep = numpy_support.vtk_to_numpy(plane).tolist()
+            hitPointGrid.plane, hitPointGrid.sample_step = (int(castIndex), (o0, o1), precision), int(sampleStep)
+        thicknessScalarArray = stored.GetPointData().GetArray(BoneThicknessMappingType.THICKNESS)
+        airCellScalarArray = stored.GetPointData().GetArray(BoneThicknessMappingType.AIR_CELL)
+        topLayerPolyData = vtk.vtkPolyData()
+        topLayerPolyData.SetPoints(hitPointGrid.vtk_points)
+        topLayerPolyData.SetPolys(stored.GetPolys())
+        return topLayerPolyData, hitPointGrid, thicknessScalarArray, airCellScalarArray
+
+    @staticmethod
+    def store_cached_result(cache, key, top_layer_poly_data, hit_point_grid, thickness_scalar_array, air_cell_scalar_array):
+        stored = vtk.vtkPolyData()
+        stored.SetPoints(top_layer_poly_data.GetPoints())
+        stored.SetPolys(top_layer_poly_data.GetPolys())
+        normals = numpy_support.numpy_to_vtk(hit_point_grid.normals, deep=True)
+        normals.SetName('HitPointNormals')
+        for array in [thickness_scalar_array, air_cell_scalar_array, normals]: stored.GetPointData().AddArray(array)
+        pidGrid = numpy_support.numpy_to_vtk(hit_point_grid.pid_grid.ravel(), deep=True)
+        pidGrid.SetName('PidGrid')
+        shape = numpy_support.numpy_to_vtk(numpy.array(hit_point_grid.pid_grid.shape, dtype=numpy.int64), deep=True)
+        shape.SetName('PidGridShape')
+        stored.GetFieldData().AddArray(pidGrid)
+        stored.GetFieldData().AddArray(shape)
+        if hit_point_grid.plane is not None:
+            castIndex, origin, precision = hit_point_grid.plane
+            plane = numpy_support.numpy_to_vtk(numpy.array([castIndex, origin[0], origin[1], precision, hit_point_grid.sample_step], dtype=numpy.float64), deep=True)
+            plane.SetName('PidGridPlane')
+            stored.GetFieldData().AddArray(plane)
+        cache.put_poly_data(ResultCache.RESULT, key, stored)
+
+    @staticmethod
+    def export_result(prefix, top_layer_poly_data, hit_point_grid, thickness_scalar_array, air_cell_scalar_array, cast_axis_name, rasters=True, metrics=RunMetrics.DISABLED):
+        # <prefix>.vtp with both scalar arrays, and with rasters the cast-plane .npy files and their _grid.json
+        with metrics.stage('write'):
+            model = vtk.vtkPolyData()
+            model.ShallowCopy(top_layer_poly_data)
+            BoneThicknessMappingLogic.attach_scalar_arrays(model, thickness_scalar_array, air_cell_scalar_array)
+            paths = {'model': RasterExport.write_top_layer(prefix + '.vtp', model)}
+            if rasters: paths.update(RasterExport.write_rasters(prefix, hit_point_grid, thickness_scalar_array, air_cell_scalar_array, cast_axis_name))
+        return paths
+
+    @staticmethod
+    def find_implant_sites(hit_point_grid, thickness_scalar_array, shape, size, required_depth, coverage=1.0, count=5, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        # best footprint centres on the top layer, as dicts of RAS position and thickness minimum, mean (mm) and share
+        castIndex, origin, precision = hit_point_grid.plane
+        planeIndices = [i for i in range(3) if i != castIndex]
+        with metrics.stage('footprint_search'):
+            thickness = FootprintSearch.grid_raster(hit_point_grid.pid_grid, numpy_support.vtk_to_numpy(thickness_scalar_array) / gradient_scale_factor, hit_point_grid.sample_step)
+            depth = FootprintSearch.grid_raster(hit_point_grid.pid_grid, hit_point_grid.points[:, castIndex], hit_point_grid.sample_step)
+            found = FootprintSearch.find_sites(thickness, precision, shape, size, required_depth, coverage, count)
+        # below full coverage the centre itself may be off bone, it then sits at the footprint's mean depth
+        sites, reach = [], int(max(size) / 2.0 / precision)
+        for i, j, minimum, share, mean in found:
+            position = [0.0, 0.0, 0.0]
+            position[castIndex] = float(depth[i, j]) if not numpy.isnan(depth[i, j]) else float(numpy.nanmean(depth[max(i - reach, 0):i + reach + 1, max(j - reach, 0):j + reach + 1]))
+            position[planeIndices[0]], position[planeIndices[1]] = origin[0] + i * precision, origin[1] + j * precision
+            sites.append({'position': position, 'minimum': minimum, 'mean': mean, 'share': share})
+        return sites
+
+    @staticmethod
+    def mark_implant_sites(sites, markups_node=None):
+        # numbered control points in rank order, reusing the node of a previous search
+        if markups_node is None or not slicer.mrmlScene.IsNodePresent(markups_node):
+            markups_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'ImplantSites')
+            markups_node.CreateDefaultDisplayNodes()
+        markups_node.RemoveAllControlPoints()
+        for n, site in enumerate(sites): markups_node.AddControlPoint(site['position'], str(n + 1))
+        return markups_node
+
+    @staticmethod
+    def start_cohort(plane, grid_shape, cast_axis_name, spacing=None, margin=20.0, cast_plane_box=None, bin_width=0.25, bin_range=(0.0, 16.0)):
+        # empty cohort on the cast plane box ([horizontal min, max, vertical min, max]) if given, otherwise on the grid of
+        # the first subject, its (cast index, origin, precision) plane and shape, grown by margin mm; its spacing by default
+        castIndex, origin, precision = plane
+        planeIndices = [i for i in range(3) if i != castIndex]
+        if cast_plane_box is not None: low, high = cast_plane_box[0::2], cast_plane_box[1::2]
+        else:
+            low = [o - margin for o in origin]
+            high = [o + (n - 1) * precision + margin for o, n in zip(origin, grid_shape)]
+        spacing = precision if spacing is None else spacing
+        shape, frameOrigin = CohortStatistics.covering_frame(low, high, spacing)
+        return CohortStatistics.CohortAccumulator(
+            shape, frameOrigin, spacing, RasterExport.AXIS_NAMES[planeIndices[0]], RasterExport.AXIS_NAMES[planeIndices[1]], cast_axis_name, bin_width, bin_range
+        )
+
+    @staticmethod
+    def add_to_cohort(cohort, name, hit_point_grid, thickness_scalar_array, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        # False if the cohort already holds a subject of that name
+        castIndex, origin, precision = hit_point_grid.plane
+        with metrics.stage('cohort_update'):
+            thickness = FootprintSearch.grid_raster(hit_point_grid.pid_grid, numpy_support.vtk_to_numpy(thickness_scalar_array) / gradient_scale_factor, hit_point_grid.sample_step)
+            depth = FootprintSearch.grid_raster(hit_point_grid.pid_grid, hit_point_grid.points[:, castIndex], hit_point_grid.sample_step)
+            return cohort.add(name, thickness, origin, precision, depth)
+
+    @staticmethod
+    def cohort_summary_model(cohort, rasters, gradient_scale_factor=10.0):
+        # surface through the mean depth of every cell with statistics, one point array per statistic (MEAN, STD, P50...)
+        # scaled like the thickness array so that the thickness colour table applies, and the COUNT of subjects
+        planeIndices = [RasterExport.AXIS_NAMES.index(cohort.row_axis), RasterExport.AXIS_NAMES.index(cohort.column_axis)]
+        castIndex = 3 - sum(planeIndices)
+        shown = ~numpy.isnan(rasters['depth'])
+        pidGrid = numpy.full(cohort.shape, -1, dtype=numpy.int32)
+        pidGrid[shown] = numpy.arange(numpy.count_nonzero(shown), dtype=numpy.int32)
+        rows, columns = numpy.nonzero(shown)
+        points = numpy.empty((len(rows), 3), dtype=numpy.float32)
+        points[:, castIndex] = rasters['depth'][shown]
+        points[:, planeIndices[0]] = cohort.origin[0] + rows * cohort.spacing
+        points[:, planeIndices[1]] = cohort.origin[1] + columns * cohort.spacing
+        quads = numpy.stack([pidGrid[:-1, :-1], pidGrid[1:, :-1], pidGrid[1:, 1:], pidGrid[:-1, 1:]], axis=-1).reshape(-1, 4)
+        quads = quads[(quads >= 0).all(axis=1)]
+
+        polyData = vtk.vtkPolyData()
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+        polyData.SetPoints(vtkPoints)
+        polyData.SetPolys(BoneThicknessMappingLogic.build_cell_array(quads))
+        for name, raster in rasters.items():
+            if name == 'depth': continue
+            polyData.GetPointData().AddArray(BoneThicknessMappingLogic.scalar_array(raster[shown] * numpy.float32(gradient_scale_factor), name.upper()))
+        polyData.GetPointData().AddArray(BoneThicknessMappingLogic.scalar_array(cohort.count[shown].astype(numpy.float32), 'COUNT'))
+        polyData.GetPointData().SetActiveScalars('MEAN')
+        return polyData
+
+    @staticmethod
+    def write_cohort(prefix, cohort, percentiles=(5, 50, 95), min_count=1, gradient_scale_factor=10.0, metrics=RunMetrics.DISABLED):
+        # <prefix>.vtp summary model, <prefix>_<statistic>.npy rasters with their _grid.json, and the state to continue
+        # the cohort from in <prefix>_state.npz
+        with metrics.stage('cohort_summary'):
+            rasters = cohort.summary(percentiles, min_count)
+            paths = cohort.write_rasters(prefix, rasters)
+            paths['model'] = RasterExport.write_top_layer(prefix + '.vtp', BoneThicknessMappingLogic.cohort_summary_model(cohort, rasters, gradient_scale_factor))
+            paths['state'] = cohort.save(prefix + '_state.npz')
+        return paths
+
+    @staticmethod
+    def build_surface_model(poly_data):
+        modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'Bone')
+        modelNode.SetAndObservePolyData(poly_data)
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.GetDisplayNode().SetColor(0.9, 0.8, 0.7)
+        return modelNode
+
+    @staticmethod
+    def set_color_table_size(table, table_max):
+        table.NamesInitialisedOff()
+        table.SetNumberOfColors(table_max)
+        table.GetLookupTable().SetTableRange(0, table_max)
+        table.NamesInitialisedOn()
 
     @staticmethod
     def build_color_table_node(name, table_max):
@@ -900,33 +2332,61 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         table.SetName(name)
         table.SetHideFromEditors(0)
         table.SetTypeToFile()
-        table.NamesInitialisedOff()
-        table.SetNumberOfColors(table_max)
-        table.GetLookupTable().SetTableRange(0, table_max)
-        table.NamesInitialisedOn()
+        BoneThicknessMappingLogic.set_color_table_size(table, table_max)
         slicer.mrmlScene.AddNode(table)
         return table
 
     @staticmethod
-    def build_color_table_nodes(minmax_thickness, minmax_air_cell, gradient_scale_factor=10.0):
-        print(minmax_air_cell)
+    @functools.lru_cache(maxsize=16)
+    def color_table_values(minimum, maximum, resolution, hue_start, hue_span):
+        # uint8 RGBA and names of one entry per resolution mm from 0 to maximum, the hue running linearly from
+        # minimum to maximum; shared between calls, so read only
+        first, count = int(round(minimum / resolution)), int(round(maximum / resolution)) + 1
+        position = numpy.clip((numpy.arange(count) - first) / float(max(count - first, 1)), 0.0, None)
+        # colorsys.hsv_to_rgb at a saturation and value of 0.9
+        hue6 = (hue_start + hue_span * position) * 6.0
+        sector, f, v = numpy.floor(hue6).astype(int) % 6, hue6 - numpy.floor(hue6), numpy.full(count, 0.9)
+        p, q, t = v * 0.1, v * (1.0 - 0.9 * f), v * (1.0 - 0.9 * (1.0 - f))
+        rgba = numpy.empty((count, 4), dtype=numpy.uint8)
+        for channel, choices in enumerate([(v, q, p, p, t, v), (t, v, v, q, p, p), (p, p, t, v, v, q)]):
+            rgba[:, channel] = numpy.floor(numpy.choose(sector, choices) * 255.0 + 0.5)
+        rgba[:, 3] = 255
+        rgba.setflags(write=False)
+        decimals = max(0, int(numpy.ceil(-numpy.log10(resolution) - 1e-9)))
+        return rgba, tuple('%.*f mm' % (decimals, i * resolution) for i in range(count))
 
-        def calculate_and_set_colour(table, index, hue=0.0, sat=1.0, val=1.0):
-            rgb = colorsys.hsv_to_rgb(hue, sat, val)
-            table.SetColor(index, str(index/gradient_scale_factor) + ' mm', rgb[0], rgb[1], rgb[2], 1.0)
+    @staticmethod
+    def fill_color_table(table, minmax, hue_start, hue_span, gradient_scale_factor=10.0, resolution=0.1):
+        rgba, names = BoneThicknessMappingLogic.color_table_values(float(minmax[0]), float(minmax[1]), float(resolution), hue_start, hue_span)
+        table.NamesInitialisedOff()
+        table.SetNumberOfColors(len(rgba))
+        table.GetLookupTable().SetTable(numpy_support.numpy_to_vtk(rgba, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+        # scalars are mm * gradient_scale_factor, every entry covers resolution mm of them
+        table.GetLookupTable().SetTableRange(0, len(rgba) * resolution * gradient_scale_factor)
+        for i, name in enumerate(names): table.SetColorName(i, name)
+        table.NamesInitialisedOn()
+        return table
 
-        def p(lhs, rhs, base, right_mod=1.0):
-            return float(lhs-base)/float((rhs-base)*right_mod)
+    @staticmethod
+    def fill_thickness_color_table(table, minmax_thickness, gradient_scale_factor=10.0, resolution=0.1):
+        return BoneThicknessMappingLogic.fill_color_table(table, minmax_thickness, 0.0, 0.278, gradient_scale_factor, resolution)
 
-        # thickness table
-        ix = [int(i) for i in [minmax_thickness[0]*gradient_scale_factor, (minmax_thickness[1])*gradient_scale_factor + 1]]
-        thicknessTableNode = BoneThicknessMappingLogic.build_color_table_node('ThicknessColorMap', ix[-1])
-        for i in range(ix[0], ix[-1]): calculate_and_set_colour(thicknessTableNode, i, hue=p(i, ix[-1], ix[0]) * 0.278, sat=0.9, val=0.9)
+    @staticmethod
+    def fill_air_cell_color_table(table, minmax_air_cell, gradient_scale_factor=10.0, resolution=0.1):
+        return BoneThicknessMappingLogic.fill_color_table(table, minmax_air_cell, 0.696, -0.571, gradient_scale_factor, resolution)
 
-        # air cell table
-        iy = [int(i) for i in [minmax_air_cell[0]*gradient_scale_factor, (minmax_air_cell[1])*gradient_scale_factor + 1]]
-        airCellTableNode = BoneThicknessMappingLogic.build_color_table_node('AirCellColorMap', iy[-1])
-        for i in range(iy[0], iy[-1]): calculate_and_set_colour(airCellTableNode, i, hue=0.696 - p(i, iy[-1], iy[0]) * 0.571, sat=0.9, val=0.9)
+    @staticmethod
+    def build_color_table_nodes(minmax_thickness, minmax_air_cell, gradient_scale_factor=10.0, resolution=0.1, table_nodes=(None, None), metrics=RunMetrics.DISABLED):
+        # tables of a previous run are refilled rather than added again, as long as they are still in the scene
+        thicknessTableNode, airCellTableNode = [n if n is not None and slicer.mrmlScene.IsNodePresent(n) else None for n in table_nodes]
+        with metrics.stage('colour_tables'):
+            # thickness table
+            if thicknessTableNode is None: thicknessTableNode = BoneThicknessMappingLogic.build_color_table_node('ThicknessColorMap', 1)
+            BoneThicknessMappingLogic.fill_thickness_color_table(thicknessTableNode, minmax_thickness, gradient_scale_factor, resolution)
+
+            # air cell table
+            if airCellTableNode is None: airCellTableNode = BoneThicknessMappingLogic.build_color_table_node('AirCellColorMap', 1)
+            BoneThicknessMappingLogic.fill_air_cell_color_table(airCellTableNode, minmax_air_cell, gradient_scale_factor, resolution)
 
         return thicknessTableNode, airCellTableNode
 
@@ -938,3 +2398,513 @@ class BoneThicknessMappingLogic(ScriptedLoadableModuleLogic):
         if state == 0 or color_node_id is None: return
         slicer.util.findChildren(colorWidget, 'ColorTableComboBox')[0].setCurrentNodeID(color_node_id)
         slicer.util.findChildren(colorWidget, 'UseColorNameAsLabelCheckBox')[0].setChecked(True)
+
+
+class BoneThicknessMappingBatch:
+    AXES = {
+        'R': ctk.ctkAxesWidget.Right, 'L': ctk.ctkAxesWidget.Left,
+        'A': ctk.ctkAxesWidget.Anterior, 'P': ctk.ctkAxesWidget.Posterior,
+        'S': ctk.ctkAxesWidget.Superior, 'I': ctk.ctkAxesWidget.Inferior,
+    }
+    VOLUME_EXTENSIONS = ('.nrrd', '.nhdr', '.nii', '.nii.gz', '.mha', '.mhd')
+    DEFAULT_CONFIG = {
+        'threshold_range': [600, 3071],
+        'segmentation_method': 'DIRECT',
+        'axis': 'L',
+        'quality': 'MEDIUM',
+        'region_of_interest': [-100, 100],
+        'crop_margin': 20.0,
+        'cast_plane_box': None,
+        'mm_of_air_past_bone': 4.0,
+        'depth_preset': BoneDepthMappingPresets.BCI601,
+        'min_max_skull_thickness': [0.0, 8.7],
+        'min_max_air_cell': [0.0, 4.0],
+        'colour_resolution': 0.1,
+        'cast_engine': BoneThicknessMappingCastEngine.BSP_TREE,
+        'decimation_error': 0.0,
+        'thickness_workers': 1,
+        'tile_memory_mb': None,
+        'sampling': 'UNIFORM',
+        'adaptive_tolerance': [0.5, 0.5],
+        'export_rasters': False,
+        'implant_footprint': None,
+        'cohort': None,
+    }
+    DEFAULT_COHORT = {
+        'spacing': None,
+        'margin': 20.0,
+        'bin_width': 0.25,
+        'bin_range': [0.0, 16.0],
+        'percentiles': [5, 50, 95],
+        'min_count': 1,
+    }
+
+    @staticmethod
+    def load_config(path=None):
+        config = dict(BoneThicknessMappingBatch.DEFAULT_CONFIG)
+        if path is not None:
+            with open(path) as f: config.update(json.load(f))
+        # resolve names into the values used by the logic
+        if 'precision' not in config: config['precision'] = BoneThicknessMappingQuality.PRECISION[getattr(BoneThicknessMappingQuality, config['quality'])]
+        if config['depth_preset'] in BoneDepthMappingPresets.RANGES:
+            config['min_max_skull_thickness'], config['min_max_air_cell'] = BoneDepthMappingPresets.RANGES[config['depth_preset']]
+        # one axis or a list of them, all cast from the same segmentation
+        config['axes'] = [a.upper() for a in ([config['axis']] if isinstance(config['axis'], str) else config['axis'])]
+        config['cast_axes'] = [BoneThicknessMappingBatch.AXES[a] for a in config['axes']]
+        config['sampling_mode'] = getattr(BoneThicknessMappingSampling, config['sampling'].upper())
+        config['segmentation_mode'] = getattr(BoneSegmentationMethod, config['segmentation_method'].upper())
+        if config['cohort'] is not None: config['cohort'] = dict(BoneThicknessMappingBatch.DEFAULT_COHORT, **config['cohort'])
+        return config
+
+    @staticmethod
+    def find_volumes(path, rasters=False):
+        # with rasters also the _grid.json of exported rasters in a directory
+        if os.path.isdir(path):
+            return sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(BoneThicknessMappingBatch.VOLUME_EXTENSIONS) or rasters and f.endswith('_grid.json'))
+        # manifest, either a JSON list or one path per line, relative to the manifest
+        with open(path) as f:
+            if path.lower().endswith('.json'): entries = json.load(f)
+            else: entries = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+        return [os.path.join(os.path.dirname(os.path.abspath(path)), e) for e in entries]
+
+    @staticmethod
+    def volume_name(path):
+        name = os.path.basename(path)
+        for extension in BoneThicknessMappingBatch.VOLUME_EXTENSIONS:
+            if name.lower().endswith(extension): return name[:-len(extension)]
+        return name
+
+    @staticmethod
+    def cohort_prefix(config, output_directory, axis_name):
+        return os.path.join(output_directory, 'cohort' + ('_' + axis_name if len(config['axes']) > 1 else ''))
+
+    @staticmethod
+    def load_cohorts(config, output_directory):
+        # cohorts of earlier runs into the same directory keep growing, subjects already in them are not added again
+        cohorts = {}
+        for axisName in config['axes']:
+            statePath = BoneThicknessMappingBatch.cohort_prefix(config, output_directory, axisName) + '_state.npz'
+            if os.path.exists(statePath): cohorts[axisName] = CohortStatistics.CohortAccumulator.load(statePath)
+        return cohorts
+
+    @staticmethod
+    def start_cohort(config, plane, grid_shape, axis_name):
+        cohort = config['cohort']
+        return BoneThicknessMappingLogic.start_cohort(
+            plane, grid_shape, axis_name, spacing=cohort['spacing'], margin=cohort['margin'], cast_plane_box=config['cast_plane_box'],
+            bin_width=cohort['bin_width'], bin_range=cohort['bin_range']
+        )
+
+    @staticmethod
+    def add_raster_grid(path, config, cohorts):
+        # thickness rasters exported by an earlier run go straight into the cohort of their axis
+        with open(path) as f: grid = json.load(f)
+        axisName = grid['cast_axis']
+        if axisName not in config['axes']: raise ValueError('Rasters cast along ' + str(axisName) + ' are not in the configured axes')
+        if axisName not in cohorts:
+            castIndex = 3 - sum(RasterExport.AXIS_NAMES.index(grid[a]) for a in ('row_axis', 'column_axis'))
+            cohorts[axisName] = BoneThicknessMappingBatch.start_cohort(config, (castIndex, grid['origin'], grid['spacing']), grid['shape'], axisName)
+        name = os.path.basename(path)[:-len('_grid.json')]
+        if len(config['axes']) > 1 and name.endswith('_' + axisName): name = name[:-len(axisName) - 1]
+        return {'volume': path, 'status': 'ok', 'axes': {axisName: {'in_cohort': cohorts[axisName].add_grid(path, name)}}}
+
+    @staticmethod
+    def process_volume(path, config, output_directory, update_status, cohorts=None):
+        metrics, startTime = RunMetrics(), time.time()
+        name = BoneThicknessMappingBatch.volume_name(path)
+        with metrics.stage('load'): volume = slicer.util.loadVolume(path)
+        dimensions = volume.GetImageData().GetDimensions()
+        cropBounds = None
+        if config['crop_margin'] is not None:
+            cropBounds = BoneThicknessMappingLogic.crop_bounds(volume, config['cast_axes'], config['region_of_interest'], config['crop_margin'], config['cast_plane_box'])
+        labelmapEngine = config['cast_engine'] == BoneThicknessMappingCastEngine.LABELMAP
+        modelPolyData, segmentationBounds = BoneThicknessMappingLogic.process_segmentation(
+            threshold_range=config['threshold_range'],
+            image=volume,
+            axis=config['cast_axes'][0],
+            update_status=update_status,
+            update_views=False,
+            closed_surface=not labelmapEngine,
+            method=config['segmentation_mode'],
+            crop_bounds=cropBounds,
+            metrics=metrics
+        )
+        segmentedPolyData = None
+        if not labelmapEngine and config['decimation_error'] > 0:
+            segmentedPolyData = modelPolyData
+            modelPolyData = BoneThicknessMappingLogic.decimate_surface(segmentedPolyData, config['decimation_error'], metrics)
+
+        # locators are shared by all axes
+        bspTree, cellLocator = None, None
+        if config['cast_engine'] == BoneThicknessMappingCastEngine.BSP_TREE: bspTree = BoneThicknessMappingLogic.build_bsp_tree(modelPolyData, metrics)
+        if not labelmapEngine and config['thickness_workers'] <= 1:
+            with metrics.stage('locator_build'): cellLocator = ThicknessCalculation.build_cell_locator(modelPolyData)
+        thicknessColourNode, airCellColourNode = BoneThicknessMappingLogic.build_color_table_nodes(
+            minmax_thickness=config['min_max_skull_thickness'],
+            minmax_air_cell=config['min_max_air_cell'],
+            resolution=config['colour_resolution'],
+            metrics=metrics
+        )
+        outputs = {
+            'thickness_colour_table': os.path.join(output_directory, name + '_ThicknessColorMap.ctbl'),
+            'air_cell_colour_table': os.path.join(output_directory, name + '_AirCellColorMap.ctbl'),
+            'metrics': os.path.join(output_directory, name + '_metrics.json'),
+        }
+        with metrics.stage('write'):
+            slicer.util.saveNode(thicknessColourNode, outputs['thickness_colour_table'])
+            slicer.util.saveNode(airCellColourNode, outputs['air_cell_colour_table'])
+
+        axes = collections.OrderedDict()
+        for axisName, castAxis in zip(config['axes'], config['cast_axes']):
+            if config['sampling_mode'] == BoneThicknessMappingSampling.ADAPTIVE:
+                # first-hit and thickness rays are interleaved while refining
+                topLayerPolyData, hitPointGrid, thicknessScalarArray, airCellScalarArray = BoneThicknessMappingLogic.adaptive_quad_cast(
+                    poly_data=modelPolyData,
+                    seg_bounds=segmentationBounds,
+                    cast_axis=castAxis,
+                    precision=config['precision'],
+                    region_of_interest=config['region_of_interest'],
+                    dimensions=dimensions,
+                    mm_of_air_past_bone=config['mm_of_air_past_bone'],
+                    update_status=update_status,
+                    depth_tolerance=config['adaptive_tolerance'][0],
+                    thickness_tolerance=config['adaptive_tolerance'][1],
+                    engine=config['cast_engine'],
+                    workers=config['thickness_workers'],
+                    bsp_tree=bspTree,
+                    cell_locator=cellLocator,
+                    metrics=metrics
+                )
+            elif config['tile_memory_mb'] is not None:
+                topLayerPolyData, hitPointGrid, thicknessScalarArray, airCellScalarArray = BoneThicknessMappingLogic.tiled_quad_cast(
+                    poly_data=modelPolyData,
+                    seg_bounds=segmentationBounds,
+                    cast_axis=castAxis,
+                    precision=config['precision'],
+                    region_of_interest=config['region_of_interest'],
+                    dimensions=dimensions,
+                    mm_of_air_past_bone=config['mm_of_air_past_bone'],
+                    update_status=update_status,
+                    memory_budget_mb=config['tile_memory_mb'],
+                    engine=config['cast_engine'],
+                    workers=config['thickness_workers'],
+                    bsp_tree=bspTree,
+                    cell_locator=cellLocator,
+                    metrics=metrics
+                )
+            else:
+                topLayerPolyData, hitPointGrid = BoneThicknessMappingLogic.rainfall_quad_cast(
+                    poly_data=modelPolyData,
+                    seg_bounds=segmentationBounds,
+                    cast_axis=castAxis,
+                    precision=config['precision'],
+                    region_of_interest=config['region_of_interest'],
+                    update_status=update_status,
+                    engine=config['cast_engine'],
+                    bsp_tree=bspTree,
+                    metrics=metrics
+                )
+                thicknessScalarArray, airCellScalarArray = BoneThicknessMappingLogic.ray_cast_color_thickness(
+                    poly_data=modelPolyData,
+                    hit_point_grid=hitPointGrid,
+                    cast_axis=castAxis,
+                    dimensions=dimensions,
+                    mm_of_air_past_bone=config['mm_of_air_past_bone'],
+                    update_status=update_status,
+                    workers=config['thickness_workers'],
+                    cell_locator=cellLocator,
+                    metrics=metrics
+                )
+            if segmentedPolyData is not None:
+                BoneThicknessMappingLogic.decimation_thickness_change(
+                    segmentedPolyData, hitPointGrid, thicknessScalarArray, castAxis, dimensions, config['mm_of_air_past_bone'], metrics=metrics
+                )
+
+            # one model per axis, named after the volume alone when there is only one
+            prefix = os.path.join(output_directory, name + ('_' + axisName if len(config['axes']) > 1 else ''))
+            paths = BoneThicknessMappingLogic.export_result(
+                prefix, topLayerPolyData, hitPointGrid, thicknessScalarArray, airCellScalarArray, axisName, rasters=config['export_rasters'], metrics=metrics
+            )
+            axes[axisName] = dict(paths, rays=int(hitPointGrid.pid_grid.size), hits=len(hitPointGrid), cells=topLayerPolyData.GetNumberOfCells())
+            footprint = config['implant_footprint']
+            if footprint is not None:
+                axes[axisName]['implant_sites'] = BoneThicknessMappingLogic.find_implant_sites(
+                    hitPointGrid, thicknessScalarArray, getattr(FootprintSearch, footprint.get('shape', 'DISC').upper()), footprint.get('size', [16.0]),
+                    config['min_max_skull_thickness'][1], coverage=footprint.get('coverage', 100.0) / 100.0, count=footprint.get('sites', 5), metrics=metrics
+                )
+            if cohorts is not None:
+                if axisName not in cohorts: cohorts[axisName] = BoneThicknessMappingBatch.start_cohort(config, hitPointGrid.plane, hitPointGrid.pid_grid.shape, axisName)
+                # False when the volume is already part of the cohort
+                axes[axisName]['in_cohort'] = BoneThicknessMappingLogic.add_to_cohort(cohorts[axisName], name, hitPointGrid, thicknessScalarArray, metrics=metrics)
+        metrics.save(outputs['metrics'])
+        timings = dict((stage, record['wall_s']) for stage, record in metrics.stages.items())
+        timings['total'] = time.time() - startTime
+        return {'volume': path, 'status': 'ok', 'outputs': outputs, 'axes': axes, 'timings': timings}
+
+    @staticmethod
+    def run(input_path, config_path, output_directory):
+        config = BoneThicknessMappingBatch.load_config(config_path)
+        if not os.path.isdir(output_directory): os.makedirs(output_directory)
+
+        def update_status(text=None, progress=None):
+            if text is not None: print(text)
+
+        summary = {'config': {k: v for k, v in config.items() if k != 'cast_axes'}, 'volumes': []}
+        cohorts = None if config['cohort'] is None else BoneThicknessMappingBatch.load_cohorts(config, output_directory)
+        for path in BoneThicknessMappingBatch.find_volumes(input_path, rasters=cohorts is not None):
+            print('Processing ' + path)
+            try:
+                if path.endswith('_grid.json'):
+                    if cohorts is None: raise ValueError('Exported rasters can only be added to a cohort')
+                    summary['volumes'].append(BoneThicknessMappingBatch.add_raster_grid(path, config, cohorts))
+                else: summary['volumes'].append(BoneThicknessMappingBatch.process_volume(path, config, output_directory, update_status, cohorts))
+            except Exception as e:
+                summary['volumes'].append({'volume': path, 'status': 'failed', 'error': str(e)})
+                print('Failed to process ' + path + ': ' + str(e))
+            finally:
+                slicer.mrmlScene.Clear(0)
+            # rewrite the summary and cohort state after every volume so an interrupted run still leaves a record
+            for axisName, cohort in (cohorts or {}).items(): cohort.save(BoneThicknessMappingBatch.cohort_prefix(config, output_directory, axisName) + '_state.npz')
+            with open(os.path.join(output_directory, 'summary.json'), 'w') as f: json.dump(summary, f, indent=2)
+        if cohorts:
+            summary['cohort'] = {}
+            for axisName, cohort in cohorts.items():
+                prefix = BoneThicknessMappingBatch.cohort_prefix(config, output_directory, axisName)
+                paths = BoneThicknessMappingLogic.write_cohort(prefix, cohort, config['cohort']['percentiles'], config['cohort']['min_count'])
+                summary['cohort'][axisName] = dict(paths, subjects=len(cohort.subjects), memory_mb=cohort.nbytes / 2.0**20)
+            with open(os.path.join(output_directory, 'summary.json'), 'w') as f: json.dump(summary, f, indent=2)
+        return summary
+
+    @staticmethod
+    def main(argv):
+        parser = argparse.ArgumentParser(description='Run bone thickness mapping on a directory or manifest of volumes.')
+        parser.add_argument('--input', required=True, help='directory of volumes, or a manifest (.txt, one path per line, or .json list)')
+        parser.add_argument('--config', default=None, help='JSON configuration file')
+        parser.add_argument('--output', required=True, help='directory for results and summary.json')
+        args = parser.parse_args(argv)
+        summary = BoneThicknessMappingBatch.run(args.input, args.config, args.output)
+        return 0 if all(v['status'] == 'ok' for v in summary['volumes']) else 1
+
+
+class BoneThicknessMappingBenchmark:
+    # throughput and thickness regression of the logic on analytic phantoms, runs headless without any scan
+    MM_OF_AIR_PAST_BONE = 4.0
+    REGION_OF_INTEREST = [-10000.0, 10000.0]
+    QUALITIES = ['VERY_LOW', 'LOW', 'MEDIUM', 'HIGH', 'VERY_HIGH', 'EXTREME']
+
+    @staticmethod
+    def compare(measured, expected, tolerance):
+        # (median absolute error, share of points within tolerance), None without any point to compare
+        if len(measured) == 0: return None, None
+        error = numpy.abs(measured - expected)
+        return float(numpy.median(error)), float(numpy.mean(error <= tolerance))
+
+    @staticmethod
+    def run_case(phantom, axis, quality, engine=BoneThicknessMappingCastEngine.BSP_TREE, workers=1, tolerance=None, update_status=None, gradient_scale_factor=10.0):
+        metrics = RunMetrics()
+        update_status = update_status if update_status is not None else lambda text=None, progress=None: None
+        castAxis = BoneThicknessMappingBatch.AXES[axis]
+        if engine == BoneThicknessMappingCastEngine.LABELMAP:
+            with metrics.stage('labelmap_extraction'): model = phantom.labelmap()
+            bounds, tolerance = model.bounds(), tolerance if tolerance is not None else model.spacing / 2.0
+        else:
+            model, bounds, tolerance = phantom.poly_data, phantom.bounds(), tolerance if tolerance is not None else 0.1
+        topLayerPolyData, hitPointGrid = BoneThicknessMappingLogic.rainfall_quad_cast(
+            model, bounds, castAxis, BoneThicknessMappingQuality.PRECISION[getattr(BoneThicknessMappingQuality, quality)],
+            BoneThicknessMappingBenchmark.REGION_OF_INTEREST, update_status, engine=engine, metrics=metrics
+        )
+        thicknessArray, airCellArray = BoneThicknessMappingLogic.ray_cast_color_thickness(
+            model, hitPointGrid, castAxis, phantom.dimensions, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE, update_status,
+            gradient_scale_factor=gradient_scale_factor, workers=workers, metrics=metrics
+        )
+
+        # recovered against analytic thickness and air cell distance, in mm
+        checked, expectedThickness, expectedAirCell = phantom.expected(hitPointGrid.points, hitPointGrid.normals)
+        thickness = numpy_support.vtk_to_numpy(thicknessArray)[:len(hitPointGrid)] / gradient_scale_factor
+        airCell = numpy_support.vtk_to_numpy(airCellArray)[:len(hitPointGrid)] / gradient_scale_factor
+        thicknessError, thicknessWithin = BoneThicknessMappingBenchmark.compare(thickness[checked], expectedThickness[checked], tolerance)
+        airChecked = checked & ~numpy.isnan(expectedAirCell)
+        airCellError, airCellWithin = BoneThicknessMappingBenchmark.compare(airCell[airChecked], expectedAirCell[airChecked], tolerance)
+        passed = None
+        if thicknessError is not None:
+            passed = thicknessError <= tolerance and thicknessWithin >= 0.9 and (airCellError is None or (airCellError <= tolerance and airCellWithin >= 0.9))
+
+        # every ray, checked or not, against the serial per-cell search, which the multi-hit and worker paths reproduce exactly
+        mismatched = None
+        if engine != BoneThicknessMappingCastEngine.LABELMAP:
+            referenceThickness, referenceAirCell = ThicknessCalculation.calculate_thickness(
+                model, ThicknessCalculation.build_cell_locator(model), hitPointGrid.points, hitPointGrid.normals,
+                phantom.dimensions[BoneThicknessMappingLogic.determine_cast_axis_index(castAxis)], BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE,
+                gradient_scale_factor, multi_hit=False
+            )
+            mismatched = int(numpy.count_nonzero(
+                (numpy_support.vtk_to_numpy(thicknessArray)[:len(hitPointGrid)] != numpy.float32(referenceThickness)) |
+                (numpy_support.vtk_to_numpy(airCellArray)[:len(hitPointGrid)] != numpy.float32(referenceAirCell))
+            ))
+            if mismatched: passed = False
+
+        def rate(counter, stage):
+            wall = metrics.stages.get(stage, {}).get('wall_s')
+            return metrics.counters.get(counter, 0) / wall if wall else None
+        peaks = [record['peak_rss_mb'] for record in metrics.stages.values() if record['peak_rss_mb'] is not None]
+        return {
+            'phantom': phantom.name, 'axis': axis, 'quality': quality, 'engine': engine,
+            'rays': metrics.counters.get('first_hit_rays', 0), 'hits': len(hitPointGrid), 'cells': topLayerPolyData.GetNumberOfCells(),
+            'first_hit_rays_per_s': rate('first_hit_rays', 'first_hit_cast'), 'thickness_rays_per_s': rate('thickness_rays', 'thickness_cast'),
+            'peak_rss_mb': max(peaks) if peaks else None,
+            'checked': int(numpy.count_nonzero(checked)), 'tolerance_mm': tolerance,
+            'thickness_error_mm': thicknessError, 'thickness_within': thicknessWithin,
+            'air_cell_error_mm': airCellError, 'air_cell_within': airCellWithin, 'mismatched_rays': mismatched,
+            'passed': passed, 'metrics': metrics.as_dict(),
+        }
+
+    @staticmethod
+    def run(phantoms=None, qualities=None, axes=None, engine=BoneThicknessMappingCastEngine.BSP_TREE, workers=1, tolerance=None, output_path=None):
+        phantoms = phantoms if phantoms is not None else Phantoms.all_phantoms()
+        qualities = qualities if qualities is not None else BoneThicknessMappingBenchmark.QUALITIES
+        axes = axes if axes is not None else list(BoneThicknessMappingBatch.AXES.keys())
+        report = []
+        for phantom in phantoms:
+            for quality in qualities:
+                for axis in axes:
+                    case = BoneThicknessMappingBenchmark.run_case(phantom, axis, quality, engine=engine, workers=workers, tolerance=tolerance)
+                    report.append(case)
+                    print('%-16s %-9s %s %8d rays %10s first hit rays/s %10s thickness rays/s %6s MB  error %s mm  %s mismatched  %s' % (
+                        case['phantom'], case['quality'], case['axis'], case['rays'],
+                        '%.0f' % case['first_hit_rays_per_s'] if case['first_hit_rays_per_s'] else '-',
+                        '%.0f' % case['thickness_rays_per_s'] if case['thickness_rays_per_s'] else '-',
+                        '%.0f' % case['peak_rss_mb'] if case['peak_rss_mb'] is not None else '-',
+                        '%.3f' % case['thickness_error_mm'] if case['thickness_error_mm'] is not None else '-',
+                        case['mismatched_rays'] if case['mismatched_rays'] is not None else '-',
+                        {True: 'ok', False: 'FAILED', None: 'unchecked'}[case['passed']]
+                    ))
+                    # rewrite the report after every case so an interrupted run still leaves a record
+                    if output_path is not None:
+                        with open(output_path, 'w') as f: json.dump(report, f, indent=2)
+        return report
+
+    @staticmethod
+    def main(argv):
+        parser = argparse.ArgumentParser(description='Benchmark bone thickness mapping on analytic phantoms.')
+        parser.add_argument('--phantom', action='append', choices=[p.name for p in Phantoms.all_phantoms()], help='phantom to cast, repeat for several (default all)')
+        parser.add_argument('--quality', action='append', choices=BoneThicknessMappingBenchmark.QUALITIES, help='quality level, repeat for several (default all)')
+        parser.add_argument('--axis', action='append', choices=list(BoneThicknessMappingBatch.AXES.keys()), help='cast axis, repeat for several (default all)')
+        parser.add_argument('--engine', default='BSP_TREE', choices=['BSP_TREE', 'Z_BUFFER', 'LABELMAP'])
+        parser.add_argument('--workers', type=int, default=1, help='thickness worker processes')
+        parser.add_argument('--tolerance', type=float, default=None, help='allowed thickness error in mm (default 0.1, half a voxel for the labelmap engine)')
+        parser.add_argument('--output', default=None, help='JSON report')
+        args = parser.parse_args(argv)
+        phantoms = [p for p in Phantoms.all_phantoms() if args.phantom is None or p.name in args.phantom]
+        report = BoneThicknessMappingBenchmark.run(phantoms, args.quality, args.axis, getattr(BoneThicknessMappingCastEngine, args.engine), args.workers, args.tolerance, args.output)
+        return 0 if all(case['passed'] is not False for case in report) else 1
+
+
+class BoneThicknessMappingTest(ScriptedLoadableModuleTest):
+    def setUp(self):
+        slicer.mrmlScene.Clear(0)
+
+    def runTest(self):
+        self.setUp()
+        self.test_phantom_thickness()
+        self.test_footprint_search()
+        self.test_multi_hit_crossings()
+        self.test_tiled_cast()
+        self.test_parallel_thickness()
+
+    def test_phantom_thickness(self):
+        # quick subset of the benchmark, BoneThicknessMappingLib/Benchmark.py sweeps every quality level and axis
+        self.delayDisplay('Casting analytic phantoms')
+        for case in BoneThicknessMappingBenchmark.run(qualities=['LOW'], axes=['L', 'S']):
+            self.assertNotEqual(case['passed'], False, '%s cast from %s is off by %s mm' % (case['phantom'], case['axis'], case['thickness_error_mm']))
+        self.delayDisplay('Test passed')
+
+    def test_footprint_search(self):
+        # footprint minima against brute force on small random grids, and no sites where the footprint outgrows the grid
+        self.delayDisplay('Searching footprints')
+        random = numpy.random.default_rng(0)
+        for trial in range(40):
+            raster = random.uniform(0.0, 10.0, random.integers(1, 24, 2)).astype(numpy.float32)
+            raster[random.random(raster.shape) < 0.1] = numpy.nan
+            shape = (FootprintSearch.DISC, FootprintSearch.RECTANGLE)[trial % 2]
+            bands = FootprintSearch.footprint_bands(shape, random.uniform(0.5, 30.0, 2), 1.0)
+            offsets = [(di, dj) for first, last, half in bands for di in range(first, last + 1) for dj in range(-half, half + 1)]
+            padded = numpy.pad(numpy.nan_to_num(raster, nan=-numpy.inf), 32, constant_values=-numpy.inf)
+            expected = numpy.min([padded[32 + di:32 + di + raster.shape[0], 32 + dj:32 + dj + raster.shape[1]] for di, dj in offsets], axis=0)
+            self.assertTrue(numpy.array_equal(FootprintSearch.footprint_minimum(raster, bands), expected))
+        self.assertEqual(FootprintSearch.find_sites(numpy.full((8, 200), 5.0, numpy.float32), 0.5, FootprintSearch.DISC, [12.0], 2.0), [])
+        self.assertEqual(FootprintSearch.find_sites(numpy.full((200, 8), 5.0, numpy.float32), 0.5, FootprintSearch.RECTANGLE, [4.0, 12.0], 2.0, 0.9), [])
+        self.delayDisplay('Test passed')
+
+    def test_multi_hit_crossings(self):
+        # the multi-hit query has to give the thickness of the per-cell search on every ray, also on rays lying in a flat face
+        if not ThicknessCalculation.MULTI_HIT_LOCATOR: return
+        self.delayDisplay('Comparing thickness crossing searches')
+        for phantom in Phantoms.all_phantoms():
+            cellLocator = ThicknessCalculation.build_cell_locator(phantom.poly_data)
+            for axis in ['L', 'S', 'P']:
+                castAxis = BoneThicknessMappingBatch.AXES[axis]
+                topLayerPolyData, hitPointGrid = BoneThicknessMappingLogic.rainfall_quad_cast(
+                    phantom.poly_data, phantom.bounds(), castAxis, 1.0, BoneThicknessMappingBenchmark.REGION_OF_INTEREST, lambda text=None, progress=None: None
+                )
+                stretchFactor = phantom.dimensions[BoneThicknessMappingLogic.determine_cast_axis_index(castAxis)]
+                multiHit, perCell = [ThicknessCalculation.calculate_thickness(
+                    phantom.poly_data, cellLocator, hitPointGrid.points, hitPointGrid.normals, stretchFactor, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE, multi_hit=multi
+                ) for multi in [True, False]]
+                for name, a, b in zip(['thickness', 'air cell distance'], multiHit, perCell):
+                    self.assertTrue(numpy.array_equal(a, b), '%s cast from %s: %s differs on %d rays' % (phantom.name, axis, name, numpy.count_nonzero(a != b)))
+        self.delayDisplay('Test passed')
+
+    def test_tiled_cast(self):
+        # a budget small enough to split the cast into several tiles must not change any point, quad or value
+        self.delayDisplay('Comparing tiled and whole casts')
+        noStatus = lambda text=None, progress=None: None
+        for phantom in Phantoms.all_phantoms():
+            for engine in [BoneThicknessMappingCastEngine.BSP_TREE, BoneThicknessMappingCastEngine.Z_BUFFER, BoneThicknessMappingCastEngine.LABELMAP]:
+                model = phantom.labelmap() if engine == BoneThicknessMappingCastEngine.LABELMAP else phantom.poly_data
+                bounds = model.bounds() if engine == BoneThicknessMappingCastEngine.LABELMAP else phantom.bounds()
+                for axis in ['L', 'S']:
+                    castAxis = BoneThicknessMappingBatch.AXES[axis]
+                    topLayerPolyData, hitPointGrid = BoneThicknessMappingLogic.rainfall_quad_cast(
+                        model, bounds, castAxis, 2.0, BoneThicknessMappingBenchmark.REGION_OF_INTEREST, noStatus, engine=engine
+                    )
+                    thicknessArray, airCellArray = BoneThicknessMappingLogic.ray_cast_color_thickness(
+                        model, hitPointGrid, castAxis, phantom.dimensions, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE, noStatus
+                    )
+                    metrics = RunMetrics()
+                    tiledPolyData, tiledHitPointGrid, tiledThicknessArray, tiledAirCellArray = BoneThicknessMappingLogic.tiled_quad_cast(
+                        model, bounds, castAxis, 2.0, BoneThicknessMappingBenchmark.REGION_OF_INTEREST, phantom.dimensions, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE,
+                        noStatus, memory_budget_mb=0.05, engine=engine, metrics=metrics
+                    )
+                    case = '%s %s cast from %s' % (phantom.name, engine, axis)
+                    self.assertGreater(metrics.counters['tiles'], 1, case)
+                    for name, a, b in [
+                        ('points', hitPointGrid.points, tiledHitPointGrid.points),
+                        ('pid grid', hitPointGrid.pid_grid, tiledHitPointGrid.pid_grid),
+                        ('connectivity', numpy_support.vtk_to_numpy(topLayerPolyData.GetPolys().GetConnectivityArray()), numpy_support.vtk_to_numpy(tiledPolyData.GetPolys().GetConnectivityArray())),
+                        ('offsets', numpy_support.vtk_to_numpy(topLayerPolyData.GetPolys().GetOffsetsArray()), numpy_support.vtk_to_numpy(tiledPolyData.GetPolys().GetOffsetsArray())),
+                        ('thickness', numpy_support.vtk_to_numpy(thicknessArray), numpy_support.vtk_to_numpy(tiledThicknessArray)),
+                        ('air cell distance', numpy_support.vtk_to_numpy(airCellArray), numpy_support.vtk_to_numpy(tiledAirCellArray)),
+                    ]:
+                        self.assertTrue(numpy.array_equal(a, b), '%s: %s differs' % (case, name))
+        self.delayDisplay('Test passed')
+
+    def test_parallel_thickness(self):
+        # worker processes have to give the serial values, merged back by point id whatever order the shards finish in
+        self.delayDisplay('Comparing serial and parallel thickness')
+        for phantom in Phantoms.all_phantoms():
+            castAxis = BoneThicknessMappingBatch.AXES['L']
+            topLayerPolyData, hitPointGrid = BoneThicknessMappingLogic.rainfall_quad_cast(
+                phantom.poly_data, phantom.bounds(), castAxis, 1.0, BoneThicknessMappingBenchmark.REGION_OF_INTEREST, lambda text=None, progress=None: None
+            )
+            stretchFactor = phantom.dimensions[BoneThicknessMappingLogic.determine_cast_axis_index(castAxis)]
+            serial = ThicknessCalculation.calculate_thickness(
+                phantom.poly_data, ThicknessCalculation.build_cell_locator(phantom.poly_data), hitPointGrid.points, hitPointGrid.normals, stretchFactor, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE
+            )
+            pids = numpy.random.RandomState(0).permutation(len(hitPointGrid))
+            parallel = ThicknessCalculation.calculate_thickness_parallel(
+                phantom.poly_data, pids, hitPointGrid.points[pids], hitPointGrid.normals[pids], stretchFactor, BoneThicknessMappingBenchmark.MM_OF_AIR_PAST_BONE, 3,
+                executable=BoneThicknessMappingLogic.thickness_worker_executable()
+            )
+            for name, a, b in zip(['thickness', 'air cell distance'], serial, parallel):
+                self.assertTrue(numpy.array_equal(a, b), '%s: %s differs on %d rays' % (phantom.name, name, numpy.count_nonzero(a != b)))
+        self.delayDisplay('Test passed')
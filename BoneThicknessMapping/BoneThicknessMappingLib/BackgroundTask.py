@@ -0,0 +1,62 @@
+# Runs a compute stage on a worker thread. The stage reports through a ProgressChannel, which only keeps the latest
+# status for the main thread to pick up at its own pace and raises Cancelled in the worker once cancel() was called.
+import collections
+import threading
+
+
+class Cancelled(Exception):
+    pass
+
+
+class ProgressChannel:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._text, self._progress, self._changed = None, None, False
+        self._posted = collections.deque()
+
+    def update_status(self, text=None, progress=None):
+        # same signature as the widget's update_status, cheap enough to call for every few rays
+        if self._cancelled.is_set(): raise Cancelled()
+        with self._lock:
+            if text is not None: self._text = text
+            if progress is not None: self._progress = progress
+            self._changed = True
+
+    def post(self, function, *args):
+        # queue a call for the main thread, e.g. anything touching the MRML scene
+        if self._cancelled.is_set(): raise Cancelled()
+        self._posted.append((function, args))
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def take_status(self):
+        # latest (text, progress) since the previous call, or None if nothing changed
+        with self._lock:
+            if not self._changed: return None
+            self._changed = False
+            return self._text, self._progress
+
+    def take_posted(self):
+        posted = []
+        while self._posted: posted.append(self._posted.popleft())
+        return posted
+
+
+class BackgroundTask(threading.Thread):
+    def __init__(self, function, channel, **kwargs):
+        threading.Thread.__init__(self, daemon=True)
+        self.function, self.channel, self.kwargs = function, channel, kwargs
+        self.value, self.error = None, None
+
+    def run(self):
+        try: self.value = self.function(update_status=self.channel.update_status, **self.kwargs)
+        except BaseException as e: self.error = e
+
+    def result(self):
+        if self.error is not None: raise self.error
+        return self.value
@@ -0,0 +1,8 @@
+# Headless entry point for processing many volumes, run with:
+#   Slicer --no-main-window --python-script <module directory>/BoneThicknessMappingLib/BatchProcessing.py --input <directory or manifest> --config <config.json> --output <directory>
+# Slicer imports stay inside the main guard so worker processes started by multiprocessing can load this file.
+import sys
+
+if __name__ == '__main__':
+    from BoneThicknessMapping import BoneThicknessMappingBatch
+    sys.exit(BoneThicknessMappingBatch.main(sys.argv[1:]))
@@ -0,0 +1,8 @@
+# Headless benchmark of the logic on analytic phantoms, needs no scan or display, run with:
+#   Slicer --no-main-window --python-script <module directory>/BoneThicknessMappingLib/Benchmark.py [--quality LOW] [--axis S] [--output report.json]
+# Slicer imports stay inside the main guard so worker processes started by multiprocessing can load this file.
+import sys
+
+if __name__ == '__main__':
+    from BoneThicknessMapping import BoneThicknessMappingBenchmark
+    sys.exit(BoneThicknessMappingBenchmark.main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+# Running per-cell statistics of the thickness maps of many subjects on one cast-plane frame, in memory set by the frame
+# alone and not by the number of subjects. Count, mean and variance are Welford updates, minimum and maximum are exact,
+# and percentiles come from a fixed-bin histogram sketch of every cell, interpolated within the bin. Subjects must share
+# one coordinate space (e.g. registered scans); each raster is sampled nearest-neighbour onto the frame.
+import json
+import os
+
+import numpy
+
+
+def covering_frame(low, high, spacing):
+    # (shape, origin) of the frame with the given spacing from low to at least high, both (row, column) in RAS mm
+    shape = tuple(int(numpy.floor((h - l) / spacing + 1e-9)) + 1 for l, h in zip(low, high))
+    return shape, tuple(float(l) for l in low)
+
+
+class CohortAccumulator:
+    HISTOGRAM_DTYPE = numpy.uint16  # subjects a histogram bin can count
+
+    def __init__(self, shape, origin, spacing, row_axis, column_axis, cast_axis=None, bin_width=0.25, bin_range=(0.0, 16.0)):
+        self.shape, self.origin, self.spacing = tuple(int(s) for s in shape), tuple(float(o) for o in origin), float(spacing)
+        self.row_axis, self.column_axis, self.cast_axis = row_axis, column_axis, cast_axis
+        self.bin_width, self.bin_range = float(bin_width), (float(bin_range[0]), float(bin_range[1]))
+        self.subjects = []
+        self.count = numpy.zeros(self.shape, dtype=numpy.uint32)
+        self.mean = numpy.zeros(self.shape, dtype=numpy.float64)
+        self.m2 = numpy.zeros(self.shape, dtype=numpy.float64)
+        self.minimum = numpy.full(self.shape, numpy.inf, dtype=numpy.float32)
+        self.maximum = numpy.full(self.shape, -numpy.inf, dtype=numpy.float32)
+        # mean surface depth along the cast axis, to place the summary model
+        self.depth_count = numpy.zeros(self.shape, dtype=numpy.uint32)
+        self.depth_mean = numpy.zeros(self.shape, dtype=numpy.float64)
+        bins = int(round((self.bin_range[1] - self.bin_range[0]) / self.bin_width))
+        self.histogram = numpy.zeros(self.shape + (bins,), dtype=self.HISTOGRAM_DTYPE)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.count, self.mean, self.m2, self.minimum, self.maximum, self.depth_count, self.depth_mean, self.histogram))
+
+    def frame_axes(self, row_axis, column_axis, cast_axis=None):
+        if (row_axis, column_axis) != (self.row_axis, self.column_axis) or (None not in (cast_axis, self.cast_axis) and cast_axis != self.cast_axis):
+            raise ValueError('Raster cast along %s (%s, %s) does not match the cohort frame cast along %s (%s, %s)' % (cast_axis, row_axis, column_axis, self.cast_axis, self.row_axis, self.column_axis))
+
+    def add(self, name, raster, origin, spacing, depth=None, rows_per_block=256):
+        # raster is (rows, columns) of thickness in mm, nan where the ray missed, with element [0, 0] at origin;
+        # depth the surface position along the cast axis on the same grid. False if name is already in the cohort.
+        if name in self.subjects: return False
+        if len(self.subjects) >= numpy.iinfo(self.HISTOGRAM_DTYPE).max: raise ValueError('The cohort histograms are full')
+        # nearest subject element of every frame row and column, -1 where the frame reaches past the raster
+        nearest = []
+        for axis in range(2):
+            index = numpy.round((self.origin[axis] + numpy.arange(self.shape[axis]) * self.spacing - origin[axis]) / spacing).astype(numpy.int64)
+            nearest.append(numpy.where((index >= 0) & (index < raster.shape[axis]), index, -1))
+        columns = numpy.flatnonzero(nearest[1] >= 0)
+        rows = numpy.flatnonzero(nearest[0] >= 0)
+        bins = self.histogram.shape[2]
+        for start in range(0, len(rows), rows_per_block):
+            frameRows = rows[start:start + rows_per_block]
+            block = numpy.asarray(raster[numpy.ix_(nearest[0][frameRows], nearest[1][columns])], dtype=numpy.float64)
+            r, c = numpy.nonzero(~numpy.isnan(block))
+            x, i, j = block[r, c], frameRows[r], columns[c]
+            n = self.count[i, j] + 1
+            delta = x - self.mean[i, j]
+            mean = self.mean[i, j] + delta / n
+            self.m2[i, j] += delta * (x - mean)
+            self.mean[i, j], self.count[i, j] = mean, n
+            self.minimum[i, j] = numpy.minimum(self.minimum[i, j], x)
+            self.maximum[i, j] = numpy.maximum(self.maximum[i, j], x)
+            # every cell appears once per subject, so the bins can be incremented by fancy indexing
+            self.histogram[i, j, numpy.clip(((x - self.bin_range[0]) / self.bin_width).astype(numpy.int64), 0, bins - 1)] += 1
+            if depth is not None:
+                block = numpy.asarray(depth[numpy.ix_(nearest[0][frameRows], nearest[1][columns])], dtype=numpy.float64)
+                r, c = numpy.nonzero(~numpy.isnan(block))
+                i, j = frameRows[r], columns[c]
+                self.depth_count[i, j] += 1
+                self.depth_mean[i, j] += (block[r, c] - self.depth_mean[i, j]) / self.depth_count[i, j]
+        self.subjects.append(name)
+        return True
+
+    def add_grid(self, grid_path, name=None):
+        # thickness and depth rasters written by RasterExport, read a block of rows at a time from the mapped files
+        with open(grid_path) as f: grid = json.load(f)
+        self.frame_axes(grid['row_axis'], grid['column_axis'], grid.get('cast_axis'))
+        directory = os.path.dirname(os.path.abspath(grid_path))
+        thickness = numpy.load(os.path.join(directory, grid['files']['thickness']), mmap_mode='r')
+        depth = numpy.load(os.path.join(directory, grid['files']['depth']), mmap_mode='r') if 'depth' in grid['files'] else None
+        if name is None: name = os.path.basename(grid_path)[:-len('_grid.json')]
+        return self.add(name, thickness, grid['origin'], grid['spacing'], depth)
+
+    def percentile(self, q, rows_per_block=64):
+        # q in [0, 100], nan where a cell has no samples; exact minimum and maximum bound the interpolation
+        if q <= 0 or q >= 100: return numpy.where(self.count > 0, self.minimum if q <= 0 else self.maximum, numpy.nan).astype(numpy.float32)
+        result = numpy.full(self.shape, numpy.nan, dtype=numpy.float32)
+        for start in range(0, self.shape[0], rows_per_block):
+            block = slice(start, start + rows_per_block)
+            histogram = self.histogram[block]
+            cumulative = numpy.cumsum(histogram, axis=2, dtype=numpy.uint32)
+            # rank of the percentile, each sample taken as a unit of mass centred on its value
+            target = q / 100.0 * (self.count[block] - 1.0) + 0.5
+            b = numpy.minimum((cumulative < target[..., None]).sum(axis=2), histogram.shape[2] - 1)[..., None]
+            inBin = numpy.take_along_axis(histogram, b, axis=2)[..., 0]
+            before = numpy.take_along_axis(cumulative, b, axis=2)[..., 0] - inBin
+            # the end bins also hold everything past the range, they stretch out to the cell's minimum and maximum
+            b = b[..., 0]
+            lower, upper = self.bin_range[0] + b * self.bin_width, self.bin_range[0] + (b + 1) * self.bin_width
+            with numpy.errstate(invalid='ignore'):
+                lower = numpy.where(b == 0, numpy.minimum(lower, self.minimum[block]), lower)
+                upper = numpy.where(b == histogram.shape[2] - 1, numpy.maximum(upper, self.maximum[block]), upper)
+                value = numpy.clip(lower + (target - before) / numpy.maximum(inBin, 1) * (upper - lower), self.minimum[block], self.maximum[block])
+            result[block] = numpy.where(self.count[block] > 0, value, numpy.nan)
+        return result
+
+    def summary(self, percentiles=(5, 50, 95), min_count=1):
+        # float32 rasters in mm by statistic name ('p5' etc. for percentiles), nan below min_count subjects, and the
+        # mean depth; std is the sample standard deviation, nan below two subjects
+        shown = self.count >= max(min_count, 1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rasters = {
+                'mean': self.mean,
+                'std': numpy.where(self.count > 1, numpy.sqrt(self.m2 / (self.count.astype(numpy.float64) - 1)), numpy.nan),
+                'min': self.minimum,
+                'max': self.maximum,
+            }
+        for q in percentiles: rasters['p%g' % q] = self.percentile(q)
+        rasters = dict((name, numpy.where(shown, raster, numpy.nan).astype(numpy.float32)) for name, raster in rasters.items())
+        rasters['depth'] = numpy.where(shown & (self.depth_count > 0), self.depth_mean, numpy.nan).astype(numpy.float32)
+        return rasters
+
+    def write_rasters(self, prefix, rasters):
+        # <prefix>_<statistic>.npy, <prefix>_count.npy and <prefix>_grid.json, laid out like RasterExport's
+        paths = {'grid': prefix + '_grid.json', 'count': prefix + '_count.npy'}
+        numpy.save(paths['count'], self.count)
+        for name, raster in rasters.items():
+            paths[name] = prefix + '_' + name + '.npy'
+            numpy.save(paths[name], raster)
+        grid = {
+            'shape': list(self.shape),
+            'origin': list(self.origin),
+            'spacing': self.spacing,
+            'row_axis': self.row_axis,
+            'column_axis': self.column_axis,
+            'cast_axis': self.cast_axis,
+            'units': 'mm',
+            'subjects': list(self.subjects),
+            'files': dict((name, os.path.basename(path)) for name, path in paths.items() if name != 'grid'),
+        }
+        with open(paths['grid'], 'w') as f: json.dump(grid, f, indent=2)
+        return paths
+
+    def save(self, path):
+        # whole state, so that a cohort can keep growing over several runs
+        numpy.savez(
+            path, count=self.count, mean=self.mean, m2=self.m2, minimum=self.minimum, maximum=self.maximum, depth_count=self.depth_count,
+            depth_mean=self.depth_mean, histogram=self.histogram, subjects=numpy.array(self.subjects, dtype=str),
+            frame=numpy.array(json.dumps({
+                'shape': self.shape, 'origin': self.origin, 'spacing': self.spacing, 'row_axis': self.row_axis, 'column_axis': self.column_axis,
+                'cast_axis': self.cast_axis, 'bin_width': self.bin_width, 'bin_range': self.bin_range,
+            }))
+        )
+        return path
+
+    @staticmethod
+    def load(path):
+        with numpy.load(path) as state:
+            cohort = CohortAccumulator(**json.loads(str(state['frame'])))
+            for name in ['count', 'mean', 'm2', 'minimum', 'maximum', 'depth_count', 'depth_mean', 'histogram']: getattr(cohort, name)[...] = state[name]
+            cohort.subjects = [str(s) for s in state['subjects']]
+        return cohort
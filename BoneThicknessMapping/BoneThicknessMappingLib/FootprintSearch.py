@@ -0,0 +1,177 @@
+# Search of a thickness map for implant sites, places where a disc or rectangle footprint centred on a cast-plane grid
+# position lies on bone that is deep enough. Footprints are split into bands, runs of footprint rows of the same width,
+# so that the minimum under every position comes from separable sliding-window minima (van Herk/Gil-Werman, constant
+# cost per element whatever the window) and the share of clearing cells from a summed-area table. Only needs numpy.
+import numpy
+
+DISC = 'disc'
+RECTANGLE = 'rectangle'
+
+
+def grid_raster(pid_grid, values, max_gap=0):
+    # float32 (rows, columns) of values per point id, nan where the ray missed; gaps of up to max_gap cells between
+    # samples, the unsampled inside of adaptive leaves, are interpolated first along rows and then along columns
+    raster = numpy.full(pid_grid.shape, numpy.nan, dtype=numpy.float32)
+    hit = pid_grid >= 0
+    raster[hit] = values[pid_grid[hit]]
+    if max_gap > 1:
+        raster = fill_gaps(raster, max_gap)
+        raster = fill_gaps(raster.T, max_gap).T
+    return raster
+
+
+def fill_gaps(raster, max_gap):
+    known = ~numpy.isnan(raster)
+    n = raster.shape[1]
+    index = numpy.broadcast_to(numpy.arange(n), raster.shape)
+    previous = numpy.maximum.accumulate(numpy.where(known, index, -1), axis=1)
+    following = numpy.minimum.accumulate(numpy.where(known, index, n)[:, ::-1], axis=1)[:, ::-1]
+    fill = ~known & (previous >= 0) & (following < n) & (following - previous <= max_gap)
+    rows, columns = numpy.nonzero(fill)
+    p, f = previous[rows, columns], following[rows, columns]
+    filled = raster.copy()
+    filled[rows, columns] = raster[rows, p] + (columns - p) / (f - p) * (raster[rows, f] - raster[rows, p])
+    return filled
+
+
+def footprint_bands(shape, size, precision):
+    # (first row offset, last row offset, half width) in grid cells; a disc is sized by its diameter, a rectangle by
+    # its (row axis, column axis) extent in mm
+    if shape == DISC:
+        radius = size[0] / 2.0 / precision
+        offsets = numpy.arange(-int(radius), int(radius) + 1)
+        halves = numpy.floor(numpy.sqrt(numpy.maximum(radius ** 2 - offsets ** 2, 0.0))).astype(int)
+    elif shape == RECTANGLE:
+        offsets = numpy.arange(-int(size[0] / 2.0 / precision), int(size[0] / 2.0 / precision) + 1)
+        halves = numpy.full(len(offsets), int(size[1] / 2.0 / precision))
+    else: raise ValueError('Unknown footprint shape ' + str(shape))
+    bands, start = [], 0
+    for k in range(1, len(offsets) + 1):
+        if k == len(offsets) or halves[k] != halves[start]:
+            bands.append((int(offsets[start]), int(offsets[k - 1]), int(halves[start])))
+            start = k
+    return bands
+
+
+def window_min(a, first, last, fill=-numpy.inf):
+    # min of a[i + first .. i + last] along the first axis, fill outside of a; blocks of whole rows keep the
+    # accumulation vectorized over the other axis
+    n, k, front = a.shape[0], last - first + 1, max(0, -first)
+    length = -(-max(n + front, n - 1 + first + front + k) // k) * k
+    padded = numpy.full((length,) + a.shape[1:], fill, dtype=a.dtype)
+    padded[front:front + n] = a
+    blocks = padded.reshape((length // k, k) + a.shape[1:])
+    forward = numpy.minimum.accumulate(blocks, axis=1).reshape(padded.shape)
+    backward = numpy.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(padded.shape)
+    start = first + front
+    return numpy.minimum(backward[start:start + n], forward[start + k - 1:start + k - 1 + n])
+
+
+def shifted_minimum(minimum, a, shift):
+    # minimum[i] = min(minimum[i], a[i + shift]) in place, -inf past the end of a
+    n = len(a)
+    if abs(shift) >= n:
+        # the shift reaches past the whole of a, e.g. a footprint taller or wider than the grid
+        minimum[...] = -numpy.inf
+    elif shift >= 0:
+        numpy.minimum(minimum[:n - shift], a[shift:], out=minimum[:n - shift])
+        minimum[n - shift:] = -numpy.inf
+    else:
+        numpy.minimum(minimum[-shift:], a[:n + shift], out=minimum[-shift:])
+        minimum[:-shift] = -numpy.inf
+
+
+def footprint_minimum(raster, bands):
+    # lowest value under the footprint at every position, -inf where it reaches past the grid or over a miss. Each
+    # band width is a row window, grown from the previous, narrower one by two shifted minima where it can be; short
+    # bands are then gathered row by row with shifts, tall ones with a column window.
+    values = numpy.where(numpy.isnan(raster), -numpy.inf, raster)
+    minimum = numpy.full(raster.shape, numpy.inf, dtype=raster.dtype)
+    previousHalf, rowMinimum = 0, values
+    for half in sorted(set(half for first, last, half in bands)):
+        growth = half - previousHalf
+        if 0 < growth <= previousHalf:
+            grown = numpy.full_like(rowMinimum, numpy.inf)
+            shifted_minimum(grown.T, rowMinimum.T, -growth)
+            shifted_minimum(grown.T, rowMinimum.T, growth)
+            rowMinimum = grown
+        elif growth > 0:
+            rowMinimum = numpy.ascontiguousarray(window_min(numpy.ascontiguousarray(values.T), -half, half).T)
+        previousHalf = half
+        for first, last, h in bands:
+            if h != half: continue
+            if last - first < 4:
+                for shift in range(first, last + 1): shifted_minimum(minimum, rowMinimum, shift)
+            else: numpy.minimum(minimum, window_min(rowMinimum, first, last), out=minimum)
+    return minimum
+
+
+def summed_area_table(a, dtype=numpy.float64):
+    # counts are exact and quicker to difference as integers
+    table = numpy.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype=dtype)
+    table[1:, 1:] = numpy.cumsum(numpy.cumsum(a, axis=0, dtype=dtype), axis=1)
+    return table
+
+
+def footprint_sum(table, bands, rows=None, columns=None):
+    # sum under the footprint at the given positions of the table's grid (all of them by default), cells past the
+    # grid count as zero; the table is edge padded so that every band is a difference of shifted slices
+    n, m = table.shape[0] - 1, table.shape[1] - 1
+    reach = max(max(-first, last) for first, last, half in bands) + 1, max(half for first, last, half in bands) + 1
+    padded = numpy.pad(table, ((reach[0], reach[0]), (reach[1], reach[1])), mode='edge')
+    if rows is None:
+        total = numpy.zeros((n, m), dtype=table.dtype)
+        for half in set(half for first, last, half in bands):
+            # prefix sums of every row window of this width
+            widths = padded[:, reach[1] + half + 1:reach[1] + half + 1 + m] - padded[:, reach[1] - half:reach[1] - half + m]
+            for first, last, h in bands:
+                if h != half: continue
+                total += widths[reach[0] + last + 1:reach[0] + last + 1 + n]
+                total -= widths[reach[0] + first:reach[0] + first + n]
+        return total
+    i, j = numpy.asarray(rows) + reach[0], numpy.asarray(columns) + reach[1]
+    total = numpy.zeros(len(i), dtype=table.dtype)
+    for first, last, half in bands:
+        total += padded[i + last + 1, j + half + 1] - padded[i + first, j + half + 1] - padded[i + last + 1, j - half] + padded[i + first, j - half]
+    return total
+
+
+def find_sites(raster, precision, shape, size, required_depth, coverage=1.0, count=5, separation=None):
+    # best count positions as (row, column, minimum, share, mean), thickness in raster units. With full coverage a
+    # site needs the required depth under its whole footprint and sites rank by their minimum; with less, that share
+    # of the footprint must clear it and sites rank by their share, then by their minimum.
+    bands = footprint_bands(shape, size, precision)
+    cells = float(sum((last - first + 1) * (2 * half + 1) for first, last, half in bands))
+    onBone = ~numpy.isnan(raster)
+    clearing = numpy.where(onBone, raster, -numpy.inf) >= required_depth
+    minimum = footprint_minimum(raster, bands)
+    if coverage >= 1.0:
+        valid, keys = minimum >= required_depth, (minimum,)
+    else:
+        share = footprint_sum(summed_area_table(clearing, numpy.int32), bands) / cells
+        valid, keys = share >= coverage - 1e-9, (minimum, share)
+
+    # greedy non-maximum suppression on the rank of each valid position, sites are at least separation mm apart
+    rank = numpy.full(raster.shape, -1, dtype=numpy.int64)
+    candidates = numpy.flatnonzero(valid)
+    order = numpy.lexsort(tuple(key.ravel()[candidates] for key in keys))
+    rank.ravel()[candidates[order]] = numpy.arange(len(order))
+    reach = (max(size) if separation is None else separation) / precision
+    r = int(reach)
+    di, dj = numpy.mgrid[-r:r + 1, -r:r + 1]
+    near = di ** 2 + dj ** 2 < reach ** 2
+    picked = []
+    while len(picked) < count:
+        best = int(numpy.argmax(rank))
+        if rank.ravel()[best] < 0: break
+        i, j = numpy.unravel_index(best, raster.shape)
+        picked.append((int(i), int(j)))
+        i0, i1, j0, j1 = max(i - r, 0), min(i + r + 1, raster.shape[0]), max(j - r, 0), min(j + r + 1, raster.shape[1])
+        rank[i0:i1, j0:j1][near[i0 - i + r:i1 - i + r, j0 - j + r:j1 - j + r]] = -1
+    if not picked: return []
+
+    # share and mean only at the picked sites
+    rows, columns = numpy.array(picked).T
+    shares = footprint_sum(summed_area_table(clearing, numpy.int32), bands, rows, columns) / cells
+    means = footprint_sum(summed_area_table(numpy.where(onBone, raster, 0.0)), bands, rows, columns) / numpy.maximum(footprint_sum(summed_area_table(onBone, numpy.int32), bands, rows, columns), 1)
+    return [(int(i), int(j), float(minimum[i, j]), float(s), float(m)) for i, j, s, m in zip(rows, columns, shares, means)]
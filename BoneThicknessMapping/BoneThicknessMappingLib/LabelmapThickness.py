@@ -0,0 +1,133 @@
+# Thickness and first-hit marching through a binary labelmap instead of intersecting a closed surface. Only depends
+# on numpy, rays are sampled in large batches so no surface mesh or cell locator has to be built.
+import numpy
+
+
+class BinaryLabelmap:
+    array = None  # bool (k, j, i), True for voxels inside the segment
+    ijk_to_ras = None
+    ras_to_ijk = None
+    spacing = None  # smallest voxel edge in mm
+
+    def __init__(self, array, ijk_to_ras):
+        self.array = numpy.ascontiguousarray(array) != 0
+        self.ijk_to_ras = numpy.array(ijk_to_ras, dtype=numpy.float64)
+        self.ras_to_ijk = numpy.linalg.inv(self.ijk_to_ras)
+        self.spacing = float(numpy.linalg.norm(self.ijk_to_ras[:3, :3], axis=0).min())
+
+    def bounds(self):
+        # RAS bounds [xmin, xmax, ymin, ymax, zmin, zmax] of the voxels inside the segment
+        extents = []
+        for axis in [(1, 2), (0, 2), (0, 1)]:
+            occupied = numpy.flatnonzero(self.array.any(axis=axis))
+            if len(occupied) == 0: return [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+            extents.append((occupied[0] - 0.5, occupied[-1] + 0.5))
+        (k0, k1), (j0, j1), (i0, i1) = extents
+        corners = numpy.array([[i, j, k, 1.0] for i in (i0, i1) for j in (j0, j1) for k in (k0, k1)]) @ self.ijk_to_ras.T
+        return [float(v) for axis in range(3) for v in (corners[:, axis].min(), corners[:, axis].max())]
+
+    def interpolate(self, ijk):
+        # trilinear occupancy in [0, 1] at continuous (n, 3) ijk positions, zero outside the grid
+        base = numpy.floor(ijk).astype(numpy.int64)
+        fraction = ijk - base
+        value = numpy.zeros(len(ijk))
+        for corner in range(8):
+            offset = numpy.array([(corner >> 0) & 1, (corner >> 1) & 1, (corner >> 2) & 1])
+            c = base + offset
+            valid = numpy.all((c >= 0) & (c < self.array.shape[::-1]), axis=1)
+            weight = numpy.prod(numpy.where(offset, fraction, 1.0 - fraction), axis=1)
+            value[valid] += weight[valid] * self.array[c[valid, 2], c[valid, 1], c[valid, 0]]
+        return value
+
+
+def march(labelmap, starts, directions, length, step=None, max_samples=2**22, on_progress=None):
+    # every boundary crossing along start + distance * direction for 0 <= distance <= length, as (ray, distance) ordered
+    # by ray then distance. Ray ends count as outside, so each ray has an even number of crossings, entering first.
+    step = step if step is not None else labelmap.spacing / 2.0
+    rays, distances = [numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0)]
+    if len(starts) == 0: return rays[0], distances[0]
+    startsIjk = starts @ labelmap.ras_to_ijk[:3, :3].T + labelmap.ras_to_ijk[:3, 3]
+    directionsIjk = directions @ labelmap.ras_to_ijk[:3, :3].T
+
+    # part of every ray inside the voxel grid
+    shape = numpy.array(labelmap.array.shape[::-1], dtype=numpy.float64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t1, t2 = (-0.5 - startsIjk) / directionsIjk, (shape - 0.5 - startsIjk) / directionsIjk
+    parallel = directionsIjk == 0
+    within = (startsIjk >= -0.5) & (startsIjk <= shape - 0.5)
+    lower = numpy.maximum(0.0, numpy.where(parallel, numpy.where(within, -numpy.inf, numpy.inf), numpy.minimum(t1, t2)).max(axis=1))
+    upper = numpy.minimum(length, numpy.where(parallel, numpy.where(within, numpy.inf, -numpy.inf), numpy.maximum(t1, t2)).min(axis=1))
+    crossing = upper > lower
+    if not crossing.any(): return rays[0], distances[0]
+    batch = max(1, max_samples // (int(numpy.ceil((upper - lower)[crossing].max() / step)) + 1))
+
+    flat, (sizeK, sizeJ, sizeI) = labelmap.array.ravel(), labelmap.array.shape
+    for b in range(0, len(starts), batch):
+        s = slice(b, b + batch)
+        if not crossing[s].any(): continue
+        # samples sit at whole steps from each ray's start, so which rays share a batch (or a tile) changes none of them
+        t0 = numpy.floor(lower[s][crossing[s]].min() / step) * step
+        t = t0 + numpy.arange(int(numpy.ceil((upper[s][crossing[s]].max() - t0) / step)) + 1) * step
+        # nearest voxel of every sample, as a flat index into the (k, j, i) array
+        index, valid = 0, True
+        for axis, size in ((2, sizeK), (1, sizeJ), (0, sizeI)):
+            c = numpy.rint(startsIjk[s, axis, None] + t[None, :] * directionsIjk[s, axis, None]).astype(numpy.int64)
+            valid = valid & (c >= 0) & (c < size)
+            index = index * size + c
+        inside = numpy.zeros((len(index), len(t) + 2), dtype=bool)
+        inside[:, 1:-1] = valid & flat[numpy.where(valid, index, 0)]
+        del index, valid
+        r, c = numpy.nonzero(inside[:, 1:] != inside[:, :-1])
+        entering = inside[r, c + 1]
+        # nearest voxel sampling gives staircases, place each crossing where the trilinear occupancy passes 0.5 instead
+        # (the smooth surface marching cubes would give), searching a few samples either side of the staircase step
+        offsets = numpy.arange(-2, 4)
+        positions = t0 + (c[:, None] - 1 + offsets[None, :]) * step
+        values = labelmap.interpolate((startsIjk[b + r, None, :] + positions[:, :, None] * directionsIjk[b + r, None, :]).reshape(-1, 3)).reshape(positions.shape)
+        passes = numpy.where(entering[:, None], (values[:, :-1] < 0.5) & (values[:, 1:] >= 0.5), (values[:, :-1] >= 0.5) & (values[:, 1:] < 0.5))
+        m = numpy.argmin(numpy.where(passes, numpy.abs(offsets[:-1]), len(offsets)), axis=1)
+        rows = numpy.arange(len(m))
+        found, valueBefore, valueAfter = passes[rows, m], values[rows, m], values[rows, m + 1]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            fraction = numpy.where(found, (0.5 - valueBefore) / (valueAfter - valueBefore), 0.5)
+        m = numpy.where(found, m, 2)
+        rays.append(r + b)
+        distances.append(numpy.clip(positions[rows, m] + fraction * step, 0.0, length))
+        if on_progress is not None: on_progress(min(b + batch, len(starts)), len(starts))
+    return numpy.concatenate(rays), numpy.concatenate(distances)
+
+
+def first_crossings(labelmap, starts, directions, length, step=None, on_progress=None):
+    # distance along each ray to where it first enters the segment, nan where it never does
+    rays, distances = march(labelmap, starts, directions, length, step=step, on_progress=on_progress)
+    first = numpy.full(len(starts), numpy.nan)
+    entered, index = numpy.unique(rays, return_index=True)
+    first[entered] = distances[index]
+    return first
+
+
+def calculate_thickness(labelmap, points, normals, stretch_factor, mm_of_air_past_bone, gradient_scale_factor=10.0, step=None, on_progress=None):
+    # same rays and rules as ThicknessCalculation.calculate_thickness: from point + normal*stretch to point - normal*stretch,
+    # thickness spans the first bone run plus any following runs separated by less than mm_of_air_past_bone of air
+    points, normals = numpy.asarray(points, dtype=numpy.float64), numpy.asarray(normals, dtype=numpy.float64)
+    thickness, airCellDistance = numpy.zeros(len(points)), numpy.zeros(len(points))
+    aimed = numpy.flatnonzero(numpy.linalg.norm(normals, axis=1) > 0)
+    rays, distances = march(labelmap, points[aimed] + normals[aimed] * stretch_factor, -normals[aimed], 2.0 * stretch_factor, step=step, on_progress=on_progress)
+    if len(rays) == 0: return thickness, airCellDistance
+
+    # in/out runs of every ray as (rays, runs) tables
+    runRays, runIn, runOut = rays[0::2], distances[0::2], distances[1::2]
+    runCounts = numpy.bincount(runRays, minlength=len(aimed))
+    runIndex = numpy.arange(len(runRays)) - (numpy.cumsum(runCounts) - runCounts)[runRays]
+    ins, outs = numpy.full((len(aimed), runIndex.max() + 1), numpy.nan), numpy.full((len(aimed), runIndex.max() + 1), numpy.nan)
+    ins[runRays, runIndex], outs[runRays, runIndex] = runIn, runOut
+
+    # bridge air gaps run by run, for all rays at once
+    lastOut = outs[:, 0].copy()
+    for k in range(1, ins.shape[1]):
+        bridged = (k < runCounts) & (ins[:, k] - lastOut < mm_of_air_past_bone)
+        lastOut = numpy.where(bridged, outs[:, k], lastOut)
+    measured = runCounts > 0
+    thickness[aimed[measured]] = (lastOut[measured] - ins[measured, 0]) * gradient_scale_factor
+    airCellDistance[aimed[measured]] = (outs[measured, 0] - ins[measured, 0]) * gradient_scale_factor
+    return thickness, airCellDistance
@@ -0,0 +1,187 @@
+# Analytic bone phantoms for benchmarking and regression checks of the logic without a patient scan. Each phantom is a
+# closed surface built with VTK, an inside test for voxelizing it into a labelmap, and the thickness and distance to
+# the first air cell it should have along a ray through a given point and normal.
+import abc
+
+import numpy
+import vtk
+
+from BoneThicknessMappingLib.LabelmapThickness import BinaryLabelmap
+
+# off-grid centre so that rays don't line up with mesh edges and vertices
+CENTRE = (1.3, -2.1, 0.7)
+
+
+def clean_triangles(*sources):
+    append = vtk.vtkAppendPolyData()
+    for source in sources: append.AddInputConnection(source.GetOutputPort())
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(append.GetOutputPort())
+    clean = vtk.vtkCleanPolyData()
+    clean.SetInputConnection(triangles.GetOutputPort())
+    clean.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(clean.GetOutput())
+    return polyData
+
+
+def reversed_sphere(centre, radius, resolution):
+    # sphere facing inwards, the wall of a cavity
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(centre)
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(resolution)
+    sphere.SetPhiResolution(resolution)
+    reverse = vtk.vtkReverseSense()
+    reverse.SetInputConnection(sphere.GetOutputPort())
+    reverse.ReverseCellsOn()
+    reverse.ReverseNormalsOn()
+    return reverse
+
+
+class Phantom(abc.ABC):
+    name = None
+    poly_data = None
+    dimensions = None  # volume dimensions of a 1 mm scan holding the phantom, sets the thickness ray length
+
+    def bounds(self):
+        return list(self.poly_data.GetBounds())
+
+    @abc.abstractmethod
+    def inside(self, points):
+        # bool per (n, 3) point
+        pass
+
+    @abc.abstractmethod
+    def expected(self, points, normals):
+        # (checked, thickness, air cell distance) in mm per top layer point, only meaningful where checked is True;
+        # air cell distance is nan where it has no closed form
+        pass
+
+    def labelmap(self, spacing=0.5):
+        bounds = numpy.array(self.bounds()).reshape(3, 2)
+        origin = bounds[:, 0] - 2 * spacing
+        size = numpy.ceil((bounds[:, 1] - bounds[:, 0]) / spacing).astype(int) + 5
+        k, j, i = numpy.meshgrid(*[numpy.arange(n) for n in size[::-1]], indexing='ij')
+        inside = self.inside(numpy.stack([i, j, k], axis=-1).reshape(-1, 3) * spacing + origin).reshape(k.shape)
+        ijkToRas = numpy.diag([spacing, spacing, spacing, 1.0])
+        ijkToRas[:3, 3] = origin
+        return BinaryLabelmap(inside, ijkToRas)
+
+    def set_dimensions(self, margin=20):
+        bounds = numpy.array(self.bounds()).reshape(3, 2)
+        self.dimensions = tuple(int(n) for n in numpy.ceil(bounds[:, 1] - bounds[:, 0]) + 2 * margin)
+
+
+class SphericalShell(Phantom):
+    def __init__(self, outer_radius=30.0, thickness=4.0, resolution=96, centre=CENTRE):
+        self.name = 'spherical_shell'
+        self.centre, self.outer_radius, self.thickness = numpy.array(centre), outer_radius, thickness
+        outer = vtk.vtkSphereSource()
+        outer.SetCenter(centre)
+        outer.SetRadius(outer_radius)
+        outer.SetThetaResolution(resolution)
+        outer.SetPhiResolution(resolution)
+        self.poly_data = clean_triangles(outer, reversed_sphere(centre, outer_radius - thickness, resolution))
+        self.set_dimensions()
+
+    def inside(self, points):
+        radius = numpy.linalg.norm(points - self.centre, axis=1)
+        return (self.outer_radius - self.thickness <= radius) & (radius <= self.outer_radius)
+
+    def expected(self, points, normals):
+        # any ray through the centre crosses the wall at right angles
+        radial = points - self.centre
+        radial /= numpy.linalg.norm(radial, axis=1)[:, None]
+        checked = numpy.abs(numpy.sum(radial * normals, axis=1)) > 0.97
+        return checked, numpy.full(len(points), self.thickness), numpy.full(len(points), self.thickness)
+
+
+class AirCellPlate(Phantom):
+    def __init__(self, size=(80.0, 70.3, 6.0), cell_radius=1.5, cell_spacing=10.0, resolution=24, centre=CENTRE):
+        # flat plate in the xy plane, a grid of spherical air cells along its mid plane; cells are narrower than the
+        # default mm of air past bone, so thickness bridges them and spans the whole plate
+        self.name = 'air_cell_plate'
+        self.centre, self.size, self.cell_radius = numpy.array(centre), numpy.array(size), cell_radius
+        plate = vtk.vtkCubeSource()
+        plate.SetCenter(centre)
+        plate.SetXLength(size[0])
+        plate.SetYLength(size[1])
+        plate.SetZLength(size[2])
+        cells = []
+        for axis in range(2):
+            count = int((size[axis] / 2.0 - 2 * cell_radius) // cell_spacing)
+            cells.append(numpy.arange(-count, count + 1) * cell_spacing)
+        # cells are shifted off the ray lattice as well, rays through their seams would cross them an odd number of times
+        self.cell_centres = numpy.array([[x + 0.37, y - 0.29, 0.0] for x in cells[0] for y in cells[1]]) + self.centre
+        self.poly_data = clean_triangles(plate, *[reversed_sphere(c, cell_radius, resolution) for c in self.cell_centres])
+        self.set_dimensions()
+
+    def inside(self, points):
+        inPlate = numpy.all(numpy.abs(points - self.centre) <= self.size / 2.0, axis=1)
+        inCell = numpy.zeros(len(points), dtype=bool)
+        for c in self.cell_centres: inCell |= numpy.linalg.norm(points - c, axis=1) < self.cell_radius
+        return inPlate & ~inCell
+
+    def expected(self, points, normals):
+        # rays square to a face span the plate, away from its edges
+        offset = points - self.centre
+        axis = numpy.argmax(numpy.abs(normals), axis=1)
+        checked = numpy.abs(normals[numpy.arange(len(normals)), axis]) > 0.97
+        inset = numpy.minimum(4.0, self.size / 4.0)
+        for a in range(3): checked &= (axis == a) | (numpy.abs(offset[:, a]) < self.size[a] / 2.0 - inset[a])
+        thickness = self.size[axis]
+        # rays through the top or bottom face reach the first air cell they pass, if any
+        airCellDistance = numpy.where(axis == 2, self.size[2], numpy.nan)
+        for c in self.cell_centres:
+            d2 = numpy.sum((points[:, :2] - c[:2]) ** 2, axis=1)
+            through = (axis == 2) & (d2 < self.cell_radius ** 2)
+            airCellDistance[through] = self.size[2] / 2.0 - numpy.sqrt(self.cell_radius ** 2 - d2[through])
+        return checked, thickness, airCellDistance
+
+
+class SkullSlab(Phantom):
+    def __init__(self, outer_radius=70.0, thickness=6.0, opening=50.0, resolution=96, centre=CENTRE):
+        # dome shaped slab, the cap of a thick spherical shell within opening degrees of +z, swept from its profile
+        self.name = 'skull_slab'
+        self.centre, self.outer_radius, self.thickness, self.opening = numpy.array(centre), outer_radius, thickness, numpy.radians(opening)
+        profile = vtk.vtkPolyData()
+        points, line = vtk.vtkPoints(), vtk.vtkPolyLine()
+        angles = numpy.linspace(0.0, self.opening, resolution // 4 + 1)
+        for radius, sweep in ((outer_radius, angles), (outer_radius - thickness, angles[::-1])):
+            for angle in sweep: points.InsertNextPoint(radius * numpy.sin(angle), 0.0, radius * numpy.cos(angle))
+        line.GetPointIds().SetNumberOfIds(points.GetNumberOfPoints())
+        for i in range(points.GetNumberOfPoints()): line.GetPointIds().SetId(i, i)
+        lines = vtk.vtkCellArray()
+        lines.InsertNextCell(line)
+        profile.SetPoints(points)
+        profile.SetLines(lines)
+        sweep = vtk.vtkRotationalExtrusionFilter()
+        sweep.SetInputData(profile)
+        sweep.SetResolution(resolution)
+        sweep.CappingOff()
+        transform = vtk.vtkTransform()
+        transform.Translate(centre)
+        move = vtk.vtkTransformPolyDataFilter()
+        move.SetInputConnection(sweep.GetOutputPort())
+        move.SetTransform(transform)
+        self.poly_data = clean_triangles(move)
+        self.set_dimensions()
+
+    def inside(self, points):
+        offset = points - self.centre
+        radius = numpy.linalg.norm(offset, axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            angle = numpy.arccos(numpy.clip(offset[:, 2] / radius, -1.0, 1.0))
+        return (self.outer_radius - self.thickness <= radius) & (radius <= self.outer_radius) & (angle <= self.opening)
+
+    def expected(self, points, normals):
+        # like the shell, away from the rim where the top layer bends round it
+        radial = points - self.centre
+        radial /= numpy.linalg.norm(radial, axis=1)[:, None]
+        checked = (numpy.abs(numpy.sum(radial * normals, axis=1)) > 0.97) & (numpy.arccos(numpy.clip(radial[:, 2], -1.0, 1.0)) < self.opening - numpy.radians(5.0))
+        return checked, numpy.full(len(points), self.thickness), numpy.full(len(points), self.thickness)
+
+
+def all_phantoms():
+    return [SphericalShell(), AirCellPlate(), SkullSlab()]
@@ -0,0 +1,68 @@
+# Writes a finished map as dense cast-plane rasters next to its top layer model. Thickness, air cell distance and the
+# surface position along the cast axis are float32 .npy files (mm, nan where the ray missed) and the hit mask a uint8
+# one, all memory-mappable with numpy.load(path, mmap_mode='r'). A _grid.json holds their placement on the cast plane.
+# Rasters are filled a block of rows at a time straight into the mapped files, so even EXTREME quality grids are never
+# held twice in memory.
+import json
+import os
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+AXIS_NAMES = ('R', 'A', 'S')  # RAS coordinate of each axis index
+
+
+def write_top_layer(path, poly_data):
+    # raw appended binary, the smallest and quickest XML layout to read back
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(poly_data)
+    writer.SetFileName(path)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    if not writer.Write(): raise IOError('Could not write ' + path)
+    return path
+
+
+def write_rasters(prefix, hit_point_grid, thickness_scalar_array, air_cell_scalar_array, cast_axis_name=None, gradient_scale_factor=10.0, rows_per_block=256):
+    pidGrid = hit_point_grid.pid_grid
+    if hit_point_grid.plane is None: raise ValueError('The hit point grid has no cast-plane placement')
+    castIndex, origin, precision = hit_point_grid.plane
+    planeIndices = [i for i in range(3) if i != castIndex]
+    # scalar arrays hold mm scaled by the gradient factor and the points plain mm, both read without copying
+    values = {
+        'thickness': (numpy_support.vtk_to_numpy(thickness_scalar_array), gradient_scale_factor),
+        'air_cell': (numpy_support.vtk_to_numpy(air_cell_scalar_array), gradient_scale_factor),
+        'depth': (hit_point_grid.points[:, castIndex], 1.0),
+    }
+    paths = {'grid': prefix + '_grid.json'}
+    rasters = {}
+    for name in values:
+        paths[name] = prefix + '_' + name + '.npy'
+        rasters[name] = numpy.lib.format.open_memmap(paths[name], mode='w+', dtype=numpy.float32, shape=pidGrid.shape)
+    paths['mask'] = prefix + '_mask.npy'
+    rasters['mask'] = numpy.lib.format.open_memmap(paths['mask'], mode='w+', dtype=numpy.uint8, shape=pidGrid.shape)
+
+    for start in range(0, pidGrid.shape[0], rows_per_block):
+        pids = pidGrid[start:start + rows_per_block]
+        hit = pids >= 0
+        rasters['mask'][start:start + rows_per_block] = hit
+        for name, (value, scale) in values.items():
+            block = numpy.full(pids.shape, numpy.nan, dtype=numpy.float32)
+            block[hit] = value[pids[hit]] / scale
+            rasters[name][start:start + rows_per_block] = block
+    for raster in rasters.values(): raster.flush()
+    del rasters
+
+    grid = {
+        'shape': list(pidGrid.shape),
+        'origin': [float(o) for o in origin],  # RAS mm of raster element [0, 0] on the row and column axes
+        'spacing': float(precision),
+        'row_axis': AXIS_NAMES[planeIndices[0]],
+        'column_axis': AXIS_NAMES[planeIndices[1]],
+        'cast_axis': cast_axis_name,
+        'units': 'mm',
+        'files': dict((name, os.path.basename(paths[name])) for name in ('thickness', 'air_cell', 'depth', 'mask')),
+    }
+    with open(paths['grid'], 'w') as f: json.dump(grid, f, indent=2)
+    return paths
@@ -0,0 +1,70 @@
+# Disk and memory cache for intermediate and final results, so re-running with a few changed parameters can skip
+# the stages whose inputs did not change. Entries on disk are evicted least recently used first once the store
+# grows past its size cap; locators can't be written to disk and are only kept in memory for the latest meshes.
+import collections
+import hashlib
+import json
+import os
+
+import vtk
+
+
+class ResultCache:
+    SEGMENTATION = 'segmentation'
+    RESULT = 'result'
+
+    def __init__(self, directory, max_bytes, max_locator_meshes=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_locator_meshes = max_locator_meshes
+        self.locators = collections.OrderedDict()
+        if not os.path.isdir(directory): os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    def path(self, level, key):
+        return os.path.join(self.directory, level + '_' + key + '.vtp')
+
+    def get_poly_data(self, level, key):
+        path = self.path(level, key)
+        if not os.path.isfile(path): return None
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        if reader.GetErrorCode() != 0: return None
+        # mark as recently used
+        os.utime(path, None)
+        return reader.GetOutput()
+
+    def put_poly_data(self, level, key, poly_data):
+        path = self.path(level, key)
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetInputData(poly_data)
+        writer.SetFileName(path + '.part')
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.Write()
+        os.replace(path + '.part', path)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.vtp')]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(e) for e in entries)
+        while entries and total > self.max_bytes:
+            oldest = entries.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def clear(self):
+        for f in os.listdir(self.directory): os.remove(os.path.join(self.directory, f))
+        self.locators.clear()
+
+    def locator(self, mesh_key, kind, build):
+        if mesh_key not in self.locators: self.locators[mesh_key] = {}
+        self.locators.move_to_end(mesh_key)
+        while len(self.locators) > self.max_locator_meshes: self.locators.popitem(last=False)
+        if kind not in self.locators[mesh_key]: self.locators[mesh_key][kind] = build()
+        return self.locators[mesh_key][kind]
@@ -0,0 +1,103 @@
+# Per-stage wall time, CPU time and peak memory of a run, plus counters such as rays cast. Only depends on the
+# standard library so that it can be used from the logic, the batch runner and worker threads alike.
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def resident_memory():
+    # current resident set size in bytes, None where it can't be read
+    if psutil is not None: return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def children_cpu_time():
+    # CPU time of finished child processes, e.g. thickness workers
+    if resource is None: return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunMetrics:
+    SAMPLE_INTERVAL = 0.02  # seconds between memory samples while a stage runs
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # repeated stages (e.g. per progressive level) accumulate time and keep the highest peak
+        if not self.enabled:
+            yield
+            return
+        samples, done = [resident_memory()], threading.Event()
+
+        def sample():
+            while not done.wait(self.SAMPLE_INTERVAL): samples.append(resident_memory())
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        wallStart, cpuStart, childrenStart = time.perf_counter(), time.process_time(), children_cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wallStart, time.process_time() - cpuStart + children_cpu_time() - childrenStart
+            done.set()
+            sampler.join()
+            samples.append(resident_memory())
+            known = [s for s in samples if s is not None]
+            with self._lock:
+                record = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None})
+                record['calls'] += 1
+                record['wall_s'] += wall
+                record['cpu_s'] += cpu
+                if known: record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0.0, max(known) / 2.0**20)
+
+    def count(self, name, value=1):
+        if not self.enabled: return
+        with self._lock: self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        # counter that is measured once rather than accumulated, e.g. an error
+        if not self.enabled: return
+        with self._lock: self.counters[name] = value
+
+    def as_dict(self):
+        counters = dict(self.counters)
+        if counters.get('thickness_rays'):
+            for name in ['candidate_cells', 'thickness_crossings']:
+                if name in counters: counters[name + '_per_thickness_ray'] = counters[name] / float(counters['thickness_rays'])
+        return {'stages': dict(self.stages), 'counters': counters}
+
+    def save(self, path):
+        with open(path, 'w') as f: json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self):
+        lines = []
+        for name, record in self.stages.items():
+            memory = '%.0f MB' % record['peak_rss_mb'] if record['peak_rss_mb'] is not None else '-'
+            lines.append('%-22s %8.2fs wall %8.2fs cpu %10s peak' % (name, record['wall_s'], record['cpu_s'], memory))
+        for name, value in self.as_dict()['counters'].items():
+            lines.append('%-34s %s' % (name, ('%.3g' % value) if isinstance(value, float) else value))
+        return '\n'.join(lines)
+
+
+# default for callers that don't collect metrics, records nothing
+RunMetrics.DISABLED = RunMetrics(enabled=False)
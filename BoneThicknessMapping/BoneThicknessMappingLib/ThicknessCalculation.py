@@ -0,0 +1,187 @@
+# Thickness ray casting against a closed surface. Only depends on vtk and numpy so that it can also run
+# inside worker processes (PythonSlicer) where the Slicer GUI modules are not available.
+import multiprocessing
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+# static cell locators return every crossing of a line in one call from VTK 9.2, before that each candidate cell is
+# intersected from Python
+MULTI_HIT_LOCATOR = (vtk.vtkVersion.GetVTKMajorVersion(), vtk.vtkVersion.GetVTKMinorVersion()) >= (9, 2)
+
+
+def build_cell_locator(poly_data):
+    cellLocator = vtk.vtkStaticCellLocator()
+    cellLocator.SetDataSet(poly_data)
+    cellLocator.BuildLocator()
+    return cellLocator
+
+
+def serialize_poly_data(poly_data):
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(poly_data)
+    writer.SetDataModeToBinary()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return writer.GetOutputString()
+
+
+def deserialize_poly_data(string):
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetInputString(string)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def interpret_distances(parameters, hit_points, ray_offsets, mm_of_air_past_bone, gradient_scale_factor):
+    # crossings of a batch of rays as one ragged array: line parameter and point of every crossing, ray r owning
+    # crossings ray_offsets[r]:ray_offsets[r+1] in any order; rays need two or more crossings. Thickness runs from the
+    # first crossing to the exit of the last in/out pair reached through air gaps shorter than mm_of_air_past_bone,
+    # and the first air cell starts at the first exit.
+    counts = numpy.diff(ray_offsets)
+    ray = numpy.repeat(numpy.arange(len(counts)), counts)
+    order = numpy.lexsort((parameters, ray))
+    hit_points = hit_points[order]
+    local = numpy.arange(len(ray)) - ray_offsets[ray]
+    # the exit of a pair (odd local index) ends the bone unless a whole next pair follows across a short gap
+    gap = numpy.full(len(ray), numpy.inf)
+    hasNextPair = (local % 2 == 1) & (local + 2 < counts[ray])
+    following = numpy.flatnonzero(hasNextPair)
+    gap[following] = numpy.linalg.norm(hit_points[following + 1] - hit_points[following], axis=1) * gradient_scale_factor
+    ends = (local % 2 == 1) & ~(gap < mm_of_air_past_bone * gradient_scale_factor)
+    firstIn = ray_offsets[:-1]
+    lastOut = numpy.minimum.reduceat(numpy.where(ends, numpy.arange(len(ray)), len(ray)), firstIn)
+    thickness = numpy.linalg.norm(hit_points[lastOut] - hit_points[firstIn], axis=1) * gradient_scale_factor
+    airCellDistance = numpy.linalg.norm(hit_points[firstIn + 1] - hit_points[firstIn], axis=1) * gradient_scale_factor
+    return thickness, airCellDistance
+
+
+def cell_crossings(poly_data, cell_locator, starts, ends, indices, statistics=None):
+    # crossings of the rays at indices as (crossing points, ray of each), intersecting every candidate cell on its own;
+    # the reference search, exact also for rays lying in a face of the surface
+    crossings, rays = [], []
+    candidateCells = 0
+    tol, pCoords, subId = 0.000, [0, 0, 0], vtk.reference(0)
+    cellsOfIntersection = vtk.vtkIdList()
+    t, p = vtk.reference(0.0), [0.0, 0.0, 0.0]
+    for i in indices:
+        start, end = starts[i].tolist(), ends[i].tolist()
+        cell_locator.FindCellsAlongLine(start, end, tol, cellsOfIntersection)
+        candidateCells += cellsOfIntersection.GetNumberOfIds()
+        for cellIndex in range(cellsOfIntersection.GetNumberOfIds()):
+            if poly_data.GetCell(cellsOfIntersection.GetId(cellIndex)).IntersectWithLine(start, end, tol, t, p, pCoords, subId) and 0.0 <= t <= 1.0:
+                crossings.append([tuple(p)])
+                rays.append([i])
+    if statistics is not None: statistics['candidate_cells'] = statistics.get('candidate_cells', 0) + candidateCells
+    return crossings, rays
+
+
+def crossing_parameters(hit_points, rays, starts, ends):
+    # line parameter of each crossing, only its order along the ray matters
+    direction = ends[rays] - starts[rays]
+    return numpy.sum((hit_points - starts[rays]) * direction, axis=1) / numpy.sum(direction * direction, axis=1)
+
+
+def degenerate_rays(hit_points, rays, starts, ends, count, tolerance=1e-6):
+    # rays whose multi-hit crossings may not be the per-cell ones: fewer than two or an odd number of crossings, or
+    # crossings closer than tolerance mm, as where a ray lies in a face of the surface and touches several triangles
+    counts = numpy.bincount(rays, minlength=count)
+    suspect = (counts < 2) | (counts % 2 == 1)
+    if len(rays) > 1:
+        parameters = crossing_parameters(hit_points, rays, starts, ends)
+        order = numpy.lexsort((parameters, rays))
+        sortedRays, sortedParameters = rays[order], parameters[order]
+        lengths = numpy.linalg.norm(ends[sortedRays[1:]] - starts[sortedRays[1:]], axis=1)
+        close = (sortedRays[1:] == sortedRays[:-1]) & ((sortedParameters[1:] - sortedParameters[:-1]) * lengths < tolerance)
+        suspect[sortedRays[1:][close]] = True
+    return numpy.flatnonzero(suspect)
+
+
+def calculate_thickness(poly_data, cell_locator, points, normals, stretch_factor, mm_of_air_past_bone, gradient_scale_factor=10.0, statistics=None, multi_hit=MULTI_HIT_LOCATOR):
+    # statistics, when given, is a dict that collects the number of crossings found (and candidate cells tested
+    # by the per-cell search)
+    thickness, airCellDistance = numpy.zeros(len(points)), numpy.zeros(len(points))
+    points, normals = numpy.asarray(points, dtype=numpy.float64), numpy.asarray(normals, dtype=numpy.float64)
+    starts, ends = points + normals * stretch_factor, points - normals * stretch_factor
+    # crossings of every ray are gathered flat and interpreted together afterwards
+    if multi_hit:
+        crossings, rays = [], []
+        hits, cellIds = vtk.vtkPoints(), vtk.vtkIdList()
+        hits.SetDataTypeToDouble()
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            # without any tolerance crossings that lie on the surface's bounds, e.g. a cropped flat face, are dropped
+            cell_locator.IntersectWithLine(start, end, 1e-9, hits, cellIds)
+            if hits.GetNumberOfPoints() == 0: continue
+            crossings.append(numpy_support.vtk_to_numpy(hits.GetData()).copy())
+            rays.append(numpy.full(hits.GetNumberOfPoints(), i))
+        hitPoints = numpy.concatenate(crossings).reshape(-1, 3) if crossings else numpy.empty((0, 3))
+        rays = numpy.concatenate(rays) if rays else numpy.empty(0, dtype=numpy.int64)
+        # the per-cell search answers the rays the multi-hit query can get wrong
+        requeried = degenerate_rays(hitPoints, rays, starts, ends, len(points))
+        if statistics is not None: statistics['requeried_rays'] = statistics.get('requeried_rays', 0) + len(requeried)
+        keep = ~numpy.isin(rays, requeried)
+        crossings, rays = [hitPoints[keep]], [rays[keep]]
+        requeriedCrossings, requeriedRays = cell_crossings(poly_data, cell_locator, starts, ends, requeried, statistics)
+        crossings += requeriedCrossings
+        rays += requeriedRays
+    else: crossings, rays = cell_crossings(poly_data, cell_locator, starts, ends, range(len(points)), statistics)
+    if statistics is not None: statistics['thickness_crossings'] = statistics.get('thickness_crossings', 0) + sum(len(r) for r in rays)
+    if not rays: return thickness, airCellDistance
+    hitPoints, rays = numpy.concatenate(crossings).reshape(-1, 3), numpy.concatenate(rays)
+    if len(rays) == 0: return thickness, airCellDistance
+    if multi_hit:
+        # crossings grouped by ray, each ray's in the order its search found them
+        order = numpy.argsort(rays, kind='stable')
+        hitPoints, rays = hitPoints[order], rays[order]
+    counts = numpy.bincount(rays, minlength=len(points))
+    measured = counts >= 2
+    if not measured.any(): return thickness, airCellDistance
+    keep = measured[rays]
+    hitPoints, rays = hitPoints[keep], rays[keep]
+    parameters = crossing_parameters(hitPoints, rays, starts, ends)
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts[measured])])
+    thickness[measured], airCellDistance[measured] = interpret_distances(parameters, hitPoints, offsets, mm_of_air_past_bone, gradient_scale_factor)
+    return thickness, airCellDistance
+
+
+# Worker processes rebuild their own surface and locator once, then handle any number of shards
+_workerPolyData, _workerCellLocator = None, None
+
+
+def _initialize_worker(serialized_poly_data):
+    global _workerPolyData, _workerCellLocator
+    _workerPolyData = deserialize_poly_data(serialized_poly_data)
+    _workerCellLocator = build_cell_locator(_workerPolyData)
+
+
+def _calculate_thickness_shard(shard):
+    pids, points, normals, stretchFactor, mmOfAirPastBone, gradientScaleFactor = shard
+    statistics = {}
+    thickness, airCellDistance = calculate_thickness(_workerPolyData, _workerCellLocator, points, normals, stretchFactor, mmOfAirPastBone, gradientScaleFactor, statistics)
+    return pids, thickness, airCellDistance, statistics
+
+
+def calculate_thickness_parallel(poly_data, pids, points, normals, stretch_factor, mm_of_air_past_bone, workers, gradient_scale_factor=10.0, on_progress=None, executable=None, shards_per_worker=8, statistics=None):
+    # results are indexed by point id, shards are merged back in whatever order they finish
+    size = int(pids.max()) + 1 if len(pids) > 0 else 0
+    thickness, airCellDistance = numpy.zeros(size), numpy.zeros(size)
+    if size == 0: return thickness, airCellDistance
+    context = multiprocessing.get_context('spawn')
+    if executable is not None: context.set_executable(executable)
+    splits = numpy.array_split(numpy.arange(len(pids)), min(len(pids), workers*shards_per_worker))
+    shards = [(pids[s], points[s], normals[s], stretch_factor, mm_of_air_past_bone, gradient_scale_factor) for s in splits]
+    pool = context.Pool(processes=workers, initializer=_initialize_worker, initargs=(serialize_poly_data(poly_data),))
+    try:
+        done = 0
+        for shardPids, shardThickness, shardAirCellDistance, shardStatistics in pool.imap_unordered(_calculate_thickness_shard, shards):
+            thickness[shardPids], airCellDistance[shardPids] = shardThickness, shardAirCellDistance
+            if statistics is not None:
+                for name, value in shardStatistics.items(): statistics[name] = statistics.get(name, 0) + value
+            done += len(shardPids)
+            if on_progress is not None: on_progress(done, len(pids))
+    finally:
+        pool.terminate()
+        pool.join()
+    return thickness, airCellDistance